@@ -2,3 +2,5 @@ from baiji.pod.config import Config
 from baiji.pod.asset_cache import AssetCache
 from baiji.pod.versioned.core import VersionedCache
 from baiji.pod.versioned.uploader import VersionedCacheUploader
+from baiji.pod.async_cache import AsyncAssetCache
+from baiji.pod.async_cache import AsyncVersionedCache
@@ -1,5 +1,23 @@
+import collections
 import os
+import threading
+import time
 from baiji import s3
+from baiji.pod.eviction import GRACE_PERIOD
+from baiji.pod.util.locking import SingleFlight
+
+# How many files `AssetCache.get_many` downloads at once, by default.
+DEFAULT_MAX_WORKERS = 8
+
+# In a bounded cache, how often the use of a file returned from the memo of
+# fresh paths is recorded. This is well within the evictor's grace period,
+# so a file in constant use is never evicted from under us.
+ACCESS_RECORD_INTERVAL = GRACE_PERIOD / 2
+
+# In a bounded cache, the shortest time between the eviction passes started
+# after downloads. Each pass looks at every cached file, so during a burst
+# of downloads, like a prefill, one pass covers many of them.
+EVICTION_INTERVAL = 5
 
 
 class CachedPath(unicode):
@@ -8,8 +26,15 @@ class CachedPath(unicode):
 
 
 class CacheFile(object):
-    def __init__(self, static_cache, path, bucket=None):
-        self.config = static_cache.config
+    def __init__(self, static_cache, path, bucket=None, entry=None):
+        '''
+        entry: The CacheEntry for this file, when the caller already has it.
+        '''
+        self.config = static_cache.settings
+        self.metadata = static_cache.metadata
+        self.bandwidth = static_cache.bandwidth
+        self._entry = entry
+        self._entry_known = entry is not None
 
         if s3.path.isremote(path):
             parsed_path = s3.path.parse(path)
@@ -42,22 +67,36 @@ class CacheFile(object):
 
     @property
     def timestamp_file(self):
-        return os.path.join(
-            self.config.cache_dir,
-            '.timestamps',
-            self.bucket,
-            self.path[1:])
+        from baiji.pod.metadata import timestamp_file
+        return timestamp_file(self.config.cache_dir, self.bucket, self.path)
+
+    @property
+    def entry(self):
+        '''
+        The CacheEntry recorded for this file, or None. It's looked up once,
+        and then kept until this object changes it.
+        '''
+        if not self._entry_known:
+            self._entry = self.metadata.get(self.bucket, self.path)
+            self._entry_known = True
+        return self._entry
+
+    def use_entry(self, entry):
+        '''
+        Use `entry`, a CacheEntry or None, as what's recorded for this file,
+        rather than looking it up. See `AssetCache.cache_files`.
+        '''
+        self._entry = entry
+        self._entry_known = True
+
+    def _forget_entry(self):
+        self._entry = None
+        self._entry_known = False
 
     @property
     def timestamp(self):
-        try:
-            return os.path.getmtime(self.timestamp_file)
-        except OSError as e:
-            import errno
-            if e.errno == errno.ENOENT:
-                return None
-            else:
-                raise
+        entry = self.entry
+        return entry.checked_at if entry is not None else None
 
     @property
     def age(self):
@@ -69,8 +108,40 @@ class CacheFile(object):
 
     @property
     def size(self):
+        '''
+        The size of the local file. When it's been recorded, it's taken from
+        the metadata store, without a stat call.
+        '''
+        entry = self.entry
+        if entry is not None and entry.size is not None:
+            return entry.size
+        stat = self._stat()
+        return stat.st_size if stat is not None else None
+
+    def update_timestamp(self, etag=None):
+        '''
+        Mark the file as checked now. If the local file is known to match
+        `etag`, pass it, and it will be recorded along with the file's
+        current size and mtime.
+        '''
+        _, size, mtime = self.validator(etag)
+        self.metadata.touch(self.bucket, self.path, etag=etag, size=size, mtime=mtime)
+        self._forget_entry()
+
+    def validator(self, etag):
+        '''
+        Return `(etag, size, mtime)` to record for the local file, which is
+        known to match `etag`. When `etag` is None, so are the others.
+        '''
+        if etag is not None:
+            stat = self._stat()
+            if stat is not None:
+                return etag, stat.st_size, stat.st_mtime
+        return etag, None, None
+
+    def _stat(self):
         try:
-            return os.stat(self.local).st_size
+            return os.stat(self.local)
         except OSError as e:
             import errno
             if e.errno == errno.ENOENT:
@@ -78,15 +149,28 @@ class CacheFile(object):
             else:
                 raise
 
-    def update_timestamp(self):
-        from baiji.util.shutillib import mkdir_p
-        if not os.path.exists(self.timestamp_file):
-            mkdir_p(os.path.dirname(self.timestamp_file))
-        open(self.timestamp_file, 'w').close()
+    @property
+    def local_etag(self):
+        '''
+        The etag of the local file. Computing it means reading the whole file,
+        so we use the etag recorded when it was downloaded or last checked, as
+        long as the file has the same size and mtime as it did then.
+        '''
+        entry = self.entry
+        if entry is not None and entry.etag is not None:
+            recorded = entry.etag, entry.size, entry.mtime
+        else:
+            recorded = self.metadata.recorded_etag(self.bucket, self.path)
+        if recorded is not None:
+            etag, size, mtime = recorded
+            stat = self._stat()
+            if stat is not None and (stat.st_size, stat.st_mtime) == (size, mtime):
+                return etag
+        return s3.etag(self.local)
 
     def invalidate(self):
-        from baiji.pod.util.shutillib import remove_file
-        remove_file(self.timestamp_file)
+        self.metadata.invalidate(self.bucket, self.path)
+        self._forget_entry()
 
     @property
     def is_outdated(self):
@@ -99,28 +183,124 @@ class CacheFile(object):
             return True
         return self.age > timeout
 
+    @property
+    def can_serve_stale(self):
+        '''
+        Whether this file is outdated, but recently enough that it can be
+        returned while it's revalidated in the background. See
+        `Config.stale_while_revalidate`.
+        '''
+        max_staleness = self.config.stale_while_revalidate
+        if max_staleness is None or not self.is_outdated:
+            return False
+        return self.age <= self.config.timeout + max_staleness
+
+    @property
+    def fresh_until(self):
+        '''
+        The time, in seconds since the epoch, after which this file needs to be
+        revalidated. Files which are never checked are fresh forever; files
+        which have never been checked are already stale.
+        '''
+        if self.bucket in self.config.immutable_buckets:
+            return float('inf')
+        timeout = self.config.timeout
+        if not timeout:
+            return float('inf')
+        timestamp = self.timestamp
+        if timestamp is None:
+            return float('-inf')
+        return timestamp + timeout
+
     def download(self, verbose=True):
-        try:
-            s3.cp(self.remote, self.local, force=True, progress=verbose, validate=True)
-        except s3.KeyNotFound as e:
-            raise e
-        self.update_timestamp()
+        # The etag we record comes from the GET which downloaded the file, so
+        # it always matches what we have, even if the file changes on s3
+        # while we download it.
+        self.update_timestamp(etag=self._fetch(verbose=verbose))
+
+    def refresh(self, verbose=True):
+        '''
+        Check the file against s3 with a single conditional GET, which
+        downloads it only if it's changed. Returns True if it was downloaded.
+        '''
+        local_etag = self.local_etag
+        etag = self._fetch(if_none_match=local_etag, verbose=verbose)
+        self.update_timestamp(etag=local_etag if etag is None else etag)
+        return etag is not None
+
+    def _fetch(self, if_none_match=None, verbose=True):
+        from baiji.pod.transfer import fetch
+        return fetch(
+            self.remote, self.local, if_none_match=if_none_match, progress=verbose,
+            chunk_size=self.config.download_chunk_size,
+            concurrency=self.config.download_concurrency, limiter=self.bandwidth)
 
     @property
     def is_cached(self):
-        return os.path.exists(self.local)
+        '''
+        Whether the file is in the cache. With the index metadata store, an
+        entry whose file has gone missing, because it was removed by other
+        means, or we were interrupted while removing it, is removed too.
+        '''
+        if os.path.exists(self.local):
+            return True
+        if self.metadata.records_presence and self.entry is not None:
+            self.metadata.remove(self.bucket, self.path)
+            self._forget_entry()
+        return False
 
     def remove_cached(self):
+        from baiji.pod.transfer import PartialDownload
         from baiji.pod.util.shutillib import remove_file
-        self.invalidate()
+        self.metadata.remove(self.bucket, self.path)
+        self._forget_entry()
         remove_file(self.local)
+        PartialDownload(self.local).discard()
 
 
 class AssetCache(object):
     KeyNotFound = s3.KeyNotFound
 
     def __init__(self, config):
+        from baiji.pod.metadata import create_metadata_store
+        from baiji.pod.util.reachability import create_reachability_probe
+        from baiji.pod.util.throttle import create_bandwidth_limiter
         self.config = config
+        self.settings = config.snapshot()
+        self.metadata = create_metadata_store(self.settings)
+        self.reachability = create_reachability_probe(self.settings)
+        self.bandwidth = create_bandwidth_limiter(self.settings)
+        # In-process memo of files we've recently validated, so that a warm
+        # hit doesn't need to touch the filesystem at all. Maps the
+        # `(path, bucket)` arguments of `__call__` to a tuple of
+        # `(local_path, fresh_until, key, accessed_at)`, where `key` is the
+        # `(bucket, path)` of the cached file, and `accessed_at` is when its
+        # use was last recorded.
+        self._fresh = {}
+        self._in_flight = SingleFlight()
+        self._evicting = threading.Lock()
+        self._evicted_at = float('-inf')
+        # Outdated files waiting to be revalidated in the background, and
+        # the thread which revalidates them.
+        self._background_lock = threading.Lock()
+        self._stale_queue = collections.deque()
+        self._stale_pending = set()
+        self._stale_worker = None
+
+    def refresh_config(self):
+        '''
+        Re-read the config, and the environment variables it consults. Paths
+        remembered from before are forgotten, since their location and
+        freshness may have changed.
+        '''
+        from baiji.pod.metadata import create_metadata_store
+        from baiji.pod.util.reachability import create_reachability_probe
+        from baiji.pod.util.throttle import create_bandwidth_limiter
+        self.settings = self.config.snapshot()
+        self.metadata = create_metadata_store(self.settings)
+        self.reachability = create_reachability_probe(self.settings)
+        self.bandwidth = create_bandwidth_limiter(self.settings)
+        self._fresh.clear()
 
     @classmethod
     def create_default(cls):
@@ -149,7 +329,7 @@ class AssetCache(object):
             _ = settings.key
         except AWSCredentialsMissing:
             missing_asset_log_path = os.path.join(
-                self.config.cache_dir,
+                self.settings.cache_dir,
                 'missing_assets.yaml')
             msg += " We've written this to a list of files you're missing in {}".format(
                 missing_asset_log_path)
@@ -182,88 +362,528 @@ class AssetCache(object):
           it as checked now and return it's path. For remote paths, the etag
           contains the md5 of the contents, except for multipart uploads. In
           baiji, files over 5gb are multipart uploaded, and use an algorithm
-          shared between baiji and s3 to get an etag hash based on md5.
+          shared between baiji and s3 to get an etag hash based on md5. The
+          local etag is recorded when the file is downloaded, and reused while
+          the file's size and mtime are unchanged.
         - Otherwise it's out of date and changed on s3: download, mark it as
           checked now, and return it's path.
 
+        When `config.REVALIDATION` is `conditional`, the last two steps are
+        done with a single conditional GET.
+
         stacklevel: When `verbose` is `True`, how far up the stack to look when
             printing debug output. 1 means the immediate caller, 2 its caller,
             and so on. Useful when calls to cache() are wrapped, such as in vc().
+
+        Paths which have been validated by this object are remembered until
+        they time out, and returned without touching the filesystem. Note that
+        this means a file removed from the cache by another process will not
+        be noticed until then; use `invalidate` or `delete` to forget it. In a
+        bounded cache, where files are evicted, remembered files are checked
+        for, and their use is recorded every `ACCESS_RECORD_INTERVAL` seconds.
+
+        Concurrent calls for the same path from different threads are
+        coalesced: one of them does the work, and the rest share its result.
+
+        When `config.STALE_WHILE_REVALIDATE` is set, a file which timed out
+        recently is returned straight away, and revalidated in the background.
         '''
+        if not force_check:
+            local = self.remembered(path, bucket)
+            if local is not None:
+                return local
+
+        return self._in_flight.do(
+            (path, bucket, force_check),
+            self._get, path, bucket, force_check, verbose, stacklevel)
+
+    def _get(self, path, bucket, force_check, verbose, stacklevel, serve_stale=True):
         import socket
         from baiji.exceptions import AWSCredentialsMissing
-        from baiji.pod.util.reachability import assert_internet_reachable, InternetUnreachableError
+        from baiji.pod.util.reachability import InternetUnreachableError
 
         if verbose is None: # in most cases, we'll simply use the default for this cache object
-            verbose = self.config.verbose
+            verbose = self.settings.verbose
         def maybe_print(message):
             from harrison.util.inspectlib import stack_frame_info
             if verbose:
-                # stacklevel+2: one for `maybe_print`, one for `__call__`
-                where = stack_frame_info(stacklevel + 2).pretty
+                # stacklevel+4: one each for `maybe_print`, `_get`,
+                # `SingleFlight.do`, and `__call__`
+                where = stack_frame_info(stacklevel + 4).pretty
                 print message + ' - ' + where
 
         cache_file = CacheFile(static_cache=self, path=path, bucket=bucket)
+        downloaded = False
 
         if not cache_file.is_cached:
             try:
-                assert_internet_reachable()
-                maybe_print('Downloading missing file {}'.format(cache_file.remote))
-                cache_file.download(verbose=verbose)
-            except (socket.gaierror, InternetUnreachableError):
+                self.reachability.assert_reachable()
+                with self.download_lock(cache_file):
+                    # Another process may have downloaded it while we waited.
+                    cache_file = CacheFile(static_cache=self, path=path, bucket=bucket)
+                    if not cache_file.is_cached:
+                        maybe_print('Downloading missing file {}'.format(cache_file.remote))
+                        self._forget(cache_file.local)
+                        cache_file.download(verbose=verbose)
+                        downloaded = True
+            except socket.gaierror:
+                self.reachability.record_failure()
+                self._raise_cannot_get_needed_file(cache_file, InternetUnreachableError)
+            except InternetUnreachableError:
                 self._raise_cannot_get_needed_file(cache_file, InternetUnreachableError)
             except AWSCredentialsMissing:
                 self._raise_cannot_get_needed_file(cache_file, AWSCredentialsMissing)
+        elif not force_check and serve_stale and cache_file.can_serve_stale:
+            self._revalidate_in_background(path, bucket)
         elif force_check or cache_file.is_outdated:
+            checked_at = cache_file.timestamp
             try:
-                assert_internet_reachable()
-                if s3.etag(cache_file.remote) == s3.etag(cache_file.local):
-                    cache_file.update_timestamp()
-                else:
-                    maybe_print('Downloading outdated file {}'.format(cache_file.remote))
-                    cache_file.download(verbose=verbose)
-            except (socket.gaierror, InternetUnreachableError, AWSCredentialsMissing):
+                self.reachability.assert_reachable()
+                with self.download_lock(cache_file):
+                    # Another process may have checked it while we waited.
+                    cache_file = CacheFile(static_cache=self, path=path, bucket=bucket)
+                    if cache_file.timestamp == checked_at and \
+                            self._revalidate(cache_file, verbose=verbose):
+                        maybe_print('Downloaded outdated file {}'.format(cache_file.remote))
+                        downloaded = True
+            except (socket.gaierror, InternetUnreachableError, AWSCredentialsMissing) as e:
+                if isinstance(e, socket.gaierror):
+                    self.reachability.record_failure()
                 maybe_print(
                     ("File {} may be outdated, but we can't contact s3, " +
                      "so let's assume it's ok").format(cache_file.remote))
+        if downloaded and self.settings.is_bounded:
+            self._evict_in_background()
+        return self._served(path, bucket, cache_file)
+
+    def _served(self, path, bucket, cache_file):
+        '''
+        Record that `cache_file` has been returned for `path`, and return its
+        local path.
+        '''
+        if self.settings.is_bounded:
+            self.metadata.record_access(cache_file.bucket, cache_file.path)
+        self._remember(path, bucket, cache_file, accessed=True)
         return cache_file.local
 
+    def _revalidate(self, cache_file, verbose):
+        '''
+        Check `cache_file` against s3, and download it if it's changed.
+        Returns True if it was downloaded.
+        '''
+        self._forget(cache_file.local)
+        if self.settings.revalidation == 'conditional':
+            return cache_file.refresh(verbose=verbose)
+        remote_etag = s3.etag(cache_file.remote)
+        if remote_etag == cache_file.local_etag:
+            cache_file.update_timestamp(etag=remote_etag)
+            return False
+        cache_file.download(verbose=verbose)
+        return True
+
+    def _revalidate_in_background(self, path, bucket):
+        '''
+        Queue an outdated file to be revalidated by the background worker,
+        starting the worker if it's not running.
+        '''
+        with self._background_lock:
+            if (path, bucket) in self._stale_pending:
+                return
+            self._stale_pending.add((path, bucket))
+            self._stale_queue.append((path, bucket))
+            # After a fork, the parent's worker is not running here.
+            if self._stale_worker is None or not self._stale_worker.is_alive():
+                self._stale_worker = threading.Thread(
+                    target=self._work_through_stale, name='baiji-pod revalidation')
+                self._stale_worker.daemon = True
+                self._stale_worker.start()
+
+    def _work_through_stale(self):
+        while True:
+            with self._background_lock:
+                if not self._stale_queue:
+                    self._stale_worker = None
+                    return
+                path, bucket = self._stale_queue.popleft()
+            try:
+                self._get(
+                    path, bucket, force_check=False, verbose=False, stacklevel=1,
+                    serve_stale=False)
+            except Exception as e: # pylint: disable=broad-except
+                # The file will be revalidated in the foreground once it's
+                # too outdated to serve, and any error raised then.
+                if self.settings.verbose:
+                    print "Couldn't revalidate {} in the background: {}".format(path, e)
+            finally:
+                with self._background_lock:
+                    self._stale_pending.discard((path, bucket))
+
+    def cache_files(self, paths, bucket=None):
+        '''
+        Return a CacheFile for each of `paths`, with what's recorded about
+        them looked up in bulk, rather than one at a time.
+        '''
+        cache_files = [CacheFile(static_cache=self, path=path, bucket=bucket) for path in paths]
+        self._load_entries(cache_files)
+        return cache_files
+
+    def _load_entries(self, cache_files):
+        entries = self.metadata.get_many([(x.bucket, x.path) for x in cache_files])
+        for cache_file in cache_files:
+            cache_file.use_entry(entries.get((cache_file.bucket, cache_file.path)))
+
+    def download_lock(self, cache_file):
+        '''
+        Return a lock which serializes downloads and revalidation of
+        `cache_file` among the threads and processes sharing this cache
+        directory.
+        '''
+        from baiji.pod.util.locking import key_lock
+        return key_lock(self.settings.cache_dir, cache_file.remote)
+
+    def revalidate_many(self, paths, bucket=None, force_check=False, verbose=None):
+        '''
+        Revalidate many cached files at once.
+
+        Rather than a request for each file, the outdated files are grouped
+        by bucket and directory, and the etags in each directory are fetched
+        with paginated listings, which return up to a thousand at a time.
+        The files which match are marked as checked in one pass.
+
+        Files which aren't cached are skipped. Returns a list of the paths
+        which couldn't be confirmed, because they've changed or gone missing
+        on s3, or because we can't contact s3. Calling the cache with these
+        paths brings them up to date.
+        '''
+        import socket
+        from collections import defaultdict
+        from baiji.exceptions import AWSCredentialsMissing
+        from baiji.pod.transfer import list_etags
+        from baiji.pod.util.reachability import InternetUnreachableError
+
+        if verbose is None:
+            verbose = self.settings.verbose
+
+        groups = defaultdict(list)
+        for path, cache_file in zip(paths, self.cache_files(paths, bucket=bucket)):
+            if cache_file.is_cached and (force_check or cache_file.is_outdated):
+                directory = cache_file.path.rsplit('/', 1)[0]
+                groups[(cache_file.bucket, directory)].append((path, cache_file))
+
+        confirmed = []
+        unconfirmed = []
+        try:
+            self.reachability.assert_reachable()
+            for bucket_name, directory in sorted(groups):
+                group = groups[(bucket_name, directory)]
+                if len(group) == 1:
+                    # Listing the whole directory would be slower than asking
+                    # for the one key.
+                    _, cache_file = group[0]
+                    remote_etags = dict(list_etags(bucket_name, cache_file.path[1:]))
+                else:
+                    # Keys at the top of the bucket are listed with no prefix.
+                    prefix = directory[1:] + '/' if directory else ''
+                    remote_etags = dict(list_etags(bucket_name, prefix, delimiter='/'))
+                del groups[(bucket_name, directory)]
+                for path, cache_file in group:
+                    remote_etag = remote_etags.get(cache_file.path)
+                    if remote_etag is not None and remote_etag == cache_file.local_etag:
+                        confirmed.append((path, cache_file, remote_etag))
+                    else:
+                        unconfirmed.append(path)
+        except (socket.gaierror, InternetUnreachableError, AWSCredentialsMissing):
+            pending = [path for group in groups.values() for path, _ in group]
+            if verbose:
+                print "Can't contact s3, so {} files may be outdated".format(len(pending))
+            unconfirmed.extend(pending)
+
+        self.metadata.touch_many([
+            (cache_file.bucket, cache_file.path) + cache_file.validator(etag)
+            for _, cache_file, etag in confirmed])
+        for path, cache_file, _ in confirmed:
+            self._remember(path, bucket, CacheFile(static_cache=self, path=path, bucket=bucket))
+
+        return unconfirmed
+
+    def get_many(self, paths, bucket=None, force_check=False, verbose=None,
+                 max_workers=DEFAULT_MAX_WORKERS):
+        '''
+        Get many files at once. This does what calling the cache with each
+        path would, but rather than one at a time:
+
+        - Files which are cached and current are returned in one pass.
+        - Outdated files are revalidated in bulk, as with `revalidate_many`.
+        - Missing files, and outdated files which have changed, are
+          downloaded concurrently by up to `max_workers` threads.
+
+        Returns a tuple `(local_paths, errors)`. `local_paths` maps each path
+        which was got to its local path. `errors` maps each path which
+        couldn't be got to the exception raised, such as `KeyNotFound`, so
+        one bad path doesn't cost the rest.
+        '''
+        local_paths = {}
+        errors = {}
+        missing = []
+        outdated = []
+        to_check = []
+        for path in set(paths):
+            if not force_check:
+                local = self.remembered(path, bucket)
+                if local is not None:
+                    local_paths[path] = local
+                    continue
+            try:
+                to_check.append((path, CacheFile(static_cache=self, path=path, bucket=bucket)))
+            except ValueError as e:
+                errors[path] = e
+        self._load_entries([cache_file for _, cache_file in to_check])
+        for path, cache_file in to_check:
+            if not cache_file.is_cached:
+                missing.append(path)
+            elif force_check or (cache_file.is_outdated and not cache_file.can_serve_stale):
+                outdated.append(path)
+            else:
+                if cache_file.is_outdated:
+                    self._revalidate_in_background(path, bucket)
+                local_paths[path] = self._served(path, bucket, cache_file)
+
+        if outdated:
+            unconfirmed = self.revalidate_many(
+                outdated, bucket=bucket, force_check=force_check, verbose=verbose)
+            for path in set(outdated) - set(unconfirmed):
+                cache_file = CacheFile(static_cache=self, path=path, bucket=bucket)
+                local_paths[path] = self._served(path, bucket, cache_file)
+            missing.extend(unconfirmed)
+
+        downloaded, download_errors = self.download_many(
+            missing, bucket=bucket, force_check=force_check, verbose=verbose,
+            max_workers=max_workers)
+        local_paths.update(downloaded)
+        errors.update(download_errors)
+
+        return local_paths, errors
+
+    def download_many(self, paths, bucket=None, force_check=False, verbose=None,
+                      max_workers=DEFAULT_MAX_WORKERS, on_done=None):
+        '''
+        Call the cache with each of `paths`, using up to `max_workers`
+        threads. The paths are started in the order given, each one as soon
+        as a thread is free, so putting the largest files first keeps the
+        last ones from finishing long after the rest.
+
+        on_done: If given, it's called as each path finishes, with
+          `(path, local_path, error)`, one of which is None. It's called
+          from this thread, one path at a time.
+
+        Returns `(local_paths, errors)`, as `get_many` does.
+        '''
+        from multiprocessing.pool import ThreadPool
+
+        local_paths = {}
+        errors = {}
+        if not paths:
+            return local_paths, errors
+
+        def get(path):
+            try:
+                local = self(path, bucket=bucket, force_check=force_check, verbose=verbose)
+            except Exception as e: # pylint: disable=broad-except
+                return path, None, e
+            return path, local, None
+        pool = ThreadPool(min(max_workers, len(paths)))
+        try:
+            for path, local, error in pool.imap_unordered(get, paths):
+                if error is None:
+                    local_paths[path] = local
+                else:
+                    errors[path] = error
+                if on_done is not None:
+                    on_done(path, local, error)
+        finally:
+            pool.close()
+            pool.join()
+        return local_paths, errors
+
+    def evict(self):
+        '''
+        Evict files until the cache is within the limits set by
+        `config.MAX_SIZE`, `config.MAX_ENTRIES`, and
+        `config.IMMUTABLE_MAX_SIZE`. Returns the remote paths of the evicted
+        files. See `baiji.pod.eviction`.
+        '''
+        from baiji.pod.eviction import Evictor
+        return Evictor(self).run()
+
+    def _evict_in_background(self):
+        '''
+        Start evicting in a background thread, unless it's already running,
+        or the last pass started less than `EVICTION_INTERVAL` seconds ago.
+        '''
+        if time.time() - self._evicted_at < EVICTION_INTERVAL:
+            return
+        if not self._evicting.acquire(False):
+            return
+        self._evicted_at = time.time()
+        def evict():
+            try:
+                self.evict()
+            finally:
+                self._evicting.release()
+        thread = threading.Thread(target=evict, name='baiji-pod eviction')
+        thread.daemon = True
+        thread.start()
+
+    def remembered(self, path, bucket=None):
+        '''
+        If `path` has been validated by this object, and hasn't timed out,
+        return its local path, without touching the filesystem. Otherwise
+        return None.
+
+        In a bounded cache, the file may have been evicted by another
+        process, so we check it's still there, and every
+        `ACCESS_RECORD_INTERVAL` seconds, record its use, so it isn't evicted
+        as though it's gone cold.
+        '''
+        try:
+            local, fresh_until, key, accessed_at = self._fresh[(path, bucket)]
+        except KeyError:
+            return None
+        now = time.time()
+        if now >= fresh_until:
+            return None
+        if self.settings.is_bounded:
+            if not os.path.exists(local):
+                self._fresh.pop((path, bucket), None)
+                return None
+            if now - accessed_at >= ACCESS_RECORD_INTERVAL:
+                self.metadata.record_access(*key)
+                self._fresh[(path, bucket)] = (local, fresh_until, key, now)
+        return local
+
+    def _remember(self, path, bucket, cache_file, accessed=False):
+        '''
+        accessed: Whether the use of the file has just been recorded.
+        '''
+        now = time.time()
+        fresh_until = cache_file.fresh_until
+        if now < fresh_until:
+            self._fresh[(path, bucket)] = (
+                cache_file.local, fresh_until, (cache_file.bucket, cache_file.path),
+                now if accessed else float('-inf'))
+
+    def _forget(self, local_path):
+        '''
+        Drop any remembered paths which resolve to `local_path`, or to a file
+        beneath it when `local_path` is a directory.
+        '''
+        tree_prefix = local_path.rstrip(os.sep) + os.sep
+        for key, remembered in self._fresh.items():
+            local = remembered[0]
+            if local == local_path or local.startswith(tree_prefix):
+                self._fresh.pop(key, None)
+
     def invalidate(self, path, bucket=None):
         cf = CacheFile(static_cache=self, path=path, bucket=bucket)
+        self._forget(cf.local)
         if os.path.isdir(cf.local): # we're dealing with a tree, not an actual CacheFile
-            from baiji.pod.util.shutillib import remove_tree
-            remove_tree(cf.timestamp_file)
+            self.metadata.invalidate_tree(cf.bucket, cf.path)
         else:
             cf.invalidate()
 
     def invalidate_all(self):
-        from baiji.pod.util.shutillib import remove_tree
-        remove_tree(os.path.join(self.config.cache_dir, '.timestamps'))
+        self._fresh.clear()
+        self.metadata.invalidate_all()
 
     def delete(self, path, bucket=None):
-        CacheFile(static_cache=self, path=path, bucket=bucket).remove_cached()
+        cf = CacheFile(static_cache=self, path=path, bucket=bucket)
+        self._forget(cf.local)
+        cf.remove_cached()
 
     def is_cachefile(self, path):
         return isinstance(path, CachedPath) or \
-            os.path.expanduser(path).startswith(self.config.cache_dir)
+            os.path.expanduser(path).startswith(self.settings.cache_dir)
 
     def un_sc(self, path):
         '''un_sc(sc(foo)) == foo'''
         if self.is_cachefile(path):
             # Nested calls to sc
-            path = path.replace(self.config.cache_dir, '')
+            path = path.replace(self.settings.cache_dir, '')
             # Remove leading bucket
             path = path.split(os.sep, 1)[1]
         return path
 
     def ls(self):
-        for bucket in os.listdir(self.config.cache_dir):
-            bucket_path = os.path.join(self.config.cache_dir, bucket)
-            if os.path.isdir(bucket_path) and bucket != '.timestamps':
+        '''
+        Return an iterable of CacheFile for everything in the cache.
+
+        With the index metadata store, this reads the index; otherwise it walks
+        the cache directory. Use `rebuild_index` to bring the index up to date
+        with files added or removed by other means.
+        '''
+        if self.metadata.records_presence:
+            return (
+                CacheFile(static_cache=self, path=entry.path, bucket=entry.bucket, entry=entry)
+                for entry in self.metadata.entries())
+        return self._walk()
+
+    def rebuild_index(self):
+        '''
+        Reconcile the index metadata store with the files in the cache
+        directory. Returns a tuple `(added, removed, updated)` with the number
+        of entries in each case.
+        '''
+        if not self.metadata.records_presence:
+            raise ValueError('The cache index is only kept with METADATA_STORE=index')
+        found = []
+        for cache_file in self._walk():
+            try:
+                stat = os.stat(cache_file.local)
+            except OSError: # Removed since we listed it
+                continue
+            found.append((cache_file.bucket, cache_file.path, stat.st_size, stat.st_mtime))
+        return self.metadata.reconcile(found)
+
+    def _walk(self):
+        for bucket, local in self._walk_files():
+            yield CacheFile(static_cache=self, path=local, bucket=bucket)
+
+    def partial_downloads(self):
+        '''
+        Yield a CacheFile for each file in the cache directory with an
+        interrupted download, which can be picked up with
+        `baiji.pod.transfer.PartialDownload`.
+        '''
+        from baiji.pod.transfer import PartialDownload
+        seen = set()
+        for bucket, local in self._walk_files(partial=True):
+            directory, name = os.path.split(local)
+            for suffix in PartialDownload.SUFFIXES[::-1]:
+                if name.endswith(suffix):
+                    local = os.path.join(directory, name[1:-len(suffix)])
+                    break
+            if local not in seen:
+                seen.add(local)
+                yield CacheFile(static_cache=self, path=local, bucket=bucket)
+
+    def _walk_files(self, partial=False):
+        '''
+        Yield `(bucket, local_path)` for each cached file, or with `partial`,
+        for each file belonging to a download in progress.
+        '''
+        from baiji.pod.transfer import PartialDownload
+        if not os.path.isdir(self.settings.cache_dir):
+            return
+        for bucket in os.listdir(self.settings.cache_dir):
+            bucket_path = os.path.join(self.settings.cache_dir, bucket)
+            # Skip `.timestamps`, `.locks`, and the like.
+            if os.path.isdir(bucket_path) and not bucket.startswith('.'):
                 for root, _, files in os.walk(bucket_path):
                     for name in files:
-                        if name not in ['.DS_Store']:
-                            yield CacheFile(
-                                static_cache=self,
-                                path=os.path.join(root, name),
-                                bucket=bucket)
+                        # Skip `.DS_Store`, and files being atomically replaced.
+                        if name == '.DS_Store' or name.startswith('.') and name.endswith('.tmp'):
+                            continue
+                        is_partial = name.startswith('.') and \
+                            name.endswith(PartialDownload.SUFFIXES)
+                        if is_partial == partial:
+                            yield bucket, os.path.join(root, name)
@@ -23,13 +23,13 @@ def dump(cache, versioned_cache, paths, save_to, max_size=None):
             self.uri = src
 
             parsed_src = s3.path.parse(src)
-            if parsed_src[1] in cache.config.immutable_buckets and \
+            if parsed_src[1] in cache.settings.immutable_buckets and \
                 vc.is_versioned(parsed_src[2]):
                 self.src = vc(parsed_src[2])
             else:
                 self.src = cache(src)
 
-            self.dst = self.src.replace(cache.config.cache_dir, '')
+            self.dst = self.src.replace(cache.settings.cache_dir, '')
             if self.dst.startswith('/'):
                 self.dst = self.dst[1:]
 
@@ -89,4 +89,4 @@ def load(static_cache, asset_pack_paths):
     import zipfile
     for asset_path_pack in asset_pack_paths:
         with zipfile.ZipFile(asset_path_pack, 'r') as zf:
-            zf.extractall(static_cache.config.cache_dir)
+            zf.extractall(static_cache.settings.cache_dir)
@@ -0,0 +1,100 @@
+'''
+Non-blocking counterparts of AssetCache and VersionedCache, for services
+which can't afford to wait on s3.
+
+`get` returns a `concurrent.futures.Future`. Files which have been validated
+recently are returned in a future which is already done, without leaving
+the calling thread. Everything else, including stats, etag hashing, and
+downloads, runs on a pool with a bounded number of threads.
+
+Python 2.7 has no asyncio, so these can't be awaited directly. Under an
+event loop which can wrap a `concurrent.futures.Future`, such as asyncio's
+`wrap_future`, they can.
+
+The async classes wrap the sync ones, so they use the same cache directory,
+metadata, and locks, and can be used alongside them.
+'''
+from baiji import s3
+from baiji.pod.asset_cache import DEFAULT_MAX_WORKERS
+
+
+def _done(result):
+    from concurrent.futures import Future
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+class AsyncAssetCache(object):
+    KeyNotFound = s3.KeyNotFound
+
+    def __init__(self, cache, max_workers=DEFAULT_MAX_WORKERS):
+        '''
+        cache: An instance of AssetCache.
+        max_workers: The most requests to work on at once. The rest wait
+          their turn.
+        '''
+        from concurrent.futures import ThreadPoolExecutor
+        self.cache = cache
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def get(self, path, bucket=None, force_check=False, verbose=None):
+        '''
+        Return a Future for the local path of `path`, which takes the same
+        arguments as `AssetCache.__call__`.
+        '''
+        if not force_check:
+            local = self.cache.remembered(path, bucket)
+            if local is not None:
+                return _done(local)
+        return self.executor.submit(
+            self.cache, path, bucket=bucket, force_check=force_check, verbose=verbose)
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.shutdown()
+
+
+class AsyncVersionedCache(object):
+    KeyNotFound = s3.KeyNotFound
+
+    def __init__(self, versioned_cache, max_workers=DEFAULT_MAX_WORKERS):
+        '''
+        versioned_cache: An instance of VersionedCache, whose asset cache is
+          an AssetCache.
+        max_workers: The most requests to work on at once.
+        '''
+        from concurrent.futures import ThreadPoolExecutor
+        self.versioned_cache = versioned_cache
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def get(self, path, version=None, verbose=None):
+        '''
+        Return a Future for the local path of `path`, which takes the same
+        arguments as `VersionedCache.cached_file`.
+        '''
+        vc = self.versioned_cache
+        # Paths pinned to a version number resolve to an s3 uri without any
+        # I/O, so a recently validated one can be returned straight away.
+        if vc.is_versioned(path):
+            if version is None:
+                version = vc.manifest_version(path)
+            if vc.version_number_is_valid(version):
+                local = vc.cache.remembered(vc.uri(path, version))
+                if local is not None:
+                    return _done(local)
+        return self.executor.submit(vc.cached_file, path, version=version, verbose=verbose)
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.shutdown()
@@ -1,4 +1,65 @@
 import os
+from collections import namedtuple
+
+
+class ConfigSnapshot(namedtuple('ConfigSnapshot', [
+        'cache_dir',
+        'timeout',
+        'immutable_buckets',
+        'default_bucket',
+        'verbose',
+        'prefill_concurrency',
+        'metadata_store',
+        'revalidation',
+        'max_size',
+        'max_entries',
+        'immutable_max_size',
+        'eviction_policy',
+        'pinned',
+        'check_reachability',
+        'reachability_ttl',
+        'reachability_backoff',
+        'reachability_max_backoff',
+        'stale_while_revalidate',
+        'download_concurrency',
+        'download_chunk_size',
+        'max_bandwidth',
+        'version_index_ttl',
+])):
+    '''
+    An immutable copy of the settings from a `Config`, resolved once so that
+    the asset cache doesn't need to consult the environment on every call.
+    Fields have the same names and meanings as the properties on `Config`,
+    except that `immutable_buckets` is a frozenset.
+
+    Create one using `Config.snapshot()`.
+    '''
+    __slots__ = ()
+
+    @property
+    def is_bounded(self):
+        '''
+        Whether any limit is set on the size of the cache.
+        '''
+        return any(limit is not None for limit in [
+            self.max_size, self.max_entries, self.immutable_max_size])
+
+
+def parse_size(size):
+    '''
+    Parse a size in bytes, such as `1073741824`, `'1073741824'`, or `'1G'`.
+    The suffixes `K`, `M`, `G`, and `T` are powers of 1024. Returns None for
+    None or an empty string.
+    '''
+    if size is None or size == '':
+        return None
+    if isinstance(size, basestring):
+        units = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+        size = size.strip().upper().rstrip('B')
+        if size and size[-1] in units:
+            return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
 
 class Config(object):
     '''
@@ -10,13 +71,34 @@ class Config(object):
     which use your configuration.
 
     Alternatively, you can configure baiji-pod using environment variables.
+
+    The asset cache reads its configuration once, when it's created. If you
+    change the config or the environment afterward, call
+    `AssetCache.refresh_config()` to pick up the changes.
     '''
     CACHE_DIR = os.path.expanduser('~/.baiji_cache')
     TIMEOUT = 86400  # == one day.
     IMMUTABLE_BUCKETS = []
     DEFAULT_BUCKET = None
     VERBOSE = True
-    NUM_PREFILL_PROCESSES = 12
+    PREFILL_CONCURRENCY = 32
+    NUM_PREFILL_PROCESSES = None  # Deprecated; use PREFILL_CONCURRENCY.
+    METADATA_STORE = 'timestamps'
+    REVALIDATION = 'head'
+    MAX_SIZE = None
+    MAX_ENTRIES = None
+    IMMUTABLE_MAX_SIZE = None
+    EVICTION_POLICY = 'lru'
+    PINNED = []
+    CHECK_REACHABILITY = True
+    REACHABILITY_TTL = 60
+    REACHABILITY_BACKOFF = 5
+    REACHABILITY_MAX_BACKOFF = 300
+    STALE_WHILE_REVALIDATE = None
+    DOWNLOAD_CONCURRENCY = 1
+    DOWNLOAD_CHUNK_SIZE = 16 * 1024 * 1024
+    MAX_BANDWIDTH = None
+    VERSION_INDEX_TTL = 300
 
     @property
     def cache_dir(self):
@@ -68,9 +150,208 @@ class Config(object):
         '''
         return self.VERBOSE
 
+    @property
+    def prefill_concurrency(self):
+        '''
+        How many files to download at once during prefill. They're
+        downloaded by threads in a single process.
+
+        The deprecated `NUM_PREFILL_PROCESSES`, `num_prefill_processes`, and
+        `STATIC_CACHE_NUM_PREFILL_PROCESSES` are honored when they're set and
+        the new ones aren't.
+        '''
+        if type(self).num_prefill_processes is not Config.num_prefill_processes:
+            # A subclass overrides the deprecated property.
+            return int(self.num_prefill_processes)
+        for name in ['STATIC_CACHE_PREFILL_CONCURRENCY', 'STATIC_CACHE_NUM_PREFILL_PROCESSES']:
+            value = os.getenv(name)
+            if value not in [None, '']:
+                return int(value)
+        if self.NUM_PREFILL_PROCESSES is not None and \
+                self.PREFILL_CONCURRENCY == Config.PREFILL_CONCURRENCY:
+            return int(self.NUM_PREFILL_PROCESSES)
+        return int(self.PREFILL_CONCURRENCY)
+
     @property
     def num_prefill_processes(self):
         '''
-        The number of parallel processes to use during prefill.
+        Deprecated; use `prefill_concurrency`.
+        '''
+        return self.prefill_concurrency
+
+    @property
+    def metadata_store(self):
+        '''
+        How we keep track of when cached files were last checked: either
+        `timestamps`, a parallel tree of timestamp files, or `index`, a single
+        sqlite index. See `baiji.pod.metadata`.
+        '''
+        return os.getenv('STATIC_CACHE_METADATA_STORE', self.METADATA_STORE)
+
+    @property
+    def revalidation(self):
+        '''
+        How outdated files are checked. With `head`, we fetch the remote etag,
+        and download the file if it's changed. With `conditional`, we make a
+        single GET with `If-None-Match`, which only returns the file if it's
+        changed. Either way, downloads go through `baiji.pod.transfer.fetch`.
+        '''
+        return os.getenv('STATIC_CACHE_REVALIDATION', self.REVALIDATION)
+
+    @property
+    def max_size(self):
+        '''
+        The most space, in bytes, that cached files should take up, or None
+        for no limit. Strings like `20G` are accepted too. When the cache
+        outgrows it, files are evicted according to `eviction_policy`.
+        '''
+        return parse_size(os.getenv('STATIC_CACHE_MAX_SIZE', self.MAX_SIZE))
+
+    @property
+    def max_entries(self):
+        '''
+        The most files the cache should hold, or None for no limit.
+        '''
+        max_entries = os.getenv('STATIC_CACHE_MAX_ENTRIES', self.MAX_ENTRIES)
+        return int(max_entries) if max_entries not in [None, ''] else None
+
+    @property
+    def immutable_max_size(self):
+        '''
+        When set, files from immutable buckets get a budget of their own, of
+        this many bytes, and don't count toward `max_size` or `max_entries`.
+        Otherwise they share the same budget as everything else.
+        '''
+        return parse_size(os.getenv(
+            'STATIC_CACHE_IMMUTABLE_MAX_SIZE', self.IMMUTABLE_MAX_SIZE))
+
+    @property
+    def eviction_policy(self):
+        '''
+        Which files to evict first: `lru`, the least recently used, or `lfu`,
+        the least frequently used. Use counts are only kept by the `index`
+        metadata store; with `timestamps`, `lfu` behaves like `lru`.
+        '''
+        return os.getenv('STATIC_CACHE_EVICTION_POLICY', self.EVICTION_POLICY)
+
+    @property
+    def pinned(self):
+        '''
+        Patterns, like `s3://my-bucket/models/*`, for files which are never
+        evicted. In the environment, separate them with commas.
+        '''
+        try:
+            return [x for x in os.environ['STATIC_CACHE_PINNED'].split(',') if x]
+        except KeyError:
+            return self.PINNED
+
+    @property
+    def check_reachability(self):
+        '''
+        Whether to check that s3 is reachable before a download or
+        revalidation, so that we can fail fast, or skip the revalidation,
+        when we're offline. You may want to turn this off in production.
+        '''
+        from env_flag import env_flag
+        return env_flag('STATIC_CACHE_CHECK_REACHABILITY', self.CHECK_REACHABILITY)
+
+    @property
+    def reachability_ttl(self):
+        '''
+        How long, in seconds, to trust a successful reachability check.
+        '''
+        return float(os.getenv('STATIC_CACHE_REACHABILITY_TTL', self.REACHABILITY_TTL))
+
+    @property
+    def reachability_backoff(self):
+        '''
+        After a failed reachability check, how long, in seconds, to assume
+        we're offline before checking again. This doubles with each
+        consecutive failure, up to `reachability_max_backoff`.
+        '''
+        return float(os.getenv('STATIC_CACHE_REACHABILITY_BACKOFF', self.REACHABILITY_BACKOFF))
+
+    @property
+    def reachability_max_backoff(self):
+        '''
+        The longest we'll assume we're offline before checking again.
+        '''
+        return float(os.getenv(
+            'STATIC_CACHE_REACHABILITY_MAX_BACKOFF', self.REACHABILITY_MAX_BACKOFF))
+
+    @property
+    def stale_while_revalidate(self):
+        '''
+        When set, an outdated file is returned straight away, and revalidated
+        in the background, as long as it timed out no more than this many
+        seconds ago. Files which are more outdated than that are revalidated
+        before they're returned, as usual. Defaults to None, which turns this
+        off.
+        '''
+        value = os.getenv('STATIC_CACHE_STALE_WHILE_REVALIDATE', self.STALE_WHILE_REVALIDATE)
+        return int(value) if value not in [None, ''] else None
+
+    @property
+    def download_concurrency(self):
+        '''
+        How many ranges of a large file to download at once. Defaults to 1,
+        which downloads every file in a single stream. When it's more than
+        1, files larger than `download_chunk_size` are downloaded in ranges,
+        this many at a time.
+        '''
+        return int(os.getenv('STATIC_CACHE_DOWNLOAD_CONCURRENCY', self.DOWNLOAD_CONCURRENCY))
+
+    @property
+    def download_chunk_size(self):
+        '''
+        The size of the ranges, in bytes, in which large files are
+        downloaded. Strings like `16M` are accepted too.
+        '''
+        return parse_size(os.getenv('STATIC_CACHE_DOWNLOAD_CHUNK_SIZE', self.DOWNLOAD_CHUNK_SIZE))
+
+    @property
+    def max_bandwidth(self):
+        '''
+        The most bytes per second that downloads made by one asset cache
+        should take between them, or None for no limit. Strings like `10M`
+        are accepted too. It applies to every download, whether in a single
+        stream or in ranges.
+        '''
+        return parse_size(os.getenv('STATIC_CACHE_MAX_BANDWIDTH', self.MAX_BANDWIDTH))
+
+    @property
+    def version_index_ttl(self):
+        '''
+        How long, in seconds, the versioned cache trusts its index of the
+        versions in a bucket before listing the bucket again. Set it to 0 to
+        list the versions of a file each time they're needed.
+        '''
+        return int(os.getenv('STATIC_CACHE_VERSION_INDEX_TTL', self.VERSION_INDEX_TTL))
+
+    def snapshot(self):
+        '''
+        Resolve all the settings and return them as a `ConfigSnapshot`.
         '''
-        return self.NUM_PREFILL_PROCESSES
+        return ConfigSnapshot(
+            cache_dir=self.cache_dir,
+            timeout=self.timeout,
+            immutable_buckets=frozenset(self.immutable_buckets),
+            default_bucket=self.default_bucket,
+            verbose=self.verbose,
+            prefill_concurrency=self.prefill_concurrency,
+            metadata_store=self.metadata_store,
+            revalidation=self.revalidation,
+            max_size=self.max_size,
+            max_entries=self.max_entries,
+            immutable_max_size=self.immutable_max_size,
+            eviction_policy=self.eviction_policy,
+            pinned=tuple(self.pinned),
+            check_reachability=self.check_reachability,
+            reachability_ttl=self.reachability_ttl,
+            reachability_backoff=self.reachability_backoff,
+            reachability_max_backoff=self.reachability_max_backoff,
+            stale_while_revalidate=self.stale_while_revalidate,
+            download_concurrency=self.download_concurrency,
+            download_chunk_size=self.download_chunk_size,
+            max_bandwidth=self.max_bandwidth,
+            version_index_ttl=self.version_index_ttl)
@@ -0,0 +1,229 @@
+'''
+Eviction keeps the asset cache within the limits set by `Config.MAX_SIZE`,
+`Config.MAX_ENTRIES`, and `Config.IMMUTABLE_MAX_SIZE`. It runs in the
+background after a download, and on demand with `baiji-cache evict`.
+
+Files are evicted least recently used first, or with
+`Config.EVICTION_POLICY = 'lfu'`, least frequently used first. These files
+are never evicted:
+
+- Files matching one of the `Config.PINNED` patterns.
+- Files which are open in any process. This is only detected on platforms
+  with `/proc`, such as Linux.
+- Files used in the last `GRACE_PERIOD` seconds. Callers get a path from
+  the cache and open it afterward, and we can't see that coming.
+
+When the files which can't be evicted are over the limit by themselves, the
+cache is left over the limit.
+
+Interrupted downloads are kept so they can be resumed, but aren't counted
+against the limits. Those which haven't been added to in
+`ABANDONED_PERIOD` seconds are discarded.
+'''
+import os
+import time
+from collections import namedtuple
+
+GRACE_PERIOD = 60
+ABANDONED_PERIOD = 24 * 60 * 60
+
+
+class Candidate(namedtuple('Candidate', [
+        'cache_file',
+        'size',
+        'accessed_at',
+        'hits',
+])):
+    '''
+    A cached file which could be evicted.
+
+    accessed_at: When the file was last used, in seconds since the epoch.
+    hits: How many times its use has been recorded. This is 0 when the
+      metadata store doesn't count uses.
+    '''
+    __slots__ = ()
+
+
+def open_paths(directory):
+    '''
+    Return the set of files under `directory` which are open in any process
+    we're allowed to inspect, as real paths. This reads `/proc`, so on
+    platforms without it, the set is empty.
+    '''
+    result = set()
+    if not os.path.isdir('/proc'):
+        return result
+    prefix = os.path.realpath(directory).rstrip(os.sep) + os.sep
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        fd_dir = os.path.join('/proc', pid, 'fd')
+        try:
+            fds = os.listdir(fd_dir)
+        except OSError: # The process exited, or isn't ours.
+            continue
+        for fd in fds:
+            try:
+                target = os.readlink(os.path.join(fd_dir, fd))
+            except OSError:
+                continue
+            if target.startswith(prefix):
+                result.add(target)
+    return result
+
+
+class Evictor(object):
+    def __init__(self, asset_cache):
+        self.cache = asset_cache
+        self.settings = asset_cache.settings
+
+    def candidates(self):
+        '''
+        Yield a Candidate for each cached file. With the index metadata
+        store, the size and use recorded in the index are used, and only the
+        files it has no size or use for are stat'ed; otherwise every file is.
+        When a file's use hasn't been recorded, its access time is used
+        instead.
+        '''
+        stats = self.cache.metadata.access_stats()
+        for cache_file in self.cache.ls():
+            accessed_at, hits = stats.get((cache_file.bucket, cache_file.path), (None, 0))
+            size = cache_file.entry.size if self.cache.metadata.records_presence else None
+            if size is None or accessed_at is None:
+                try:
+                    stat = os.stat(cache_file.local)
+                except OSError: # Removed since we listed it.
+                    continue
+                if size is None:
+                    size = stat.st_size
+                if accessed_at is None:
+                    accessed_at = stat.st_atime
+            yield Candidate(
+                cache_file=cache_file, size=size, accessed_at=accessed_at, hits=hits)
+
+    def budgets(self, candidates):
+        '''
+        Split `candidates` into groups which share a budget. Returns a list
+        of `(candidates, max_size, max_entries)`.
+        '''
+        if self.settings.immutable_max_size is None:
+            return [(candidates, self.settings.max_size, self.settings.max_entries)]
+        immutable_buckets = self.settings.immutable_buckets
+        return [
+            ([x for x in candidates if x.cache_file.bucket not in immutable_buckets],
+             self.settings.max_size, self.settings.max_entries),
+            ([x for x in candidates if x.cache_file.bucket in immutable_buckets],
+             self.settings.immutable_max_size, None),
+        ]
+
+    def eviction_order(self):
+        '''
+        Return a sort key which puts the candidates to evict first, first.
+        '''
+        if self.settings.eviction_policy == 'lru':
+            return lambda candidate: candidate.accessed_at
+        elif self.settings.eviction_policy == 'lfu':
+            return lambda candidate: (candidate.hits, candidate.accessed_at)
+        else:
+            raise ValueError('Unknown eviction policy {}; use lru or lfu'.format(
+                self.settings.eviction_policy))
+
+    def is_protected(self, candidate, in_use, now):
+        from fnmatch import fnmatch
+        if now - candidate.accessed_at < GRACE_PERIOD:
+            return True
+        if any(fnmatch(candidate.cache_file.remote, x) for x in self.settings.pinned):
+            return True
+        return os.path.realpath(candidate.cache_file.local) in in_use
+
+    @staticmethod
+    def is_within(candidates, max_size, max_entries):
+        '''
+        Whether `candidates` fit in a budget of `max_size` bytes and
+        `max_entries` files.
+        '''
+        return (max_size is None or sum(x.size for x in candidates) <= max_size) and \
+            (max_entries is None or len(candidates) <= max_entries)
+
+    def plan(self):
+        '''
+        Return a list of the Candidates to evict to bring the cache within
+        its limits, in the order they should be evicted.
+        '''
+        if not self.settings.is_bounded:
+            return []
+        budgets = self.budgets(list(self.candidates()))
+        # Finding the open files means reading all of /proc, so skip it when
+        # there's nothing to evict, which is most of the time.
+        if all(self.is_within(*budget) for budget in budgets):
+            return []
+        order = self.eviction_order()
+        now = time.time()
+        in_use = open_paths(self.settings.cache_dir)
+
+        result = []
+        for candidates, max_size, max_entries in budgets:
+            total_size = sum(x.size for x in candidates)
+            num_entries = len(candidates)
+            for candidate in sorted(candidates, key=order):
+                if (max_size is None or total_size <= max_size) and \
+                        (max_entries is None or num_entries <= max_entries):
+                    break
+                if self.is_protected(candidate, in_use, now):
+                    continue
+                result.append(candidate)
+                total_size -= candidate.size
+                num_entries -= 1
+        return result
+
+    @staticmethod
+    def is_abandoned(partial, now):
+        '''
+        Whether the PartialDownload `partial` hasn't been added to in
+        `ABANDONED_PERIOD` seconds.
+        '''
+        modified_at = None
+        for path in [partial.path, partial.info_path]:
+            try:
+                modified_at = max(modified_at, os.path.getmtime(path))
+            except OSError: # Missing, or removed since we listed it.
+                pass
+        return modified_at is not None and now - modified_at >= ABANDONED_PERIOD
+
+    def discard_abandoned_downloads(self):
+        '''
+        Discard the interrupted downloads which haven't been resumed in
+        `ABANDONED_PERIOD` seconds.
+        '''
+        from baiji.pod.transfer import PartialDownload
+        now = time.time()
+        for cache_file in self.cache.partial_downloads():
+            # Downloads in progress are recent, so this doesn't wait for them.
+            if not self.is_abandoned(PartialDownload(cache_file.local), now):
+                continue
+            with self.cache.download_lock(cache_file):
+                # Check again, in case it was resumed before we got the lock.
+                partial = PartialDownload(cache_file.local)
+                if self.is_abandoned(partial, now):
+                    partial.discard()
+
+    def run(self):
+        '''
+        Evict files until the cache is within its limits, and return the
+        remote paths of the files which were evicted. If another process is
+        already evicting from this cache, do nothing.
+        '''
+        from baiji.pod.util.locking import FileLock
+        lock_path = os.path.join(self.settings.cache_dir, '.locks', 'evict')
+        with FileLock(lock_path, blocking=False) as lock:
+            if not lock.acquired:
+                return []
+            evicted = []
+            for candidate in self.plan():
+                cache_file = candidate.cache_file
+                # Don't pull the file out from under a download or revalidation.
+                with self.cache.download_lock(cache_file):
+                    self.cache.delete(cache_file.remote)
+                evicted.append(cache_file.remote)
+            self.discard_abandoned_downloads()
+            return evicted
@@ -0,0 +1,452 @@
+'''
+Stores for the metadata the asset cache keeps about each cached file: when
+it was last checked against s3, and what we learned when we checked.
+
+Two stores are available, selected with `Config.METADATA_STORE`:
+
+- `timestamps`: The original layout. An empty file is kept at
+  `.timestamps/<bucket>/<path>` for each cached file, and its mtime is the
+  time the cached file was last checked.
+- `index`: A single sqlite index in the cache directory. One lookup tells us
+  whether a file is cached, and whether it's fresh, without any stat calls or
+  a parallel directory tree.
+
+To switch an existing cache to the index, run `baiji-cache migrate`, which
+imports the `.timestamps` tree and then removes it. Files which aren't
+imported are still found on disk, but are revalidated the first time
+they're used.
+'''
+import os
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+
+class CacheEntry(namedtuple('CacheEntry', [
+        'bucket',
+        'path',
+        'checked_at',
+        'etag',
+        'size',
+        'mtime',
+])):
+    '''
+    What we know about one cached file.
+
+    path: The path within the bucket, starting with `/`, as in CacheFile.
+    checked_at: When the file was last checked, in seconds since the epoch,
+      or None if it's been invalidated.
+    etag: The remote etag, when it's known.
+    size, mtime: The size and mtime of the cached file when `etag` was
+      recorded. If the file still has this size and mtime, we assume its
+      contents still match `etag`.
+    '''
+    __slots__ = ()
+
+
+def timestamp_file(cache_dir, bucket, path):
+    return os.path.join(cache_dir, '.timestamps', bucket, path[1:])
+
+
+def create_metadata_store(settings):
+    if settings.metadata_store == 'timestamps':
+        return TimestampMetadataStore(settings.cache_dir)
+    elif settings.metadata_store == 'index':
+        return IndexMetadataStore(settings.cache_dir)
+    else:
+        raise ValueError('Unknown metadata store {}; use timestamps or index'.format(
+            settings.metadata_store))
+
+
+class TimestampMetadataStore(object):
+    '''
+    Keeps a file for each cached file under `.timestamps`, whose mtime is the
+    time it was last checked. When the etag is known, it's written into the
+    timestamp file along with the size and mtime of the cached file.
+    '''
+    # Having a timestamp doesn't mean the cached file exists.
+    records_presence = False
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def get(self, bucket, path):
+        try:
+            checked_at = os.path.getmtime(timestamp_file(self.cache_dir, bucket, path))
+        except OSError as e:
+            import errno
+            if e.errno == errno.ENOENT:
+                return None
+            else:
+                raise
+        # The etag is only read when it's needed, by `recorded_etag`.
+        return CacheEntry(
+            bucket=bucket, path=path, checked_at=checked_at, etag=None, size=None, mtime=None)
+
+    def get_many(self, keys):
+        '''
+        Return a dict mapping each `(bucket, path)` in `keys` which has an
+        entry to its CacheEntry. There's a timestamp file for each entry, so
+        this is no faster than getting them one at a time.
+        '''
+        result = {}
+        for bucket, path in keys:
+            entry = self.get(bucket, path)
+            if entry is not None:
+                result[(bucket, path)] = entry
+        return result
+
+    def recorded_etag(self, bucket, path):
+        '''
+        Return a tuple `(etag, size, mtime)`, or None if no etag is recorded.
+        '''
+        from baiji.pod.util import json
+        try:
+            recorded = json.load(timestamp_file(self.cache_dir, bucket, path))
+        except IOError as e:
+            import errno
+            if e.errno == errno.ENOENT:
+                return None
+            else:
+                raise
+        except ValueError: # Empty, as written by older versions.
+            return None
+        return recorded['etag'], recorded['size'], recorded['mtime']
+
+    def touch(self, bucket, path, etag=None, size=None, mtime=None):
+        '''
+        Mark a file as checked now. When `etag` is None, the etag recorded
+        before, if any, is kept.
+        '''
+        from baiji.util.shutillib import mkdir_p
+        from baiji.pod.util import json
+        ts_file = timestamp_file(self.cache_dir, bucket, path)
+        if etag is None and os.path.exists(ts_file):
+            os.utime(ts_file, None)
+            return
+        if not os.path.exists(ts_file):
+            mkdir_p(os.path.dirname(ts_file))
+        if etag is None:
+            open(ts_file, 'w').close()
+        else:
+            json.dump({'etag': etag, 'size': size, 'mtime': mtime}, ts_file)
+
+    def touch_many(self, entries):
+        '''
+        Mark several files as checked now. `entries` is a list of
+        `(bucket, path, etag, size, mtime)`.
+        '''
+        for bucket, path, etag, size, mtime in entries:
+            self.touch(bucket, path, etag=etag, size=size, mtime=mtime)
+
+    def invalidate(self, bucket, path):
+        from baiji.pod.util.shutillib import remove_file
+        remove_file(timestamp_file(self.cache_dir, bucket, path))
+
+    def invalidate_tree(self, bucket, path):
+        from baiji.pod.util.shutillib import remove_tree
+        remove_tree(timestamp_file(self.cache_dir, bucket, path))
+
+    def invalidate_all(self):
+        from baiji.pod.util.shutillib import remove_tree
+        remove_tree(os.path.join(self.cache_dir, '.timestamps'))
+
+    def remove(self, bucket, path):
+        self.invalidate(bucket, path)
+
+    def record_access(self, bucket, path):
+        '''
+        Note that a cached file was used. Many filesystems don't update the
+        access time on every read, so we set it on the cached file ourselves.
+        Its mtime is left alone.
+        '''
+        local = os.path.join(self.cache_dir, bucket, path[1:])
+        try:
+            os.utime(local, (time.time(), os.stat(local).st_mtime))
+        except OSError as e:
+            import errno
+            if e.errno != errno.ENOENT:
+                raise
+
+    def access_stats(self):
+        '''
+        Return a dict mapping `(bucket, path)` to `(accessed_at, hits)`. We
+        don't count uses, and the access time is on the cached file, so this
+        is empty.
+        '''
+        return {}
+
+
+class IndexMetadataStore(object):
+    '''
+    Keeps a row for each cached file in a sqlite database at
+    `<cache_dir>/.index.sqlite`. A row is only present while the file is
+    cached, so the index also lists what's in the cache.
+
+    sqlite handles locking between processes sharing the cache. Connections
+    aren't shared between threads or across a fork, so we keep one per
+    thread and process.
+    '''
+    records_presence = True
+    FILENAME = '.index.sqlite'
+
+    # Replacing the row keeps its access time and use count.
+    _TOUCH_WITH_ETAG = '''
+        INSERT OR REPLACE INTO entries
+            (bucket, path, checked_at, etag, size, mtime, accessed_at, hits)
+        SELECT ?, ?, ?, ?, ?, ?, old.accessed_at, COALESCE(old.hits, 0)
+        FROM (SELECT 1) LEFT JOIN entries AS old ON old.bucket = ? AND old.path = ?
+        '''
+
+    def __init__(self, cache_dir):
+        import threading
+        self.cache_dir = cache_dir
+        self.index_path = os.path.join(cache_dir, self.FILENAME)
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        pid = os.getpid()
+        if getattr(self._local, 'pid', None) != pid:
+            self._local.connection = self._connect()
+            self._local.pid = pid
+        return self._local.connection
+
+    def _connect(self):
+        import sqlite3
+        from baiji.util.shutillib import mkdir_p
+        mkdir_p(self.cache_dir)
+        connection = sqlite3.connect(self.index_path, timeout=60, isolation_level=None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('''
+            CREATE TABLE IF NOT EXISTS entries (
+                bucket TEXT NOT NULL,
+                path TEXT NOT NULL,
+                checked_at REAL,
+                etag TEXT,
+                size INTEGER,
+                mtime REAL,
+                accessed_at REAL,
+                hits INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (bucket, path)
+            )''')
+        columns = [row[1] for row in connection.execute('PRAGMA table_info(entries)')]
+        if 'accessed_at' not in columns: # Created before access was recorded
+            try:
+                connection.execute('ALTER TABLE entries ADD COLUMN accessed_at REAL')
+                connection.execute(
+                    'ALTER TABLE entries ADD COLUMN hits INTEGER NOT NULL DEFAULT 0')
+            except sqlite3.OperationalError: # Another process got there first
+                pass
+        return connection
+
+    @contextmanager
+    def transaction(self):
+        '''
+        Group several statements into one transaction, which is much faster
+        than committing each one.
+        '''
+        connection = self.connection
+        connection.execute('BEGIN')
+        try:
+            yield connection
+        except:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def get(self, bucket, path):
+        row = self.connection.execute(
+            'SELECT checked_at, etag, size, mtime FROM entries WHERE bucket = ? AND path = ?',
+            (bucket, path)).fetchone()
+        if row is None:
+            return None
+        checked_at, etag, size, mtime = row
+        return CacheEntry(
+            bucket=bucket, path=path, checked_at=checked_at, etag=etag, size=size, mtime=mtime)
+
+    def get_many(self, keys):
+        '''
+        Return a dict mapping each `(bucket, path)` in `keys` which has an
+        entry to its CacheEntry. The paths in each bucket are looked up a few
+        hundred to a query, which keeps within sqlite's limit of 999
+        parameters.
+        '''
+        from collections import defaultdict
+        batch_size = 500
+        paths_by_bucket = defaultdict(set)
+        for bucket, path in keys:
+            paths_by_bucket[bucket].add(path)
+        result = {}
+        for bucket, paths in paths_by_bucket.items():
+            paths = sorted(paths)
+            for i in xrange(0, len(paths), batch_size):
+                batch = paths[i:i + batch_size]
+                query = '''
+                    SELECT bucket, path, checked_at, etag, size, mtime FROM entries
+                    WHERE bucket = ? AND path IN ({})'''.format(', '.join('?' * len(batch)))
+                for row in self.connection.execute(query, [bucket] + batch):
+                    entry = CacheEntry(*row)
+                    result[(entry.bucket, entry.path)] = entry
+        return result
+
+    def recorded_etag(self, bucket, path):
+        '''
+        Return a tuple `(etag, size, mtime)`, or None if no etag is recorded.
+        '''
+        entry = self.get(bucket, path)
+        if entry is None or entry.etag is None:
+            return None
+        return entry.etag, entry.size, entry.mtime
+
+    def touch(self, bucket, path, etag=None, size=None, mtime=None):
+        '''
+        Mark a file as checked now. When `etag` is None, the etag recorded
+        before, if any, is kept.
+        '''
+        if etag is None:
+            self.connection.execute('''
+                INSERT OR REPLACE INTO entries
+                    (bucket, path, checked_at, etag, size, mtime, accessed_at, hits)
+                SELECT ?, ?, ?, old.etag, old.size, old.mtime,
+                    old.accessed_at, COALESCE(old.hits, 0)
+                FROM (SELECT 1) LEFT JOIN entries AS old ON old.bucket = ? AND old.path = ?
+                ''', (bucket, path, time.time(), bucket, path))
+        else:
+            self.connection.execute(self._TOUCH_WITH_ETAG, (
+                bucket, path, time.time(), etag, size, mtime, bucket, path))
+
+    def touch_many(self, entries):
+        '''
+        Mark several files as checked now, in one transaction. `entries` is a
+        list of `(bucket, path, etag, size, mtime)`, where `etag` is not None.
+        '''
+        now = time.time()
+        with self.transaction() as connection:
+            connection.executemany(self._TOUCH_WITH_ETAG, [
+                (bucket, path, now, etag, size, mtime, bucket, path)
+                for bucket, path, etag, size, mtime in entries])
+
+    def invalidate(self, bucket, path):
+        self.connection.execute(
+            'UPDATE entries SET checked_at = NULL WHERE bucket = ? AND path = ?',
+            (bucket, path))
+
+    def invalidate_tree(self, bucket, path):
+        # Everything under `path/` sorts between `path/` and `path0`, since
+        # `0` immediately follows `/`.
+        tree = path.rstrip('/')
+        self.connection.execute('''
+            UPDATE entries SET checked_at = NULL
+            WHERE bucket = ? AND (path = ? OR (path > ? AND path < ?))
+            ''', (bucket, tree, tree + '/', tree + '0'))
+
+    def invalidate_all(self):
+        self.connection.execute('UPDATE entries SET checked_at = NULL')
+
+    def remove(self, bucket, path):
+        self.connection.execute(
+            'DELETE FROM entries WHERE bucket = ? AND path = ?',
+            (bucket, path))
+
+    def entries(self):
+        '''
+        Yield a CacheEntry for each cached file, ordered by bucket and path.
+        '''
+        for row in self.connection.execute('''
+                SELECT bucket, path, checked_at, etag, size, mtime
+                FROM entries ORDER BY bucket, path'''):
+            yield CacheEntry(*row)
+
+    def reconcile(self, found):
+        '''
+        Bring the index in line with the files which are actually in the
+        cache. `found` is a list of `(bucket, path, size, mtime)` for each one.
+
+        Files which aren't in the index are added, as never checked, so
+        they're revalidated the next time they're used. Entries for files
+        which are gone are removed. When a file's size or mtime has changed,
+        its recorded etag no longer applies, so it's dropped.
+
+        Returns a tuple `(added, removed, updated)` with the number of
+        entries in each case.
+        '''
+        found = dict(((bucket, path), (size, mtime)) for bucket, path, size, mtime in found)
+        indexed = dict(
+            ((entry.bucket, entry.path), (entry.size, entry.mtime)) for entry in self.entries())
+        added = [key + found[key] for key in found if key not in indexed]
+        removed = [key for key in indexed if key not in found]
+        updated = [
+            found[key] + key for key in found
+            if key in indexed and indexed[key] != found[key]]
+        with self.transaction() as connection:
+            connection.executemany(
+                'INSERT INTO entries (bucket, path, size, mtime) VALUES (?, ?, ?, ?)',
+                added)
+            connection.executemany(
+                'DELETE FROM entries WHERE bucket = ? AND path = ?',
+                removed)
+            connection.executemany('''
+                UPDATE entries SET etag = NULL, size = ?, mtime = ?
+                WHERE bucket = ? AND path = ?
+                ''', updated)
+        return len(added), len(removed), len(updated)
+
+    def record_access(self, bucket, path):
+        '''
+        Note that a cached file was used, and count the use.
+        '''
+        self.connection.execute(
+            'UPDATE entries SET accessed_at = ?, hits = hits + 1 WHERE bucket = ? AND path = ?',
+            (time.time(), bucket, path))
+
+    def access_stats(self):
+        '''
+        Return a dict mapping `(bucket, path)` to `(accessed_at, hits)`, for
+        the files whose use has been recorded.
+        '''
+        return dict(
+            ((bucket, path), (accessed_at, hits))
+            for bucket, path, accessed_at, hits in self.connection.execute(
+                'SELECT bucket, path, accessed_at, hits FROM entries WHERE accessed_at IS NOT NULL'))
+
+    def import_timestamps(self):
+        '''
+        Import the `.timestamps` tree kept by TimestampMetadataStore, and then
+        remove it. Timestamps of files which are no longer cached are dropped.
+
+        Returns the number of entries imported.
+        '''
+        from baiji.pod.util.shutillib import remove_tree
+
+        timestamps_dir = os.path.join(self.cache_dir, '.timestamps')
+        if not os.path.isdir(timestamps_dir):
+            return 0
+
+        timestamps = TimestampMetadataStore(self.cache_dir)
+        rows = []
+        for bucket in os.listdir(timestamps_dir):
+            bucket_dir = os.path.join(timestamps_dir, bucket)
+            for root, _, files in os.walk(bucket_dir):
+                for name in files:
+                    ts_file = os.path.join(root, name)
+                    local = os.path.join(self.cache_dir, bucket, os.path.relpath(ts_file, bucket_dir))
+                    try:
+                        size = os.stat(local).st_size
+                        checked_at = os.path.getmtime(ts_file)
+                    except OSError:
+                        continue
+                    path = '/' + os.path.relpath(ts_file, bucket_dir).replace(os.sep, '/')
+                    etag, mtime = None, None
+                    recorded = timestamps.recorded_etag(bucket, path)
+                    if recorded is not None:
+                        etag, size, mtime = recorded
+                    rows.append((bucket, path, checked_at, etag, size, mtime))
+
+        with self.transaction() as connection:
+            connection.executemany('''
+                INSERT OR REPLACE INTO entries (bucket, path, checked_at, etag, size, mtime)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ''', rows)
+        remove_tree(timestamps_dir)
+        return len(rows)
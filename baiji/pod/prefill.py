@@ -1,42 +1,318 @@
-from baiji.util.parallel import ParallelWorker
+'''
+Prefill downloads a list of files into the asset cache ahead of time.
 
+First it plans the work. Files which are cached and current are found
+without any requests. Outdated files are revalidated in bulk, and the sizes
+of the files left to download are read from bucket listings, a directory at
+a time.
 
-class PrefillWorker(ParallelWorker):
-    def __init__(self, asset_cache, versioned_cache, verbose=False):
-        super(PrefillWorker, self).__init__()
-        self.cache = asset_cache
-        self.vc = versioned_cache
-        self.verbose = verbose
+Then the downloads are made by threads in a single process, at most
+`Config.PREFILL_CONCURRENCY` at a time, largest first. Each thread takes
+the next file as soon as it's free, so a large file doesn't start last and
+hold up the end of the prefill. Each thread reuses its own s3 connection
+from one download to the next, and `Config.MAX_BANDWIDTH` limits the
+bandwidth they take between them.
 
-    def on_run(self, remote):
-        import sys
-        from baiji import s3
+`dry_run` makes the same plan, without downloading or revalidating
+anything, and reports what a prefill would do.
 
-        if not self.verbose:
-            sys.stdout.write('.')
+While it runs, PrefillProgress reports the files and bytes done, the rate,
+and how long is left. When it's done, `prefill` returns a summary which can
+be written out as JSON.
+'''
+import sys
+import time
+from collections import namedtuple
 
-        try:
-            if remote.startswith('s3://'):
-                self.cache(remote, verbose=self.verbose)
-            else:
-                self.vc(remote, verbose=self.verbose)
-        except s3.KeyNotFound:
-            print '{} is in the prefill manifest, but is not found!'.format(remote)
 
+class PrefillPlan(namedtuple('PrefillPlan', [
+        'current',
+        'revalidated',
+        'outdated',
+        'downloads',
+        'not_found',
+])):
+    '''
+    current: The uris which are cached and current.
+    revalidated: The uris which were outdated, and have been confirmed
+      current.
+    outdated: The uris which are cached, but have changed on s3, or couldn't
+      be confirmed current. They're included in `downloads`, or `not_found`
+      when they're gone from s3.
+    downloads: A list of `(uri, size)` to download, largest first. The size
+      is None when it couldn't be listed, because we can't contact s3.
+    not_found: The uris which aren't on s3.
+    '''
+    __slots__ = ()
 
-def prefill(asset_cache, versioned_cache, paths, num_processes=None, verbose=False):
-    from baiji.util.parallel import parallel_for
-    from harrison import Timer
+    @property
+    def download_size(self):
+        return sum(size for _, size in self.downloads if size is not None)
 
-    if num_processes is None:
-        num_processes = asset_cache.config.num_prefill_processes
+    def summary(self):
+        from baiji.pod.util.format_bytes import format_bytes
+        return 'Prefill plan: {} current, {} revalidated, {} to download ({}), {} not found'.format(
+            len(self.current), len(self.revalidated), len(self.downloads),
+            format_bytes(self.download_size), len(self.not_found))
 
-    with Timer(verbose=False) as t:
-        parallel_for(
-            paths,
-            PrefillWorker,
-            args=[asset_cache, versioned_cache, verbose],
-            num_processes=num_processes)
+
+def format_duration(seconds):
+    '''
+    Format a number of seconds like `45s`, `3m20s`, or `1h05m`.
+    '''
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return '{}s'.format(seconds)
+    elif seconds < 3600:
+        return '{}m{:02d}s'.format(seconds // 60, seconds % 60)
+    return '{}h{:02d}m'.format(seconds // 3600, seconds % 3600 // 60)
+
+
+class PrefillProgress(object):
+    '''
+    Keep count of the downloads in a PrefillPlan as they finish, and report
+    progress on `stream`. On a terminal the report is updated in place;
+    otherwise a line is written every `interval` seconds, so logs don't fill
+    up.
+
+    Pass it as the `on_done` callback of `AssetCache.download_many`.
+    '''
+    def __init__(self, prefill_plan, stream=None, interval=10):
+        self.plan = prefill_plan
+        self.sizes = dict(prefill_plan.downloads)
+        self.stream = stream if stream is not None else sys.stderr
+        self.interval = interval
+        self.files_done = 0
+        self.bytes_done = 0
+        self.failures = {}
+        self.started_at = time.time()
+        self.finished_at = None
+        self._reported_at = None
+
+    @property
+    def is_interactive(self):
+        isatty = getattr(self.stream, 'isatty', None)
+        return isatty is not None and isatty()
+
+    @property
+    def elapsed(self):
+        return (self.finished_at or time.time()) - self.started_at
+
+    @property
+    def rate(self):
+        '''
+        The average download rate so far, in bytes per second.
+        '''
+        elapsed = self.elapsed
+        return self.bytes_done / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def eta(self):
+        '''
+        The seconds left at the average rate so far, or None before
+        anything's been downloaded.
+        '''
+        rate = self.rate
+        if not rate:
+            return None
+        return (self.plan.download_size - self.bytes_done) / rate
+
+    def __call__(self, uri, local_path, error):
+        self.files_done += 1
+        if error is None:
+            self.bytes_done += self.sizes.get(uri) or 0
+        else:
+            self.failures[uri] = error
+        self.report()
+
+    def status(self):
+        from baiji.pod.util.format_bytes import format_bytes
+        eta = self.eta
+        return 'Prefill: {}/{} files, {}/{}, {}/s, ETA {}, {} failed'.format(
+            self.files_done, len(self.plan.downloads),
+            format_bytes(self.bytes_done), format_bytes(self.plan.download_size),
+            format_bytes(self.rate), format_duration(eta) if eta is not None else '?',
+            len(self.failures))
+
+    def report(self):
+        now = time.time()
+        if self.is_interactive:
+            self.stream.write('\r' + self.status())
+        elif self._reported_at is None or now - self._reported_at >= self.interval:
+            self.stream.write(self.status() + '\n')
+        else:
+            return
+        self.stream.flush()
+        self._reported_at = now
+
+    def finish(self):
+        self.finished_at = time.time()
+        if self.is_interactive:
+            self.stream.write('\r' + self.status() + '\n')
+        else:
+            self.stream.write(self.status() + '\n')
+        self.stream.flush()
+
+    def summary(self):
+        '''
+        Return a summary of the prefill, made of things which can be
+        serialized as JSON.
+        '''
+        failures = dict((uri, str(error)) for uri, error in self.failures.items())
+        failures.update((uri, 'Not found') for uri in self.plan.not_found)
+        return {
+            'files': len(self.plan.current) + len(self.plan.revalidated) + \
+                len(self.plan.downloads) + len(self.plan.not_found),
+            'current': len(self.plan.current),
+            'revalidated': len(self.plan.revalidated),
+            'downloaded': len(self.plan.downloads) - len(self.failures),
+            'failed': len(failures),
+            'bytes_downloaded': self.bytes_done,
+            'download_seconds': round(self.elapsed, 3),
+            'bytes_per_second': round(self.rate, 1),
+            'failures': failures,
+        }
+
+
+def remote_uris(versioned_cache, paths):
+    '''
+    Resolve the prefill paths to s3 uris, skipping any which aren't on s3.
+    '''
+    from baiji import s3
+    uris = []
+    for path in paths:
+        if path.startswith('s3://'):
+            uris.append(path)
+        elif versioned_cache.is_versioned(path):
+            try:
+                uri = versioned_cache.uri(path)
+            except s3.KeyNotFound:
+                continue
+            if s3.path.isremote(uri):
+                uris.append(uri)
+    return uris
+
+
+def plan(asset_cache, uris, verbose=False, dry_run=False):
+    '''
+    Work out what it takes to prefill `uris`, and return a PrefillPlan.
+    What's recorded about the cached files is looked up in bulk.
+
+    Outdated files are revalidated along the way. With `dry_run`, they're
+    compared with the listings instead, and nothing in the cache is changed,
+    so `revalidated` holds the files which would be confirmed current.
+    '''
+    import socket
+    from baiji.exceptions import AWSCredentialsMissing
+    from baiji.pod.transfer import list_many
+    from baiji.pod.util.reachability import InternetUnreachableError
+
+    uris = sorted(set(uris))
+    current, outdated, missing = [], [], []
+    for uri, cache_file in zip(uris, asset_cache.cache_files(uris)):
+        if not cache_file.is_cached:
+            missing.append(uri)
+        elif cache_file.is_outdated:
+            outdated.append((uri, cache_file))
+        else:
+            current.append(uri)
+
+    try:
+        if dry_run:
+            asset_cache.reachability.assert_reachable()
+            listed = list_many([uri for uri, _ in outdated] + missing)
+            unconfirmed = [
+                uri for uri, cache_file in outdated
+                if uri not in listed or listed[uri][0] != cache_file.local_etag]
+        else:
+            unconfirmed = asset_cache.revalidate_many(
+                [uri for uri, _ in outdated], verbose=verbose)
+            asset_cache.reachability.assert_reachable()
+            listed = list_many(missing + unconfirmed)
+    except (socket.gaierror, InternetUnreachableError, AWSCredentialsMissing):
+        # Try them anyway, and let each one report its own error.
+        if dry_run:
+            unconfirmed = [uri for uri, _ in outdated]
+        listed = None
+
+    revalidated = sorted(set(uri for uri, _ in outdated) - set(unconfirmed))
+    to_download = sorted(missing + unconfirmed)
+    if listed is None:
+        downloads = [(uri, None) for uri in to_download]
+        not_found = []
+    else:
+        downloads = sorted(
+            [(uri, listed[uri][1]) for uri in to_download if uri in listed],
+            key=lambda download: download[1], reverse=True)
+        not_found = [uri for uri in to_download if uri not in listed]
+    return PrefillPlan(
+        current=current, revalidated=revalidated, outdated=sorted(unconfirmed),
+        downloads=downloads, not_found=not_found)
+
+
+def dry_run(asset_cache, versioned_cache, paths, verbose=False):
+    '''
+    Report what prefilling `paths` would do, without downloading anything or
+    changing the cache, and return the PrefillPlan.
+    '''
+    from baiji.pod.util.format_bytes import format_bytes
+    for path in paths:
+        if not path.startswith('s3://') and not versioned_cache.is_versioned(path):
+            print 'not found  {}'.format(path)
+    prefill_plan = plan(
+        asset_cache, remote_uris(versioned_cache, paths), verbose=verbose, dry_run=True)
+    outdated = set(prefill_plan.outdated)
+    for uri, size in prefill_plan.downloads:
+        print '{:<10} {} ({})'.format(
+            'outdated' if uri in outdated else 'missing', uri,
+            format_bytes(size) if size is not None else 'size unknown')
+    for uri in prefill_plan.not_found:
+        print 'not found  {}'.format(uri)
+    if verbose:
+        for uri in prefill_plan.revalidated:
+            print 'unchanged  {}'.format(uri)
+        for uri in prefill_plan.current:
+            print 'current    {}'.format(uri)
+    print prefill_plan.summary()
+    return prefill_plan
+
+
+def prefill(asset_cache, versioned_cache, paths, concurrency=None, verbose=False,
+            progress_stream=None, num_processes=None):
+    '''
+    Fill the cache with `paths`, which are s3 uris or versioned paths.
+    Returns the summary from `PrefillProgress.summary`, which includes the
+    uris which couldn't be got, and why.
+
+    concurrency: The most files to download at once. Defaults to
+      `Config.PREFILL_CONCURRENCY`.
+    progress_stream: Where to report progress. Defaults to stderr.
+    num_processes: Deprecated; use `concurrency`.
+    '''
+    if concurrency is None:
+        concurrency = num_processes
+    if concurrency is None:
+        concurrency = asset_cache.settings.prefill_concurrency
+    started_at = time.time()
+
+    for path in paths:
+        if not path.startswith('s3://') and not versioned_cache.is_versioned(path):
+            print '{} is in the prefill manifest, but is not found!'.format(path)
+
+    prefill_plan = plan(asset_cache, remote_uris(versioned_cache, paths), verbose=verbose)
+    print prefill_plan.summary()
+
+    progress = PrefillProgress(prefill_plan, stream=progress_stream)
+    asset_cache.download_many(
+        [uri for uri, _ in prefill_plan.downloads], verbose=verbose, max_workers=concurrency,
+        on_done=progress)
+    progress.finish()
+
+    summary = progress.summary()
+    summary['elapsed_seconds'] = round(time.time() - started_at, 3)
+    for uri, reason in sorted(summary['failures'].items()):
+        print "Couldn't prefill {}: {}".format(uri, reason)
 
     print ''
-    print 'sc prefill done in {} seconds'.format(t.elapsed_time_s)
+    print 'sc prefill done in {} seconds'.format(summary['elapsed_seconds'])
+    return summary
@@ -19,6 +19,15 @@ class CacheUtilRunner(object):
         cache_command.add_argument(
             '-u', '--update', action='store_true', help='always check for updates')
 
+        revalidate_command = commands.add_parser(
+            'revalidate', help='check cached files for updates, in bulk')
+        revalidate_command.add_argument(
+            'keys', type=str, nargs='*',
+            help='keys to check; defaults to everything in the cache')
+        revalidate_command.add_argument(
+            '-f', '--force', action='store_true',
+            help='check files even if they were checked recently')
+
         del_command = commands.add_parser(
             'del', help='remove a file from the cache')
         del_command.add_argument(
@@ -28,10 +37,22 @@ class CacheUtilRunner(object):
             'ls', help='list everything in the cache')
         ls_command.add_argument(
             '-l', '--details', action='store_true', help='more detail')
+        ls_command.add_argument(
+            '--rebuild', action='store_true',
+            help='first reconcile the cache index with the files on disk')
+
+        evict_command = commands.add_parser(
+            'evict', help='evict files until the cache is within its size limits')
+        evict_command.add_argument(
+            '-n', '--dry-run', action='store_true',
+            help='list the files which would be evicted, without evicting them')
 
         commands.add_parser(
             'loc', help='print the location of the cache')
 
+        commands.add_parser(
+            'migrate', help='import the .timestamps tree into the cache index')
+
         return parser.parse_args(args=args)
 
     def main(self, args=None):
@@ -42,10 +63,19 @@ class CacheUtilRunner(object):
         if args.command == 'cache':
             self.cache(args.key, force_check=args.update)
 
+        elif args.command == 'revalidate':
+            keys = args.keys or [x.remote for x in self.cache.ls()]
+            for key in self.cache.revalidate_many(keys, force_check=args.force):
+                print('outdated {}'.format(key).encode('utf-8'))
+
         elif args.command == 'del':
             self.cache.delete(args.key)
 
         elif args.command == 'ls':
+            if args.rebuild:
+                import sys
+                print('Rebuilt index: {} added, {} removed, {} updated'.format(
+                    *self.cache.rebuild_index()), file=sys.stderr)
             if args.details:
                 for x in self.cache.ls():
                     outdated = 'outdated ' if x.is_outdated else ''
@@ -58,8 +88,25 @@ class CacheUtilRunner(object):
             else:
                 print(u'\n'.join([x.remote for x in self.cache.ls()]).encode('utf-8'))
 
+        elif args.command == 'evict':
+            if args.dry_run:
+                from baiji.pod.eviction import Evictor
+                evicted = [x.cache_file.remote for x in Evictor(self.cache).plan()]
+            else:
+                evicted = self.cache.evict()
+            for key in evicted:
+                print('evicted {}'.format(key).encode('utf-8'))
+
         elif args.command == 'loc':
-            print(self.cache.config.cache_dir)
+            print(self.cache.settings.cache_dir)
+
+        elif args.command == 'migrate':
+            from baiji.pod.metadata import IndexMetadataStore
+            index = IndexMetadataStore(self.cache.settings.cache_dir)
+            print('Imported {} entries into {}'.format(
+                index.import_timestamps(), index.index_path))
+            if self.cache.settings.metadata_store != 'index':
+                print('Set STATIC_CACHE_METADATA_STORE=index to use it.')
 
         # On success, exit with status code of 0.
         return 0
@@ -46,12 +46,21 @@ class PrefillRunner(object):
         parser.add_argument(
             '-v', '--verbose', action='store_true', default=False,
             help='print verbose info such as which file are getting pre-filled')
+        parser.add_argument(
+            '--plan', action='store_true', default=False,
+            help="report which files are missing, outdated, or current, and how much "
+                 "would be downloaded, without downloading anything")
+        parser.add_argument(
+            '--summary', default=None, type=str,
+            help='write a JSON summary of the prefill to this file, or - for stdout')
 
         return parser.parse_args()
 
     def main(self):
         import os
-        from baiji.pod.prefill import prefill
+        import sys
+        from baiji.pod.prefill import dry_run, prefill
+        from baiji.pod.util import json
         from baiji.pod.util import yaml
 
         args = self._parse_args()
@@ -62,12 +71,34 @@ class PrefillRunner(object):
 
         if paths is None:
             print 'Nothing to prefill!'
+        elif args.plan:
+            dry_run(
+                asset_cache=self.cache,
+                versioned_cache=vc,
+                paths=paths,
+                verbose=args.verbose)
+        elif args.summary == '-':
+            # Keep stdout for the summary, so it can be piped to a JSON
+            # reader, and send everything else to stderr.
+            stdout = sys.stdout
+            sys.stdout = sys.stderr
+            try:
+                summary = prefill(
+                    asset_cache=self.cache,
+                    versioned_cache=vc,
+                    paths=paths,
+                    verbose=args.verbose)
+            finally:
+                sys.stdout = stdout
+            print json.dumps(summary, sort_keys=True)
         else:
-            prefill(
+            summary = prefill(
                 asset_cache=self.cache,
                 versioned_cache=vc,
                 paths=paths,
                 verbose=args.verbose)
+            if args.summary is not None:
+                json.dump(summary, args.summary, sort_keys=True, indent=4)
 
         # On success, exit with status code of 0.
         return 0
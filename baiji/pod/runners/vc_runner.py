@@ -63,6 +63,9 @@ class VCRunner(object):
             'path-remote', help="output the file's remote path")
         subparsers['cat'] = parser.subs.add_parser(
             'cat', help='write the contents of a file to stdout')
+        subparsers['compile-manifest'] = parser.subs.add_parser(
+            'compile-manifest',
+            help='compile the manifest for faster loading, to the manifest path + .sqlite')
 
         subparsers['add'].add_argument('path', type=str, help='path to store the file at')
         subparsers['add'].add_argument(
@@ -161,5 +164,10 @@ class VCRunner(object):
             f = vc(args.path, version=args.version)
             shutil.copyfileobj(open(f, 'rb'), sys.stdout)
 
+        if args.command == 'compile-manifest':
+            from baiji.pod.versioned.manifest import compile_manifest, compiled_path
+            count = compile_manifest(vc.manifest_path)
+            print 'compiled {} entries to {}'.format(count, compiled_path(vc.manifest_path))
+
         # On success, exit with status code of 0.
         return 0
@@ -3,6 +3,7 @@ import os
 import mock
 from scratch_dir import ScratchDirMixin
 from baiji import s3
+from baiji.pod.test_support import S3StandInMixin
 
 
 class CreateDefaultAssetCacheMixin(object):
@@ -110,10 +111,9 @@ class TestAssetCache(CreateTestAssetCacheMixin, unittest.TestCase):
 
     def test_doesnt_check_before_timeout(self):
         self.cache(self.filename)
-        with mock.patch('baiji.s3.cp') as mock_cp:
-            mock_cp.return_value = True
+        with mock.patch('baiji.pod.transfer.fetch') as mock_fetch:
             self.cache(self.filename)
-            assert not mock_cp.called, 'File downloaded before timeout'
+            assert not mock_fetch.called, 'File downloaded before timeout'
 
     def test_does_check_after_timeout(self):
         import time
@@ -123,12 +123,11 @@ class TestAssetCache(CreateTestAssetCacheMixin, unittest.TestCase):
         s3.cp(self.get_test_file_path(), self.remote_file, force=True)
         time.sleep(2)
 
-        with mock.patch('baiji.s3.cp') as mock_cp:
-            mock_cp.return_value = True
+        with mock.patch('baiji.pod.transfer.fetch') as mock_fetch:
+            mock_fetch.return_value = 'abc'
             self.cache(self.filename)
-            mock_cp.assert_called_with(
-                self.remote_file, self.local_file,
-                progress=False, force=True, validate=True)
+            self.assertEqual(mock_fetch.call_args[0], (self.remote_file, self.local_file))
+            self.assertFalse(mock_fetch.call_args[1]['progress'])
 
     def test_that_invalidating_nonexistent_file_succeeds(self):
         import uuid
@@ -172,6 +171,142 @@ class TestAssetCache(CreateTestAssetCacheMixin, unittest.TestCase):
             self.assertTrue(os.path.exists(cache_file))
 
 
+class TestConfigSnapshot(CreateTestAssetCacheMixin, unittest.TestCase):
+    def test_that_settings_are_resolved_once(self):
+        with mock.patch.dict('os.environ', {'STATIC_CACHE_IMMUTABLE_BUCKETS': 'foo:bar'}):
+            self.assertEqual(self.cache.settings.immutable_buckets, frozenset())
+            self.cache.refresh_config()
+            self.assertEqual(self.cache.settings.immutable_buckets, frozenset(['foo', 'bar']))
+            with mock.patch('os.getenv') as mock_getenv:
+                self.cache.is_cachefile('/foo/bar.baz')
+                self.assertFalse(mock_getenv.called)
+
+    def test_that_settings_are_immutable(self):
+        with self.assertRaises(AttributeError):
+            self.cache.settings.timeout = 0
+
+    def test_deprecated_prefill_settings(self):
+        from baiji.pod.config import Config
+
+        class OldConfig(Config):
+            NUM_PREFILL_PROCESSES = 4
+
+        class OldPropertyConfig(Config):
+            @property
+            def num_prefill_processes(self):
+                return 5
+
+        self.assertEqual(Config().prefill_concurrency, 32)
+        self.assertEqual(Config().num_prefill_processes, 32)
+        self.assertEqual(OldConfig().prefill_concurrency, 4)
+        self.assertEqual(OldPropertyConfig().snapshot().prefill_concurrency, 5)
+        with mock.patch.dict('os.environ', {'STATIC_CACHE_NUM_PREFILL_PROCESSES': '6'}):
+            self.assertEqual(Config().prefill_concurrency, 6)
+            with mock.patch.dict('os.environ', {'STATIC_CACHE_PREFILL_CONCURRENCY': '7'}):
+                self.assertEqual(Config().prefill_concurrency, 7)
+
+
+def put_in_cache(cache_file):
+    from baiji.util.shutillib import mkdir_p
+    mkdir_p(os.path.dirname(cache_file.local))
+    with open(cache_file.local, 'w') as f:
+        f.write('cached')
+    cache_file.update_timestamp()
+
+
+class TestFreshPathMemo(CreateTestAssetCacheMixin, unittest.TestCase):
+    def setUp(self):
+        from baiji.pod.asset_cache import CacheFile
+
+        super(TestFreshPathMemo, self).setUp()
+        self.cache.config.TIMEOUT = 3600
+        self.cache.refresh_config()
+
+        self.filename = 'test_sc/memo/test_sample.txt'
+        self.cache_file = CacheFile(self.cache, self.filename)
+        put_in_cache(self.cache_file)
+
+    def test_that_warm_hit_does_not_touch_filesystem(self):
+        self.assertEqual(self.cache(self.filename), self.cache_file.local)
+        with mock.patch('os.path.exists') as mock_exists:
+            with mock.patch('os.path.getmtime') as mock_getmtime:
+                self.assertEqual(self.cache(self.filename), self.cache_file.local)
+        self.assertFalse(mock_exists.called)
+        self.assertFalse(mock_getmtime.called)
+
+    def test_that_expired_entries_are_checked_again(self):
+        import time
+        self.cache(self.filename)
+        with mock.patch('time.time', return_value=time.time() + 7200):
+            with mock.patch('os.path.exists', wraps=os.path.exists) as mock_exists:
+                self.cache(self.filename)
+        mock_exists.assert_any_call(self.cache_file.local)
+
+    @mock.patch('baiji.pod.util.reachability.assert_internet_reachable')
+    def test_that_force_check_bypasses_memo(self, _):
+        self.cache(self.filename)
+        with mock.patch('baiji.s3.etag', return_value='abc') as mock_etag:
+            with mock.patch('baiji.pod.transfer.fetch', return_value='abc'):
+                self.cache(self.filename, force_check=True)
+        self.assertTrue(mock_etag.called)
+
+    def test_that_invalidate_and_delete_forget_paths(self):
+        self.cache(self.filename)
+        self.cache.invalidate('test_sc/memo')
+        self.assertEqual(self.cache._fresh, {}) # pylint: disable=protected-access
+
+        self.cache(self.filename)
+        self.cache.invalidate_all()
+        self.assertEqual(self.cache._fresh, {}) # pylint: disable=protected-access
+
+        put_in_cache(self.cache_file)
+        self.cache(self.filename)
+        self.cache.delete(self.filename)
+        self.assertEqual(self.cache._fresh, {}) # pylint: disable=protected-access
+
+    @mock.patch.dict('os.environ', {'EC2': ''})
+    @mock.patch('baiji.util.reachability.internet_reachable', return_value=False)
+    def test_that_offline_revalidation_is_skipped_without_probing_each_time(self, mock_reachable):
+        for _ in range(3):
+            self.assertEqual(
+                self.cache(self.filename, force_check=True), self.cache_file.local)
+        self.assertEqual(mock_reachable.call_count, 1)
+
+
+class TestRecordedEtag(CreateTestAssetCacheMixin, unittest.TestCase):
+    def setUp(self):
+        from baiji.pod.asset_cache import CacheFile
+
+        super(TestRecordedEtag, self).setUp()
+        self.filename = 'test_sc/memo/test_sample.txt'
+        self.cache_file = CacheFile(self.cache, self.filename)
+        put_in_cache(self.cache_file)
+        self.cache_file.update_timestamp(etag='abc')
+
+    def test_that_recorded_etag_is_used_for_unchanged_file(self):
+        from baiji.pod.asset_cache import CacheFile
+        with mock.patch('baiji.s3.etag') as mock_etag:
+            self.assertEqual(CacheFile(self.cache, self.filename).local_etag, 'abc')
+        self.assertFalse(mock_etag.called)
+
+    def test_that_changed_file_is_hashed(self):
+        from baiji.pod.asset_cache import CacheFile
+        stat = os.stat(self.cache_file.local)
+        os.utime(self.cache_file.local, (stat.st_atime, stat.st_mtime - 10))
+        with mock.patch('baiji.s3.etag', return_value='def') as mock_etag:
+            self.assertEqual(CacheFile(self.cache, self.filename).local_etag, 'def')
+        mock_etag.assert_called_once_with(self.cache_file.local)
+
+    def test_that_index_records_etag(self):
+        from baiji.pod.asset_cache import CacheFile
+        self.cache.config.METADATA_STORE = 'index'
+        self.cache.refresh_config()
+        CacheFile(self.cache, self.filename).update_timestamp(etag='abc')
+        with mock.patch('baiji.s3.etag') as mock_etag:
+            self.assertEqual(CacheFile(self.cache, self.filename).local_etag, 'abc')
+        self.assertFalse(mock_etag.called)
+
+
 class TestCacheFile(CreateDefaultAssetCacheMixin, unittest.TestCase):
     def test_cachefile_parses_s3_path_correctly(self):
         from baiji.pod.asset_cache import CacheFile
@@ -184,8 +319,8 @@ class TestCacheFile(CreateDefaultAssetCacheMixin, unittest.TestCase):
 
     def test_cachefile_parses_recursive_cached_calls_correctly(self):
         from baiji.pod.asset_cache import CacheFile
-        with mock.patch('baiji.s3.cp') as mock_cp:
-            mock_cp.return_value = True
+        with mock.patch('baiji.pod.transfer.fetch') as mock_fetch:
+            mock_fetch.return_value = 'abc'
             with mock.patch('baiji.s3.exists') as mock_exists:
                 mock_exists.return_value = True
                 local_path = self.cache('s3://BuKeT/foo/bar.baz')
@@ -200,6 +335,7 @@ class TestCacheFile(CreateDefaultAssetCacheMixin, unittest.TestCase):
     def test_cachefile_parses_remote_path_with_no_bucket_correctly(self):
         from baiji.pod.asset_cache import CacheFile
         self.cache.config.DEFAULT_BUCKET = 'BuKeT'
+        self.cache.refresh_config()
         cf = CacheFile(self.cache, '/foo/bar.baz')
         self.assertEqual(cf.path, '/foo/bar.baz')
         self.assertEqual(cf.bucket, 'BuKeT')
@@ -258,3 +394,311 @@ class TestCachePath(ScratchDirMixin, unittest.TestCase):
             m.assert_not_called()
 
         self.assertIsNot(type(loaded_cache_path), CachedPath)
+
+
+class TestConditionalRevalidation(S3StandInMixin, ScratchDirMixin, unittest.TestCase):
+    def setUp(self):
+        super(TestConditionalRevalidation, self).setUp()
+        self.cache = self.create_cache()
+        self.s3.put('bucket', 'foo/bar.baz', 'some contents')
+
+    def test_revalidation_costs_one_request(self):
+        path = self.cache('s3://bucket/foo/bar.baz')
+        self.assertEqual(len(self.s3.requests), 1)
+
+        with mock.patch('baiji.s3.etag') as mock_etag:
+            self.cache('s3://bucket/foo/bar.baz', force_check=True)
+        self.assertFalse(mock_etag.called)
+        self.assertEqual(len(self.s3.requests), 2)
+
+        self.s3.put('bucket', 'foo/bar.baz', 'new contents')
+        self.cache('s3://bucket/foo/bar.baz', force_check=True)
+        self.assertEqual(len(self.s3.requests), 3)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), 'new contents')
+
+
+class TestRevalidateMany(S3StandInMixin, ScratchDirMixin, unittest.TestCase):
+    def setUp(self):
+        super(TestRevalidateMany, self).setUp()
+        self.cache = self.create_cache()
+        self.s3.page_size = 3
+
+        self.keys = ['s3://bucket/foo/{}.txt'.format(i) for i in range(10)]
+        self.keys.append('s3://bucket/bar/solo.txt')
+        for key in self.keys:
+            self.s3.put('bucket', key.replace('s3://bucket/', ''), key)
+            self.cache(key)
+        self.cache.invalidate_all()
+        del self.s3.requests[:]
+
+    def test_revalidate_many(self):
+        from baiji.pod.asset_cache import CacheFile
+
+        self.s3.put('bucket', 'foo/3.txt', 'changed')
+        self.s3.objects.pop(('bucket', 'foo/4.txt'))
+
+        unconfirmed = self.cache.revalidate_many(self.keys + ['s3://bucket/not/cached.txt'])
+
+        self.assertEqual(sorted(unconfirmed), ['s3://bucket/foo/3.txt', 's3://bucket/foo/4.txt'])
+        # Three pages of foo/, and one for bar/solo.txt.
+        self.assertEqual(len(self.s3.requests), 4)
+        for key in self.keys:
+            self.assertEqual(
+                CacheFile(self.cache, key).is_outdated, key in unconfirmed)
+
+        # Only foo/ is left to check.
+        self.assertEqual(self.cache.revalidate_many(self.keys), unconfirmed)
+        self.assertEqual(len(self.s3.requests), 7)
+
+
+class TestGetMany(S3StandInMixin, ScratchDirMixin, unittest.TestCase):
+    def setUp(self):
+        super(TestGetMany, self).setUp()
+        self.cache = self.create_cache()
+
+        for name in ['current', 'outdated', 'changed', 'missing']:
+            self.s3.put('bucket', 'foo/{}.txt'.format(name), name)
+        for name in ['current', 'outdated', 'changed']:
+            self.cache('s3://bucket/foo/{}.txt'.format(name))
+        self.cache.invalidate('s3://bucket/foo/outdated.txt')
+        self.cache.invalidate('s3://bucket/foo/changed.txt')
+        self.s3.put('bucket', 'foo/changed.txt', 'changed again')
+        del self.s3.requests[:]
+
+    def contents(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_get_many(self):
+        from baiji import s3
+        paths = ['s3://bucket/foo/{}.txt'.format(name) for name in [
+            'current', 'outdated', 'changed', 'missing', 'not_there']]
+
+        local_paths, errors = self.cache.get_many(paths, max_workers=2)
+
+        self.assertEqual(sorted(local_paths), sorted(paths[:4]))
+        for path in paths[:4]:
+            self.assertEqual(local_paths[path], self.cache(path))
+        self.assertEqual(self.contents(local_paths[paths[2]]), 'changed again')
+        self.assertEqual(self.contents(local_paths[paths[3]]), 'missing')
+        self.assertEqual(errors.keys(), [paths[4]])
+        self.assertIsInstance(errors[paths[4]], s3.KeyNotFound)
+        # One listing for foo/, then a GET each for changed, missing, and
+        # not_there.
+        self.assertEqual(len(self.s3.requests), 4)
+
+    def test_that_remembered_paths_are_not_checked(self):
+        self.cache.invalidate_all()
+        self.cache('s3://bucket/foo/current.txt')
+        del self.s3.requests[:]
+        with mock.patch('baiji.pod.asset_cache.CacheFile') as mock_cache_file:
+            local_paths, errors = self.cache.get_many(['s3://bucket/foo/current.txt'])
+        self.assertEqual(local_paths.keys(), ['s3://bucket/foo/current.txt'])
+        self.assertEqual(errors, {})
+        self.assertFalse(mock_cache_file.called)
+        self.assertEqual(self.s3.requests, [])
+
+    def test_versioned_get_many(self):
+        from baiji.pod import VersionedCache
+        from baiji.pod.util import json
+
+        manifest_path = os.path.join(self.scratch_dir, 'manifest.json')
+        json.dump({'/a.txt': '1.0.0', '/b.txt': '2.0.0'}, manifest_path)
+        self.s3.put('versioned', 'a.1.0.0.txt', 'a')
+        vc = VersionedCache(cache=self.cache, manifest_path=manifest_path, bucket='versioned')
+
+        local_paths, errors = vc.get_many(['/a.txt', 'b.txt', '/c.txt'])
+
+        self.assertEqual(local_paths.keys(), ['/a.txt'])
+        self.assertEqual(self.contents(local_paths['/a.txt']), 'a')
+        self.assertEqual(sorted(errors), ['/c.txt', 'b.txt'])
+        for error in errors.values():
+            self.assertIsInstance(error, vc.KeyNotFound)
+
+
+class TestConcurrentDownloads(S3StandInMixin, ScratchDirMixin, unittest.TestCase):
+    def setUp(self):
+        super(TestConcurrentDownloads, self).setUp()
+        self.s3.put('bucket', 'foo/bar.baz', 'some contents')
+        self.s3.delay = 0.2
+
+    def test_that_concurrent_misses_download_once(self):
+        import threading
+
+        # Separate caches, as separate processes would have.
+        caches = [self.create_cache() for _ in range(5)]
+        results = []
+        def get(cache):
+            results.append(cache('s3://bucket/foo/bar.baz'))
+        threads = [threading.Thread(target=get, args=(cache,)) for cache in caches]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(self.s3.requests), 1)
+        self.assertEqual(len(set(results)), 1)
+        with open(results[0], 'rb') as f:
+            self.assertEqual(f.read(), 'some contents')
+        self.assertEqual(os.listdir(os.path.dirname(results[0])), ['bar.baz'])
+
+    def run_concurrently(self, fn, num_threads=5):
+        import threading
+        results, errors = [], []
+        def run():
+            try:
+                results.append(fn())
+            except Exception as e: # pylint: disable=broad-except
+                errors.append(e)
+        threads = [threading.Thread(target=run) for _ in range(num_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results, errors
+
+    def test_that_concurrent_misses_within_a_process_share_one_request(self):
+        cache = self.create_cache()
+        results, errors = self.run_concurrently(lambda: cache('s3://bucket/foo/bar.baz'))
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(self.s3.requests), 1)
+        self.assertEqual(len(results), 5)
+        self.assertEqual(len(set(results)), 1)
+
+    def test_that_concurrent_requests_for_a_missing_key_share_the_error(self):
+        from baiji import s3
+        cache = self.create_cache()
+        results, errors = self.run_concurrently(lambda: cache('s3://bucket/not/there'))
+
+        self.assertEqual(results, [])
+        self.assertEqual(len(errors), 5)
+        for e in errors:
+            self.assertIsInstance(e, s3.KeyNotFound)
+        self.assertEqual(len(self.s3.requests), 1)
+
+
+class TestStaleWhileRevalidate(S3StandInMixin, ScratchDirMixin, unittest.TestCase):
+    def setUp(self):
+        super(TestStaleWhileRevalidate, self).setUp()
+        self.cache = self.create_cache(TIMEOUT=60, STALE_WHILE_REVALIDATE=3600)
+
+        # Collect the background worker rather than starting it.
+        import threading
+        self.workers = []
+        start_thread = threading.Thread.start
+        def start(thread):
+            if thread.name == 'baiji-pod revalidation':
+                self.workers.append(thread)
+            else:
+                start_thread(thread)
+        patcher = mock.patch('threading.Thread.start', start)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.s3.put('bucket', 'foo/bar.baz', 'some contents')
+        self.path = self.cache('s3://bucket/foo/bar.baz')
+        self.s3.put('bucket', 'foo/bar.baz', 'new contents')
+        del self.s3.requests[:]
+
+    def age(self, seconds):
+        from baiji.pod.asset_cache import CacheFile
+        timestamp_file = CacheFile(self.cache, 's3://bucket/foo/bar.baz').timestamp_file
+        checked_at = os.path.getmtime(timestamp_file) - seconds
+        os.utime(timestamp_file, (checked_at, checked_at))
+        self.cache.refresh_config() # Forget the path
+
+    def contents(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def test_that_recently_outdated_file_is_revalidated_in_background(self):
+        self.age(120)
+        for _ in range(2):
+            self.assertEqual(self.cache('s3://bucket/foo/bar.baz'), self.path)
+        self.assertEqual(self.s3.requests, [])
+        self.assertEqual(self.contents(), 'some contents')
+        self.assertEqual(len(self.workers), 1)
+
+        self.workers[0].run()
+        self.assertEqual(len(self.s3.requests), 1)
+        self.assertEqual(self.contents(), 'new contents')
+
+        # Now it's fresh, and remembered.
+        with mock.patch('os.path.exists') as mock_exists:
+            self.cache('s3://bucket/foo/bar.baz')
+        self.assertFalse(mock_exists.called)
+
+    def test_that_very_outdated_file_is_revalidated_before_returning(self):
+        self.age(7200)
+        self.cache('s3://bucket/foo/bar.baz')
+        self.assertEqual(len(self.s3.requests), 1)
+        self.assertEqual(self.contents(), 'new contents')
+        self.assertEqual(self.workers, [])
+
+    def test_that_force_check_is_not_deferred(self):
+        self.age(120)
+        self.cache('s3://bucket/foo/bar.baz', force_check=True)
+        self.assertEqual(len(self.s3.requests), 1)
+        self.assertEqual(self.workers, [])
+
+    def test_that_background_errors_are_swallowed(self):
+        self.age(120)
+        self.cache('s3://bucket/foo/bar.baz')
+        self.s3.objects.clear()
+        self.workers[0].run()
+        self.assertEqual(self.contents(), 'some contents')
+        self.assertEqual(self.cache._stale_pending, set()) # pylint: disable=protected-access
+
+
+class TestCacheDownloads(S3StandInMixin, ScratchDirMixin, unittest.TestCase):
+    def setUp(self):
+        import hashlib
+        super(TestCacheDownloads, self).setUp()
+        self.contents = ''.join(chr(x % 256) for x in range(10000))
+        self.etag = hashlib.md5(self.contents).hexdigest()
+        self.s3.put('bucket', 'foo/bar.baz', self.contents)
+        self.local = os.path.join(self.scratch_dir, 'cache', 'bucket', 'foo', 'bar.baz')
+
+    def interrupted_stream(self, num_bytes):
+        from baiji.pod.transfer import PartialDownload
+        partial = PartialDownload(self.local)
+        partial.start(self.etag, len(self.contents))
+        with open(partial.path, 'ab') as f:
+            f.write(self.contents[:num_bytes])
+        return partial
+
+    def assert_fetched(self):
+        with open(self.local, 'rb') as f:
+            self.assertEqual(f.read(), self.contents)
+        self.assertEqual(os.listdir(os.path.dirname(self.local)), ['bar.baz'])
+
+    def test_that_cache_downloads_in_ranges(self):
+        cache = self.create_cache(DOWNLOAD_CONCURRENCY=4, DOWNLOAD_CHUNK_SIZE='1k')
+        with mock.patch('baiji.s3.cp') as mock_cp:
+            self.assertEqual(cache('s3://bucket/foo/bar.baz'), self.local)
+        self.assertFalse(mock_cp.called)
+        self.assert_fetched()
+        self.assertEqual(len(self.s3.requests), 1 + 10)
+
+    def test_that_cache_resumes_download(self):
+        cache = self.create_cache(REVALIDATION='head')
+        self.interrupted_stream(4000)
+
+        self.assertEqual(cache('s3://bucket/foo/bar.baz'), self.local)
+        self.assert_fetched()
+        self.assertEqual(
+            [(command, headers.get('range')) for command, _, _, headers in self.s3.requests],
+            [('HEAD', None), ('GET', 'bytes=4000-')])
+
+    def test_that_delete_removes_partial_download(self):
+        from baiji.pod.asset_cache import CacheFile
+        cache = self.create_cache()
+        partial = self.interrupted_stream(4000)
+
+        self.assertEqual(list(cache.ls()), [])
+        cache.delete('s3://bucket/foo/bar.baz')
+        self.assertFalse(os.path.exists(partial.path))
+        self.assertFalse(os.path.exists(partial.info_path))
+        self.assertEqual(CacheFile(cache, 's3://bucket/foo/bar.baz').local, self.local)
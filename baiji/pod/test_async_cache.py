@@ -0,0 +1,85 @@
+import unittest
+import os
+import mock
+from scratch_dir import ScratchDirMixin
+from baiji.pod.test_support import S3StandInMixin
+
+
+class TestAsyncCaches(S3StandInMixin, ScratchDirMixin, unittest.TestCase):
+    def setUp(self):
+        from baiji.pod import AsyncAssetCache
+        super(TestAsyncCaches, self).setUp()
+        self.cache = self.create_cache()
+        self.async_cache = AsyncAssetCache(self.cache, max_workers=2)
+        self.addCleanup(self.async_cache.shutdown)
+
+        for name in ['a', 'b', 'c', 'd']:
+            self.s3.put('bucket', 'foo/{}.txt'.format(name), name)
+
+    def test_get(self):
+        future = self.async_cache.get('s3://bucket/foo/a.txt')
+        path = future.result()
+        self.assertEqual(path, self.cache('s3://bucket/foo/a.txt'))
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), 'a')
+
+    def test_that_remembered_path_is_returned_without_a_thread(self):
+        local = self.cache('s3://bucket/foo/a.txt')
+        with mock.patch.object(self.async_cache.executor, 'submit') as mock_submit:
+            future = self.async_cache.get('s3://bucket/foo/a.txt')
+        self.assertTrue(future.done())
+        self.assertEqual(future.result(), local)
+        self.assertFalse(mock_submit.called)
+
+    def test_that_errors_are_raised_from_the_future(self):
+        from baiji import s3
+        future = self.async_cache.get('s3://bucket/not/there')
+        with self.assertRaises(s3.KeyNotFound):
+            future.result()
+
+    def test_that_concurrency_is_bounded(self):
+        import threading
+        import time
+        lock = threading.Lock()
+        running = [0]
+        most_running = [0]
+        call_cache = self.cache.__class__.__call__
+        def call(cache, *args, **kwargs):
+            with lock:
+                running[0] += 1
+                most_running[0] = max(most_running[0], running[0])
+            time.sleep(0.05)
+            try:
+                return call_cache(cache, *args, **kwargs)
+            finally:
+                with lock:
+                    running[0] -= 1
+
+        with mock.patch.object(self.cache.__class__, '__call__', call):
+            futures = [
+                self.async_cache.get('s3://bucket/foo/{}.txt'.format(name))
+                for name in ['a', 'b', 'c', 'd']]
+            results = [future.result() for future in futures]
+        self.assertEqual(len(set(results)), 4)
+        self.assertEqual(most_running[0], 2)
+
+    def test_versioned_get(self):
+        from baiji.pod import VersionedCache, AsyncVersionedCache
+        from baiji.pod.util import json
+
+        manifest_path = os.path.join(self.scratch_dir, 'manifest.json')
+        json.dump({'/foo/bar.txt': '1.2.3'}, manifest_path)
+        self.s3.put('versioned', 'foo/bar.1.2.3.txt', 'versioned contents')
+        vc = VersionedCache(cache=self.cache, manifest_path=manifest_path, bucket='versioned')
+
+        with AsyncVersionedCache(vc) as async_vc:
+            path = async_vc.get('/foo/bar.txt').result()
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), 'versioned contents')
+
+            with mock.patch.object(async_vc.executor, 'submit') as mock_submit:
+                self.assertEqual(async_vc.get('/foo/bar.txt').result(), path)
+            self.assertFalse(mock_submit.called)
+
+            with self.assertRaises(vc.KeyNotFound):
+                async_vc.get('/not/versioned.txt').result()
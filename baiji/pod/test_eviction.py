@@ -0,0 +1,202 @@
+import unittest
+import os
+import time
+import mock
+from scratch_dir import ScratchDirMixin
+from baiji.pod.test_support import S3StandInMixin
+
+
+class TestParseSize(unittest.TestCase):
+    def test_parse_size(self):
+        from baiji.pod.config import parse_size
+        self.assertIsNone(parse_size(None))
+        self.assertIsNone(parse_size(''))
+        self.assertEqual(parse_size(1000), 1000)
+        self.assertEqual(parse_size('1000'), 1000)
+        self.assertEqual(parse_size('2k'), 2048)
+        self.assertEqual(parse_size('1.5G'), 3 * 1024**3 / 2)
+        self.assertEqual(parse_size('20GB'), 20 * 1024**3)
+
+
+class TestEviction(S3StandInMixin, ScratchDirMixin, unittest.TestCase):
+    def setUp(self):
+        super(TestEviction, self).setUp()
+        self.now = time.time()
+
+    def put(self, cache, remote, size=10, hours_ago=1):
+        '''
+        Put a file of `size` bytes in the cache, last used `hours_ago`.
+        '''
+        from baiji.util.shutillib import mkdir_p
+        from baiji.pod.asset_cache import CacheFile
+        cache_file = CacheFile(cache, remote)
+        mkdir_p(os.path.dirname(cache_file.local))
+        with open(cache_file.local, 'w') as f:
+            f.write('x' * size)
+        cache_file.update_timestamp()
+        with mock.patch('time.time', return_value=self.now - 3600 * hours_ago):
+            cache.metadata.record_access(cache_file.bucket, cache_file.path)
+        return cache_file
+
+    def cached(self, cache):
+        return sorted(x.remote for x in cache.ls())
+
+    def test_that_unbounded_cache_evicts_nothing(self):
+        cache = self.create_cache()
+        self.put(cache, 's3://bucket/a')
+        self.assertEqual(cache.evict(), [])
+        self.assertEqual(self.cached(cache), ['s3://bucket/a'])
+
+    def test_lru_by_size(self):
+        cache = self.create_cache(MAX_SIZE=25)
+        self.put(cache, 's3://bucket/old', hours_ago=3)
+        self.put(cache, 's3://bucket/older', hours_ago=4)
+        self.put(cache, 's3://bucket/new', hours_ago=2)
+
+        self.assertEqual(cache.evict(), ['s3://bucket/older'])
+        self.assertEqual(self.cached(cache), ['s3://bucket/new', 's3://bucket/old'])
+        self.assertFalse(cache.metadata.get('bucket', '/older'))
+
+    def test_lru_by_entries(self):
+        cache = self.create_cache(MAX_ENTRIES=1)
+        self.put(cache, 's3://bucket/a', hours_ago=3)
+        self.put(cache, 's3://bucket/b', hours_ago=1)
+        self.put(cache, 's3://bucket/c', hours_ago=2)
+
+        self.assertEqual(cache.evict(), ['s3://bucket/a', 's3://bucket/c'])
+        self.assertEqual(self.cached(cache), ['s3://bucket/b'])
+
+    def test_lfu(self):
+        cache = self.create_cache(MAX_ENTRIES=2, EVICTION_POLICY='lfu', METADATA_STORE='index')
+        popular = self.put(cache, 's3://bucket/popular', hours_ago=3)
+        self.put(cache, 's3://bucket/unpopular', hours_ago=1)
+        self.put(cache, 's3://bucket/middling', hours_ago=2)
+        for _ in range(2):
+            cache.metadata.record_access(popular.bucket, popular.path)
+        with mock.patch('time.time', return_value=self.now - 7200):
+            cache.metadata.record_access('bucket', '/middling')
+
+        self.assertEqual(cache.evict(), ['s3://bucket/unpopular'])
+
+    def test_that_cache_within_its_limits_doesnt_look_for_open_files(self):
+        cache = self.create_cache(MAX_SIZE=25)
+        self.put(cache, 's3://bucket/a')
+        self.put(cache, 's3://bucket/b')
+        with mock.patch('baiji.pod.eviction.open_paths') as mock_open_paths:
+            self.assertEqual(cache.evict(), [])
+        self.assertFalse(mock_open_paths.called)
+
+    def test_that_indexed_sizes_are_used_without_stat(self):
+        cache = self.create_cache(MAX_SIZE=25, METADATA_STORE='index')
+        for remote, hours_ago in [('s3://bucket/old', 3), ('s3://bucket/older', 4)]:
+            cache_file = self.put(cache, remote, hours_ago=hours_ago)
+            cache_file.update_timestamp(etag='abc')
+        # Checked without an etag, so no size is recorded.
+        unsized = self.put(cache, 's3://bucket/new', hours_ago=2)
+
+        with mock.patch('os.stat', side_effect=os.stat) as mock_stat:
+            self.assertEqual(cache.evict(), ['s3://bucket/older'])
+        statted = [args[0] for args, _ in mock_stat.call_args_list]
+        self.assertIn(unsized.local, statted)
+        self.assertNotIn(cache_file.local, statted)
+
+    def test_that_pinned_and_recently_used_files_are_kept(self):
+        cache = self.create_cache(MAX_SIZE=0, PINNED=['s3://bucket/pinned/*'])
+        self.put(cache, 's3://bucket/pinned/a', hours_ago=3)
+        self.put(cache, 's3://bucket/just/used', hours_ago=0)
+        self.put(cache, 's3://bucket/evictable', hours_ago=2)
+
+        self.assertEqual(cache.evict(), ['s3://bucket/evictable'])
+        self.assertEqual(self.cached(cache), ['s3://bucket/just/used', 's3://bucket/pinned/a'])
+
+    @unittest.skipUnless(os.path.isdir('/proc'), 'open files are found using /proc')
+    def test_that_open_files_are_kept(self):
+        cache = self.create_cache(MAX_SIZE=0)
+        in_use = self.put(cache, 's3://bucket/in/use', hours_ago=3)
+        with open(in_use.local, 'r'):
+            self.assertEqual(cache.evict(), [])
+        self.assertEqual(cache.evict(), ['s3://bucket/in/use'])
+
+    def test_separate_budget_for_immutable_buckets(self):
+        cache = self.create_cache(
+            MAX_SIZE=15, IMMUTABLE_MAX_SIZE=25, IMMUTABLE_BUCKETS=['versioned'])
+        self.put(cache, 's3://bucket/a', hours_ago=6)
+        self.put(cache, 's3://bucket/b', hours_ago=5)
+        self.put(cache, 's3://versioned/a', hours_ago=4)
+        self.put(cache, 's3://versioned/b', hours_ago=3)
+        self.put(cache, 's3://versioned/c', hours_ago=2)
+
+        self.assertEqual(sorted(cache.evict()), ['s3://bucket/a', 's3://versioned/a'])
+
+    def test_that_another_eviction_in_progress_is_left_alone(self):
+        from baiji.pod.util.locking import FileLock
+        cache = self.create_cache(MAX_SIZE=0)
+        self.put(cache, 's3://bucket/a')
+        with FileLock(os.path.join(cache.settings.cache_dir, '.locks', 'evict')):
+            self.assertEqual(cache.evict(), [])
+
+    def test_that_abandoned_downloads_are_discarded(self):
+        from baiji.pod.asset_cache import CacheFile
+        from baiji.pod.eviction import ABANDONED_PERIOD
+        from baiji.pod.transfer import PartialDownload
+        cache = self.create_cache(MAX_SIZE=100)
+        self.put(cache, 's3://bucket/a')
+        abandoned = PartialDownload(CacheFile(cache, 's3://bucket/abandoned').local)
+        abandoned.start('abc', 10)
+        modified_at = self.now - ABANDONED_PERIOD
+        for path in [abandoned.path, abandoned.info_path]:
+            os.utime(path, (modified_at, modified_at))
+        recent = PartialDownload(CacheFile(cache, 's3://bucket/recent').local)
+        recent.start('abc', 10)
+
+        self.assertEqual(
+            sorted(x.remote for x in cache.partial_downloads()),
+            ['s3://bucket/abandoned', 's3://bucket/recent'])
+        self.assertEqual(cache.evict(), [])
+        self.assertFalse(os.path.exists(abandoned.path))
+        self.assertFalse(os.path.exists(abandoned.info_path))
+        self.assertTrue(os.path.exists(recent.path))
+        self.assertEqual(self.cached(cache), ['s3://bucket/a'])
+
+    def test_that_downloads_trigger_eviction(self):
+        self.s3.put('bucket', 'new', 'x' * 10)
+        cache = self.create_cache(MAX_SIZE=15)
+        self.put(cache, 's3://bucket/old', hours_ago=2)
+
+        with mock.patch('threading.Thread.start', lambda thread: thread.run()):
+            cache('s3://bucket/new')
+        self.assertEqual(self.cached(cache), ['s3://bucket/new'])
+
+    def test_that_eviction_after_downloads_is_rate_limited(self):
+        from baiji.pod.asset_cache import EVICTION_INTERVAL
+        for name in ['a', 'b', 'c']:
+            self.s3.put('bucket', name, 'x' * 10)
+
+        cache = self.create_cache(MAX_SIZE=100)
+        with mock.patch('threading.Thread.start', lambda thread: thread.run()), \
+                mock.patch.object(cache, 'evict') as mock_evict:
+            cache('s3://bucket/a')
+            cache('s3://bucket/b')
+            self.assertEqual(mock_evict.call_count, 1)
+            with mock.patch('time.time', return_value=time.time() + EVICTION_INTERVAL):
+                cache('s3://bucket/c')
+            self.assertEqual(mock_evict.call_count, 2)
+
+    def test_that_remembered_files_are_kept_in_use(self):
+        from baiji.pod.asset_cache import ACCESS_RECORD_INTERVAL, CacheFile
+        cache = self.create_cache(MAX_SIZE=100, TIMEOUT=3600)
+        cache_file = self.put(cache, 's3://bucket/hot', hours_ago=2)
+        cache('s3://bucket/hot')
+
+        with mock.patch.object(cache.metadata, 'record_access') as mock_record_access:
+            self.assertEqual(cache('s3://bucket/hot'), cache_file.local)
+            self.assertFalse(mock_record_access.called)
+            later = time.time() + ACCESS_RECORD_INTERVAL
+            with mock.patch('time.time', return_value=later):
+                self.assertEqual(cache('s3://bucket/hot'), cache_file.local)
+                self.assertEqual(cache('s3://bucket/hot'), cache_file.local)
+        mock_record_access.assert_called_once_with('bucket', '/hot')
+
+        # Evicted by another process.
+        CacheFile(cache, 's3://bucket/hot').remove_cached()
+        self.assertIsNone(cache.remembered('s3://bucket/hot'))
@@ -0,0 +1,211 @@
+import unittest
+import os
+import mock
+from scratch_dir import ScratchDirMixin
+from baiji.pod.test_support import S3StandInMixin
+
+
+class TestIndexMetadataStore(ScratchDirMixin, unittest.TestCase):
+    def setUp(self):
+        from baiji.pod.metadata import IndexMetadataStore
+        super(TestIndexMetadataStore, self).setUp()
+        self.cache_dir = os.path.join(self.scratch_dir, 'cache')
+        self.store = IndexMetadataStore(self.cache_dir)
+
+    def test_touch_and_get(self):
+        self.assertIsNone(self.store.get('bucket', '/foo/bar.baz'))
+
+        self.store.touch('bucket', '/foo/bar.baz')
+        entry = self.store.get('bucket', '/foo/bar.baz')
+        self.assertIsNotNone(entry.checked_at)
+        self.assertIsNone(entry.etag)
+        self.assertIsNone(self.store.recorded_etag('bucket', '/foo/bar.baz'))
+
+        self.store.touch('bucket', '/foo/bar.baz', etag='abc', size=12, mtime=1234.5)
+        self.assertEqual(self.store.recorded_etag('bucket', '/foo/bar.baz'), ('abc', 12, 1234.5))
+
+        # The etag is kept when the file is checked again.
+        self.store.invalidate('bucket', '/foo/bar.baz')
+        self.store.touch('bucket', '/foo/bar.baz')
+        entry = self.store.get('bucket', '/foo/bar.baz')
+        self.assertIsNotNone(entry.checked_at)
+        self.assertEqual((entry.etag, entry.size, entry.mtime), ('abc', 12, 1234.5))
+
+    def test_get_many(self):
+        paths = ['/foo/{}'.format(i) for i in range(1200)]
+        self.store.touch_many([('bucket', path, 'etag', 1, 1.0) for path in paths[::2]])
+        self.store.touch('other', '/foo/1')
+        entries = self.store.get_many(
+            [('bucket', path) for path in paths] + [('other', '/foo/1'), ('other', '/foo/2')])
+        self.assertEqual(
+            sorted(entries),
+            sorted([('bucket', path) for path in paths[::2]] + [('other', '/foo/1')]))
+        self.assertEqual(entries[('bucket', '/foo/0')], self.store.get('bucket', '/foo/0'))
+
+    def test_that_access_is_recorded_and_kept(self):
+        self.store.touch('bucket', '/foo/bar.baz')
+        self.assertEqual(self.store.access_stats(), {})
+
+        with mock.patch('time.time', return_value=1000.0):
+            self.store.record_access('bucket', '/foo/bar.baz')
+        self.store.record_access('bucket', '/not/cached')
+        self.assertEqual(self.store.access_stats(), {('bucket', '/foo/bar.baz'): (1000.0, 1)})
+
+        # Checking the file again doesn't reset them.
+        self.store.touch('bucket', '/foo/bar.baz')
+        self.store.touch_many([('bucket', '/foo/bar.baz', 'abc', 12, 1234.5)])
+        self.assertEqual(self.store.access_stats(), {('bucket', '/foo/bar.baz'): (1000.0, 1)})
+
+    def test_invalidate_and_remove(self):
+        self.store.touch('bucket', '/foo/bar.baz')
+        self.store.invalidate('bucket', '/foo/bar.baz')
+        self.assertIsNone(self.store.get('bucket', '/foo/bar.baz').checked_at)
+        self.store.remove('bucket', '/foo/bar.baz')
+        self.assertIsNone(self.store.get('bucket', '/foo/bar.baz'))
+
+    def test_invalidate_tree(self):
+        paths = ['/foo/a', '/foo/b/c', '/foo.txt', '/foobar/d', '/other']
+        for path in paths:
+            self.store.touch('bucket', path)
+        self.store.touch('other-bucket', '/foo/a')
+
+        self.store.invalidate_tree('bucket', '/foo')
+
+        checked = dict(
+            (path, self.store.get('bucket', path).checked_at is not None) for path in paths)
+        self.assertEqual(checked, {
+            '/foo/a': False,
+            '/foo/b/c': False,
+            '/foo.txt': True,
+            '/foobar/d': True,
+            '/other': True,
+        })
+        self.assertIsNotNone(self.store.get('other-bucket', '/foo/a').checked_at)
+
+    def test_import_timestamps(self):
+        from baiji.pod.metadata import TimestampMetadataStore, timestamp_file
+        from baiji.util.shutillib import mkdir_p
+
+        timestamps = TimestampMetadataStore(self.cache_dir)
+        for path in ['/foo/cached.txt', '/foo/not_cached.txt']:
+            timestamps.touch('bucket', path)
+        local = os.path.join(self.cache_dir, 'bucket', 'foo', 'cached.txt')
+        mkdir_p(os.path.dirname(local))
+        with open(local, 'w') as f:
+            f.write('cached')
+
+        self.assertEqual(self.store.import_timestamps(), 1)
+
+        entry = self.store.get('bucket', '/foo/cached.txt')
+        self.assertEqual(entry.size, len('cached'))
+        self.assertIsNotNone(entry.checked_at)
+        self.assertIsNone(self.store.get('bucket', '/foo/not_cached.txt'))
+        self.assertFalse(os.path.exists(
+            timestamp_file(self.cache_dir, 'bucket', '/foo/cached.txt')))
+
+
+class TestTimestampMetadataStore(ScratchDirMixin, unittest.TestCase):
+    def test_recorded_etag(self):
+        from baiji.pod.metadata import TimestampMetadataStore
+        store = TimestampMetadataStore(self.scratch_dir)
+
+        store.touch('bucket', '/foo/bar.baz')
+        self.assertIsNone(store.recorded_etag('bucket', '/foo/bar.baz'))
+
+        store.touch('bucket', '/foo/bar.baz', etag='abc', size=12, mtime=1234.5)
+        self.assertEqual(store.recorded_etag('bucket', '/foo/bar.baz'), ('abc', 12, 1234.5))
+
+        # The etag is kept when the file is checked again.
+        store.touch('bucket', '/foo/bar.baz')
+        self.assertEqual(store.recorded_etag('bucket', '/foo/bar.baz'), ('abc', 12, 1234.5))
+
+
+class TestAssetCacheWithIndex(S3StandInMixin, ScratchDirMixin, unittest.TestCase):
+    def setUp(self):
+        super(TestAssetCacheWithIndex, self).setUp()
+        self.cache = self.create_cache(REVALIDATION='head', METADATA_STORE='index')
+
+    def test_that_fresh_file_needs_no_request(self):
+        cf = self.put_in_cache('s3://bucket/foo/bar.baz', 'contents')
+
+        with mock.patch('baiji.s3.etag') as mock_etag, \
+                mock.patch('baiji.pod.transfer.fetch') as mock_fetch:
+            self.assertEqual(self.cache('s3://bucket/foo/bar.baz'), cf.local)
+        self.assertFalse(mock_etag.called)
+        self.assertFalse(mock_fetch.called)
+        self.assertFalse(os.path.exists(cf.timestamp_file))
+
+    def test_that_entry_for_missing_file_is_a_miss(self):
+        from baiji.pod.asset_cache import CacheFile
+
+        cf = self.put_in_cache('s3://bucket/foo/bar.baz', 'contents')
+        os.remove(cf.local)
+
+        self.assertFalse(CacheFile(self.cache, 's3://bucket/foo/bar.baz').is_cached)
+        self.assertIsNone(self.cache.metadata.get(cf.bucket, cf.path))
+
+    def test_invalidate(self):
+        from baiji.pod.asset_cache import CacheFile
+        from baiji.util.shutillib import mkdir_p
+
+        cf = CacheFile(self.cache, 's3://bucket/foo/bar.baz')
+        mkdir_p(os.path.dirname(cf.local))
+        self.cache.metadata.touch(cf.bucket, cf.path)
+
+        self.cache.invalidate('s3://bucket/foo')
+        self.assertTrue(CacheFile(self.cache, 's3://bucket/foo/bar.baz').is_outdated)
+
+    def put_in_cache(self, remote, contents, etag=None):
+        from baiji.pod.asset_cache import CacheFile
+        from baiji.util.shutillib import mkdir_p
+        cf = CacheFile(self.cache, remote)
+        mkdir_p(os.path.dirname(cf.local))
+        with open(cf.local, 'w') as f:
+            f.write(contents)
+        cf.update_timestamp(etag=etag)
+        return cf
+
+    def test_that_ls_reads_the_index(self):
+        self.put_in_cache('s3://bucket/foo/b.txt', 'bbb', etag='abc')
+        self.put_in_cache('s3://bucket/foo/a.txt', 'a', etag='def')
+
+        with mock.patch('os.walk') as mock_walk:
+            with mock.patch('os.stat') as mock_stat:
+                listing = [(x.remote, x.size, x.is_outdated) for x in self.cache.ls()]
+        self.assertFalse(mock_walk.called)
+        self.assertFalse(mock_stat.called)
+        self.assertEqual(listing, [
+            ('s3://bucket/foo/a.txt', 1, False),
+            ('s3://bucket/foo/b.txt', 3, False),
+        ])
+
+    def test_rebuild_index(self):
+        unchanged = self.put_in_cache('s3://bucket/unchanged.txt', 'same', etag='abc')
+        changed = self.put_in_cache('s3://bucket/changed.txt', 'before', etag='def')
+        gone = self.put_in_cache('s3://bucket/gone.txt', 'gone', etag='ghi')
+        os.remove(gone.local)
+        with open(changed.local, 'w') as f:
+            f.write('after, and longer')
+        unindexed = self.put_in_cache('s3://bucket/unindexed.txt', 'new')
+        self.cache.metadata.remove(unindexed.bucket, unindexed.path)
+
+        self.assertEqual(self.cache.rebuild_index(), (1, 1, 1))
+
+        self.assertEqual([x.remote for x in self.cache.ls()], [
+            's3://bucket/changed.txt',
+            's3://bucket/unchanged.txt',
+            's3://bucket/unindexed.txt',
+        ])
+        self.assertEqual(
+            self.cache.metadata.recorded_etag(unchanged.bucket, unchanged.path)[0], 'abc')
+        self.assertIsNone(self.cache.metadata.recorded_etag(changed.bucket, changed.path))
+        self.assertEqual(self.cache.metadata.get(changed.bucket, changed.path).size, 17)
+        self.assertIsNone(self.cache.metadata.get(unindexed.bucket, unindexed.path).checked_at)
+
+        self.assertEqual(self.cache.rebuild_index(), (0, 0, 0))
+
+    def test_that_rebuild_needs_the_index(self):
+        self.cache.config.METADATA_STORE = 'timestamps'
+        self.cache.refresh_config()
+        with self.assertRaises(ValueError):
+            self.cache.rebuild_index()
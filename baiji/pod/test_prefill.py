@@ -0,0 +1,263 @@
+import unittest
+import os
+import mock
+from scratch_dir import ScratchDirMixin
+from baiji.pod.test_support import S3StandInMixin
+
+
+class TestPrefill(S3StandInMixin, ScratchDirMixin, unittest.TestCase):
+    def setUp(self):
+        from baiji.pod import VersionedCache
+        from baiji.pod.util import json
+        super(TestPrefill, self).setUp()
+        self.cache = self.create_cache()
+
+        manifest_path = os.path.join(self.scratch_dir, 'manifest.json')
+        json.dump({'/versioned.txt': '1.0.0', '/gone.txt': '1.0.0'}, manifest_path)
+        self.vc = VersionedCache(cache=self.cache, manifest_path=manifest_path, bucket='vc')
+
+        self.s3.put('vc', 'versioned.1.0.0.txt', 'versioned')
+        for i in range(5):
+            self.s3.put('bucket', 'foo/{}.txt'.format(i), str(i))
+        self.paths = ['s3://bucket/foo/{}.txt'.format(i) for i in range(5)]
+        self.paths += ['/versioned.txt', '/gone.txt', 's3://bucket/not/there.txt']
+        self.uris = [
+            's3://bucket/foo/{}.txt'.format(i) for i in range(5)] + [
+                's3://vc/versioned.1.0.0.txt', 's3://vc/gone.1.0.0.txt',
+                's3://bucket/not/there.txt']
+
+    def prefill(self, **kwargs):
+        from StringIO import StringIO
+        from baiji.pod.prefill import prefill
+        with mock.patch('sys.stdout'):
+            return prefill(self.cache, self.vc, self.paths, progress_stream=StringIO(), **kwargs)
+
+    def test_prefill(self):
+        from baiji.pod.asset_cache import CacheFile
+        from baiji.pod.util import json
+        self.cache('s3://bucket/foo/0.txt')
+
+        summary = self.prefill()
+
+        for i in range(5):
+            self.assertTrue(CacheFile(self.cache, 's3://bucket/foo/{}.txt'.format(i)).is_cached)
+        self.assertTrue(CacheFile(self.cache, 's3://vc/versioned.1.0.0.txt').is_cached)
+        self.assertEqual(json.loads(json.dumps(summary)), summary)
+        self.assertEqual(
+            {key: value for key, value in summary.items() if not key.endswith('seconds')}, {
+                'files': 8,
+                'current': 1,
+                'revalidated': 0,
+                'downloaded': 5,
+                'failed': 2,
+                'bytes_downloaded': 13,
+                'bytes_per_second': summary['bytes_per_second'],
+                'failures': {
+                    's3://bucket/not/there.txt': 'Not found',
+                    's3://vc/gone.1.0.0.txt': 'Not found',
+                },
+            })
+
+    def test_that_downloads_are_made_by_threads_at_most_concurrency_at_a_time(self):
+        import threading
+        import time
+        from baiji.pod.asset_cache import CacheFile
+        lock = threading.Lock()
+        running = set()
+        most_running = [0]
+        download = CacheFile.download
+        def slow_download(cache_file, verbose=True):
+            with lock:
+                running.add(cache_file.remote)
+                most_running[0] = max(most_running[0], len(running))
+            time.sleep(0.05)
+            try:
+                download(cache_file, verbose=verbose)
+            finally:
+                with lock:
+                    running.discard(cache_file.remote)
+
+        with mock.patch('os.fork') as mock_fork, \
+                mock.patch.object(CacheFile, 'download', slow_download):
+            self.prefill(concurrency=3)
+        self.assertEqual(most_running[0], 3)
+        self.assertFalse(mock_fork.called)
+
+    def test_deprecated_num_processes(self):
+        from multiprocessing.pool import ThreadPool
+        with mock.patch('multiprocessing.pool.ThreadPool', wraps=ThreadPool) as mock_pool:
+            self.prefill(num_processes=2)
+        mock_pool.assert_called_once_with(2)
+
+    def test_that_current_files_are_skipped(self):
+        from baiji.pod.prefill import plan
+        self.prefill()
+        del self.s3.requests[:]
+        self.cache.refresh_config()
+        prefill_plan = plan(self.cache, self.uris)
+        self.assertEqual(len(prefill_plan.current), 6)
+        self.assertEqual(prefill_plan.downloads, [])
+        # The missing files are listed, but nothing else is requested.
+        self.assertEqual(
+            [(method, bucket) for method, bucket, _, _ in self.s3.requests],
+            [('GET', 'bucket'), ('GET', 'vc')])
+
+    def test_that_outdated_files_are_revalidated_in_bulk(self):
+        self.prefill()
+        self.cache.invalidate_all()
+        self.cache.refresh_config()
+        del self.s3.requests[:]
+        self.prefill()
+        # Revalidation lists foo/ and the versioned file, and the missing
+        # files are listed again. Nothing is downloaded.
+        self.assertEqual(len(self.s3.requests), 4)
+        self.assertTrue(all(key == '' for _, _, key, _ in self.s3.requests))
+
+    def test_plan(self):
+        from baiji.pod.prefill import plan
+        self.s3.put('bucket', 'foo/2.txt', 'x' * 1000)
+        self.s3.put('bucket', 'foo/4.txt', 'x' * 100)
+        self.cache('s3://bucket/foo/0.txt')
+        self.cache.invalidate('s3://bucket/foo/0.txt')
+        self.cache('s3://bucket/foo/1.txt')
+
+        prefill_plan = plan(self.cache, self.uris)
+
+        self.assertEqual(prefill_plan.current, ['s3://bucket/foo/1.txt'])
+        self.assertEqual(prefill_plan.revalidated, ['s3://bucket/foo/0.txt'])
+        self.assertEqual(prefill_plan.downloads, [
+            ('s3://bucket/foo/2.txt', 1000),
+            ('s3://bucket/foo/4.txt', 100),
+            ('s3://vc/versioned.1.0.0.txt', 9),
+            ('s3://bucket/foo/3.txt', 1),
+        ])
+        self.assertEqual(prefill_plan.download_size, 1110)
+        self.assertEqual(
+            sorted(prefill_plan.not_found), ['s3://bucket/not/there.txt', 's3://vc/gone.1.0.0.txt'])
+        self.assertEqual(
+            prefill_plan.summary(),
+            'Prefill plan: 1 current, 1 revalidated, 4 to download (1.1kb), 2 not found')
+
+    def test_dry_run(self):
+        from baiji.pod.asset_cache import CacheFile
+        from baiji.pod.prefill import dry_run
+        self.cache('s3://bucket/foo/0.txt')
+        self.cache('s3://bucket/foo/1.txt')
+        self.cache('s3://bucket/foo/2.txt')
+        self.cache.invalidate('s3://bucket/foo/1.txt')
+        self.cache.invalidate('s3://bucket/foo/2.txt')
+        self.s3.put('bucket', 'foo/2.txt', 'changed')
+        del self.s3.requests[:]
+
+        with mock.patch('sys.stdout') as mock_stdout:
+            prefill_plan = dry_run(self.cache, self.vc, self.paths)
+        output = ''.join(call[0][0] for call in mock_stdout.write.call_args_list)
+
+        self.assertEqual(prefill_plan.current, ['s3://bucket/foo/0.txt'])
+        self.assertEqual(prefill_plan.revalidated, ['s3://bucket/foo/1.txt'])
+        self.assertEqual(prefill_plan.outdated, ['s3://bucket/foo/2.txt'])
+        self.assertEqual(prefill_plan.downloads[0], ('s3://vc/versioned.1.0.0.txt', 9))
+        self.assertEqual(prefill_plan.download_size, 9 + 7 + 1 + 1)
+        self.assertIn('outdated   s3://bucket/foo/2.txt (7.0b)', output)
+        self.assertIn('missing    s3://bucket/foo/3.txt (1.0b)', output)
+        self.assertIn('not found  s3://bucket/not/there.txt', output)
+        # Only listings were requested, and the cache is as it was.
+        self.assertTrue(all(key == '' for _, _, key, _ in self.s3.requests))
+        self.assertTrue(CacheFile(self.cache, 's3://bucket/foo/1.txt').is_outdated)
+        self.assertFalse(CacheFile(self.cache, 's3://bucket/foo/3.txt').is_cached)
+
+    def test_that_plan_looks_up_metadata_in_bulk(self):
+        from baiji.pod.prefill import plan
+        self.cache.config.METADATA_STORE = 'index'
+        self.cache.refresh_config()
+        self.prefill()
+        self.cache.invalidate('s3://bucket/foo/1.txt')
+        metadata = self.cache.metadata
+        with mock.patch.object(metadata, 'get', side_effect=AssertionError), \
+                mock.patch.object(metadata, 'recorded_etag', side_effect=AssertionError), \
+                mock.patch.object(metadata, 'get_many', wraps=metadata.get_many) as mock_get_many:
+            prefill_plan = plan(self.cache, self.uris, dry_run=True)
+        self.assertEqual(mock_get_many.call_count, 1)
+        self.assertEqual(prefill_plan.revalidated, ['s3://bucket/foo/1.txt'])
+
+    def test_that_downloads_start_largest_first(self):
+        self.s3.put('bucket', 'foo/3.txt', 'x' * 1000)
+        self.s3.put('bucket', 'foo/1.txt', 'x' * 100)
+        self.prefill(concurrency=1)
+        downloaded = [
+            key for method, _, key, _ in self.s3.requests if method == 'GET' and key]
+        self.assertEqual(downloaded, [
+            'foo/3.txt', 'foo/1.txt', 'versioned.1.0.0.txt', 'foo/0.txt', 'foo/2.txt', 'foo/4.txt'])
+
+    def test_that_summary_on_stdout_is_all_that_is_there(self):
+        from StringIO import StringIO
+        from baiji.pod.runners.prefill_runner import PrefillRunner
+        from baiji.pod.util import json
+        from baiji.pod.util import yaml
+        paths_file = os.path.join(self.scratch_dir, 'prefill.yaml')
+        yaml.dump(self.paths, paths_file)
+        runner = PrefillRunner(
+            self.cache, default_vc_manifest_path=self.vc.manifest_path, default_vc_bucket='vc')
+
+        stdout, stderr = StringIO(), StringIO()
+        with mock.patch('sys.argv', ['baiji-prefill', paths_file, '--summary', '-']), \
+                mock.patch('sys.stdout', stdout), mock.patch('sys.stderr', stderr):
+            runner.main()
+        self.assertEqual(json.loads(stdout.getvalue())['downloaded'], 6)
+        self.assertIn('sc prefill done', stderr.getvalue())
+
+
+class TestPrefillProgress(unittest.TestCase):
+    def setUp(self):
+        from StringIO import StringIO
+        from baiji.pod.prefill import PrefillPlan
+        self.now = 1000.0
+        patcher = mock.patch('time.time', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.stream = StringIO()
+        self.plan = PrefillPlan(
+            current=['s3://bucket/current'], revalidated=[], outdated=[],
+            downloads=[('s3://bucket/a', 3000), ('s3://bucket/b', 1000), ('s3://bucket/c', 1000)],
+            not_found=[])
+
+    def create_progress(self, interactive):
+        from baiji.pod.prefill import PrefillProgress
+        self.stream.isatty = lambda: interactive
+        return PrefillProgress(self.plan, stream=self.stream, interval=10)
+
+    def test_progress(self):
+        progress = self.create_progress(interactive=True)
+        self.now += 2
+        progress('s3://bucket/a', '/local/a', None)
+        self.assertEqual(progress.rate, 1500)
+        self.assertAlmostEqual(progress.eta, 2000 / 1500.)
+        self.now += 1
+        progress('s3://bucket/b', None, IOError('Oops'))
+        self.assertEqual(
+            self.stream.getvalue().split('\r')[-1],
+            'Prefill: 2/3 files, 2.9kb/4.9kb, 1000.0b/s, ETA 2s, 1 failed')
+
+        progress('s3://bucket/c', '/local/c', None)
+        progress.finish()
+        summary = progress.summary()
+        self.assertEqual(summary['downloaded'], 2)
+        self.assertEqual(summary['failures'], {'s3://bucket/b': 'Oops'})
+        self.assertEqual(summary['bytes_downloaded'], 4000)
+        self.assertTrue(self.stream.getvalue().endswith('\n'))
+
+    def test_that_reports_to_logs_are_spaced_out(self):
+        progress = self.create_progress(interactive=False)
+        progress('s3://bucket/a', '/local/a', None)
+        self.now += 5
+        progress('s3://bucket/b', '/local/b', None)
+        self.now += 5
+        progress('s3://bucket/c', '/local/c', None)
+        progress.finish()
+        self.assertEqual(len(self.stream.getvalue().splitlines()), 3)
+
+    def test_format_duration(self):
+        from baiji.pod.prefill import format_duration
+        self.assertEqual(format_duration(45.2), '45s')
+        self.assertEqual(format_duration(200), '3m20s')
+        self.assertEqual(format_duration(3900), '1h05m')
@@ -0,0 +1,203 @@
+'''
+Support shared by the tests: a local stand-in for s3, for testing the code
+which talks to it through `baiji.pod.transfer`.
+'''
+import os
+import mock
+
+
+class S3StandIn(object):
+    '''
+    A minimal local stand-in for S3, which serves objects from memory over
+    HTTP. It understands GET and HEAD, including `If-None-Match`, `If-Match`,
+    and `Range` headers, and paginated bucket listings, which is enough to
+    exercise `baiji.pod.transfer`.
+
+    Use `bucket(name)` to get a boto bucket connected to it, and `requests`
+    to see what was asked for. Set `drops` to have that many of the next
+    GETs hang up halfway through the body.
+    '''
+    def __init__(self, page_size=1000, delay=0):
+        self.objects = {}
+        self.requests = []
+        self.page_size = page_size
+        self.delay = delay
+        self.drops = 0
+
+    def put(self, bucket, key, contents, etag=None):
+        import hashlib
+        if etag is None:
+            etag = hashlib.md5(contents).hexdigest()
+        self.objects[(bucket, key)] = (contents, etag)
+
+    def start(self):
+        import socket
+        import sys
+        import threading
+        from BaseHTTPServer import HTTPServer
+        from SocketServer import ThreadingMixIn
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+            def handle_error(self, request, client_address):
+                # Clients may hang up without reading the response. This can
+                # happen as the interpreter shuts down, so nothing is
+                # imported here.
+                if not isinstance(sys.exc_info()[1], socket.error):
+                    HTTPServer.handle_error(self, request, client_address)
+
+        self.server = Server(('127.0.0.1', 0), self._handler_class())
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def bucket(self, name):
+        from boto.s3.connection import S3Connection, OrdinaryCallingFormat
+        connection = S3Connection(
+            aws_access_key_id='stand-in',
+            aws_secret_access_key='stand-in',
+            host='127.0.0.1',
+            port=self.server.server_address[1],
+            is_secure=False,
+            calling_format=OrdinaryCallingFormat())
+        return connection.get_bucket(name, validate=False)
+
+    def _handler_class(self):
+        import re
+        from BaseHTTPServer import BaseHTTPRequestHandler
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args): # pylint: disable=arguments-differ
+                pass
+
+            def do_HEAD(self): # pylint: disable=invalid-name
+                self.respond(send_body=False)
+
+            def do_GET(self): # pylint: disable=invalid-name
+                import time
+                time.sleep(stand_in.delay)
+                self.respond(send_body=True)
+
+            def respond(self, send_body):
+                import urllib
+                import urlparse
+                path, _, query = self.path.partition('?')
+                bucket, _, key = urllib.unquote(path).lstrip('/').partition('/')
+                stand_in.requests.append((self.command, bucket, key, dict(self.headers)))
+                if not key:
+                    return self.send_listing(bucket, dict(urlparse.parse_qsl(query)))
+                try:
+                    contents, etag = stand_in.objects[(bucket, key)]
+                except KeyError:
+                    return self.send_empty(404)
+                if self.headers.get('If-None-Match') == '"{}"'.format(etag):
+                    return self.send_empty(304)
+                if self.headers.get('If-Match', '"{}"'.format(etag)) != '"{}"'.format(etag):
+                    return self.send_empty(412)
+                status, start, end = 200, 0, len(contents)
+                match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+                if match:
+                    status, start = 206, int(match.group(1))
+                    if match.group(2):
+                        end = min(end, int(match.group(2)) + 1)
+                body = contents[start:end]
+                self.send_response(status)
+                self.send_header('ETag', '"{}"'.format(etag))
+                self.send_header('Content-Length', str(len(body)))
+                if status == 206:
+                    self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                        start, end - 1, len(contents)))
+                self.end_headers()
+                if send_body and stand_in.drops:
+                    stand_in.drops -= 1
+                    self.wfile.write(body[:len(body) / 2])
+                    self.close_connection = 1
+                elif send_body:
+                    self.wfile.write(body)
+
+            def send_listing(self, bucket, query):
+                from xml.sax.saxutils import escape
+                prefix = query.get('prefix', '')
+                delimiter = query.get('delimiter', '')
+                marker = query.get('marker', '')
+                contents, common_prefixes = [], set()
+                for (b, key), (body, etag) in sorted(stand_in.objects.items()):
+                    if b != bucket or not key.startswith(prefix) or key <= marker:
+                        continue
+                    rest = key[len(prefix):]
+                    if delimiter and delimiter in rest:
+                        common_prefixes.add(prefix + rest.split(delimiter)[0] + delimiter)
+                    else:
+                        contents.append((key, etag, len(body)))
+                is_truncated = len(contents) > stand_in.page_size
+                contents = contents[:stand_in.page_size]
+                xml = ['<?xml version="1.0" encoding="UTF-8"?>',
+                       '<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">',
+                       '<Name>{}</Name>'.format(escape(bucket)),
+                       '<Prefix>{}</Prefix>'.format(escape(prefix)),
+                       '<IsTruncated>{}</IsTruncated>'.format('true' if is_truncated else 'false')]
+                for key, etag, size in contents:
+                    xml.append(
+                        '<Contents><Key>{}</Key><ETag>"{}"</ETag><Size>{}</Size>'.format(
+                            escape(key), etag, size) +
+                        '<LastModified>2017-01-01T00:00:00.000Z</LastModified></Contents>')
+                if not is_truncated:
+                    for common_prefix in sorted(common_prefixes):
+                        xml.append('<CommonPrefixes><Prefix>{}</Prefix></CommonPrefixes>'.format(
+                            escape(common_prefix)))
+                xml.append('</ListBucketResult>')
+                body = ''.join(xml)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/xml')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def send_empty(self, status):
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+        return Handler
+
+
+class S3StandInMixin(object):
+    '''
+    Route `baiji.pod.transfer` to a local S3StandIn, at `self.s3`, and take
+    the internet to be reachable. Use with ScratchDirMixin.
+    '''
+    def setUp(self):
+        super(S3StandInMixin, self).setUp()
+        self.s3 = S3StandIn()
+        self.s3.start()
+        patcher = mock.patch('baiji.pod.transfer.connect_bucket', side_effect=self.s3.bucket)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.s3.stop)
+        patcher = mock.patch('baiji.pod.util.reachability.assert_internet_reachable')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def create_cache(self, **settings):
+        '''
+        Return a quiet AssetCache in the scratch directory, which uses
+        conditional revalidation unless `settings` say otherwise. Each of
+        `settings` is set on its config.
+        '''
+        from baiji.pod import AssetCache
+        from baiji.pod.config import Config
+        config = Config()
+        config.CACHE_DIR = os.path.join(self.scratch_dir, 'cache')
+        config.REVALIDATION = 'conditional'
+        config.VERBOSE = False
+        for name, value in settings.items():
+            setattr(config, name, value)
+        return AssetCache(config)
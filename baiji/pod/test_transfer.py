@@ -0,0 +1,231 @@
+import unittest
+import os
+import mock
+from scratch_dir import ScratchDirMixin
+from baiji.pod.test_support import S3StandInMixin
+
+
+class TestFetch(S3StandInMixin, ScratchDirMixin, unittest.TestCase):
+    def setUp(self):
+        super(TestFetch, self).setUp()
+        self.contents = 'some contents' * 1000
+        self.s3.put('bucket', 'foo/bar.baz', self.contents)
+        self.local = os.path.join(self.scratch_dir, 'bucket', 'foo', 'bar.baz')
+
+    def test_fetch(self):
+        import hashlib
+        from baiji.pod.transfer import fetch
+
+        etag = fetch('s3://bucket/foo/bar.baz', self.local)
+        self.assertEqual(etag, hashlib.md5(self.contents).hexdigest())
+        with open(self.local, 'rb') as f:
+            self.assertEqual(f.read(), self.contents)
+        self.assertEqual(os.listdir(os.path.dirname(self.local)), ['bar.baz'])
+
+    def test_conditional_fetch(self):
+        from baiji.pod.transfer import fetch
+        etag = fetch('s3://bucket/foo/bar.baz', self.local)
+        self.assertIsNone(fetch('s3://bucket/foo/bar.baz', self.local, if_none_match=etag))
+
+        self.s3.put('bucket', 'foo/bar.baz', 'new contents')
+        self.assertIsNotNone(fetch('s3://bucket/foo/bar.baz', self.local, if_none_match=etag))
+        with open(self.local, 'rb') as f:
+            self.assertEqual(f.read(), 'new contents')
+        self.assertEqual([command for command, _, _, _ in self.s3.requests], ['GET'] * 3)
+
+    def test_missing_key(self):
+        from baiji import s3
+        from baiji.pod.transfer import fetch
+        with self.assertRaises(s3.KeyNotFound):
+            fetch('s3://bucket/nothing/here', self.local)
+        self.assertFalse(os.path.exists(os.path.dirname(self.local)) and
+                         os.listdir(os.path.dirname(self.local)))
+
+    def test_ranged_fetch(self):
+        import hashlib
+        from baiji.pod.transfer import fetch
+
+        etag = fetch('s3://bucket/foo/bar.baz', self.local, chunk_size=1000, concurrency=4)
+        self.assertEqual(etag, hashlib.md5(self.contents).hexdigest())
+        with open(self.local, 'rb') as f:
+            self.assertEqual(f.read(), self.contents)
+        self.assertEqual(os.listdir(os.path.dirname(self.local)), ['bar.baz'])
+
+        # One GET which is abandoned, and then one per range.
+        self.assertEqual(len(self.s3.requests), 1 + 13)
+        ranges = sorted(
+            (headers['range'], headers['if-match']) for _, _, _, headers in self.s3.requests[1:])
+        self.assertEqual(ranges[0], ('bytes=0-999', '"{}"'.format(etag)))
+        self.assertEqual(ranges[-1], ('bytes=9000-9999', '"{}"'.format(etag)))
+
+    def test_that_small_files_are_fetched_in_one_request(self):
+        from baiji.pod.transfer import fetch
+        fetch('s3://bucket/foo/bar.baz', self.local, chunk_size=len(self.contents), concurrency=4)
+        self.assertEqual(len(self.s3.requests), 1)
+
+    def test_ranged_fetch_with_multipart_etag(self):
+        import hashlib
+        from baiji.pod.transfer import fetch
+        # S3's smallest part size.
+        part_size = 5 * 1024 * 1024
+        contents = os.urandom(part_size + 1000)
+        parts = [contents[:part_size], contents[part_size:]]
+        etag = hashlib.md5(''.join(hashlib.md5(x).digest() for x in parts)).hexdigest() + '-2'
+        self.s3.put('bucket', 'foo/bar.baz', contents, etag=etag)
+
+        self.assertEqual(
+            fetch('s3://bucket/foo/bar.baz', self.local, chunk_size=1024*1024, concurrency=4),
+            etag)
+        with open(self.local, 'rb') as f:
+            self.assertEqual(f.read(), contents)
+
+    def test_that_corrupted_ranged_fetch_is_discarded(self):
+        from baiji.exceptions import get_transient_error_class
+        from baiji.pod.transfer import fetch
+        self.s3.put('bucket', 'foo/bar.baz', self.contents, etag='0' * 32)
+        with self.assertRaises(get_transient_error_class()):
+            fetch('s3://bucket/foo/bar.baz', self.local, chunk_size=1000, concurrency=4)
+        self.assertEqual(os.listdir(os.path.dirname(self.local)), [])
+
+    def test_that_corrupted_fetch_is_tried_again_once(self):
+        from baiji.exceptions import get_transient_error_class
+        from baiji.pod.transfer import fetch
+        self.s3.put('bucket', 'foo/bar.baz', self.contents, etag='0' * 32)
+        with self.assertRaises(get_transient_error_class()):
+            fetch('s3://bucket/foo/bar.baz', self.local)
+        self.assertEqual([command for command, _, _, _ in self.s3.requests], ['GET'] * 2)
+        self.assertEqual(os.listdir(os.path.dirname(self.local)), [])
+
+    def test_that_dropped_connection_is_tried_again(self):
+        from baiji.pod.transfer import fetch
+        self.s3.drops = 1
+        fetch('s3://bucket/foo/bar.baz', self.local)
+        with open(self.local, 'rb') as f:
+            self.assertEqual(f.read(), self.contents)
+        self.assertEqual([command for command, _, _, _ in self.s3.requests], ['GET'] * 2)
+
+    def test_that_server_error_is_tried_again(self):
+        import socket
+        from boto.exception import S3ResponseError
+        from baiji.pod import transfer
+        open_key = transfer._open_key # pylint: disable=protected-access
+        errors = [S3ResponseError(503, 'Slow Down'), socket.error('Connection reset')]
+        def flaky_open_key(remote, headers=None):
+            if errors:
+                raise errors.pop(0)
+            return open_key(remote, headers=headers)
+        with mock.patch('baiji.pod.transfer._open_key', flaky_open_key):
+            with self.assertRaises(socket.error):
+                transfer.fetch('s3://bucket/foo/bar.baz', self.local)
+            transfer.fetch('s3://bucket/foo/bar.baz', self.local)
+        with open(self.local, 'rb') as f:
+            self.assertEqual(f.read(), self.contents)
+
+    def test_that_change_during_ranged_fetch_is_an_error(self):
+        import itertools
+        from baiji.exceptions import get_transient_error_class
+        from baiji.pod import transfer
+        open_key = transfer._open_key # pylint: disable=protected-access
+        changes = itertools.count()
+        def open_key_and_change(remote, headers=None):
+            key = open_key(remote, headers=headers)
+            self.s3.put('bucket', 'foo/bar.baz', 'change {}'.format(next(changes)) * 1000)
+            return key
+        with mock.patch('baiji.pod.transfer._open_key', open_key_and_change):
+            with self.assertRaises(get_transient_error_class()):
+                transfer.fetch('s3://bucket/foo/bar.baz', self.local, chunk_size=1000, concurrency=4)
+
+
+class TestConnectionReuse(unittest.TestCase):
+    def setUp(self):
+        import threading
+        from baiji.pod import transfer
+        patcher = mock.patch('baiji.connection.S3Connection')
+        self.mock_connection = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.mock_connection.side_effect = lambda: mock.Mock()
+        patcher = mock.patch.object(transfer, '_connections', threading.local())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_that_each_thread_reuses_its_connection(self):
+        import threading
+        from baiji.pod.transfer import _connection
+        first = _connection()
+        self.assertIs(_connection(), first)
+        other = []
+        thread = threading.Thread(target=lambda: other.append(_connection()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(other[0], first)
+
+    def test_that_connection_is_not_shared_after_fork(self):
+        from baiji.pod.transfer import _connection
+        first = _connection()
+        with mock.patch('os.getpid', return_value=os.getpid() + 1):
+            self.assertIsNot(_connection(), first)
+
+
+class TestResumableFetch(S3StandInMixin, ScratchDirMixin, unittest.TestCase):
+    def setUp(self):
+        import hashlib
+        super(TestResumableFetch, self).setUp()
+        self.contents = ''.join(chr(x % 256) for x in range(10000))
+        self.etag = hashlib.md5(self.contents).hexdigest()
+        self.s3.put('bucket', 'foo/bar.baz', self.contents)
+        self.local = os.path.join(self.scratch_dir, 'bucket', 'foo', 'bar.baz')
+
+    def interrupted_stream(self, num_bytes):
+        from baiji.pod.transfer import PartialDownload
+        partial = PartialDownload(self.local)
+        partial.start(self.etag, len(self.contents))
+        with open(partial.path, 'ab') as f:
+            f.write(self.contents[:num_bytes])
+        return partial
+
+    def assert_fetched(self):
+        with open(self.local, 'rb') as f:
+            self.assertEqual(f.read(), self.contents)
+        self.assertEqual(os.listdir(os.path.dirname(self.local)), ['bar.baz'])
+
+    def test_that_stream_resumes_from_offset(self):
+        from baiji.pod.transfer import fetch
+        self.interrupted_stream(4000)
+
+        self.assertEqual(fetch('s3://bucket/foo/bar.baz', self.local), self.etag)
+        self.assert_fetched()
+        self.assertEqual(
+            [(command, headers.get('range')) for command, _, _, headers in self.s3.requests],
+            [('HEAD', None), ('GET', 'bytes=4000-')])
+
+    def test_that_changed_remote_starts_over(self):
+        from baiji.pod.transfer import fetch
+        self.interrupted_stream(4000)
+        self.s3.put('bucket', 'foo/bar.baz', 'new contents')
+
+        fetch('s3://bucket/foo/bar.baz', self.local)
+        with open(self.local, 'rb') as f:
+            self.assertEqual(f.read(), 'new contents')
+        self.assertEqual(
+            [(command, headers.get('range')) for command, _, _, headers in self.s3.requests],
+            [('HEAD', None), ('GET', None)])
+
+    def test_that_ranged_fetch_resumes_missing_ranges(self):
+        from baiji.pod import transfer
+        open_key = transfer._open_key # pylint: disable=protected-access
+        def flaky_open_key(remote, headers=None):
+            if headers and headers.get('Range') == 'bytes=5000-5999':
+                raise IOError('Connection reset')
+            return open_key(remote, headers=headers)
+        with mock.patch('baiji.pod.transfer._open_key', flaky_open_key):
+            with self.assertRaises(IOError):
+                transfer.fetch('s3://bucket/foo/bar.baz', self.local, chunk_size=1000, concurrency=2)
+        self.assertFalse(os.path.exists(self.local))
+        del self.s3.requests[:]
+
+        transfer.fetch('s3://bucket/foo/bar.baz', self.local, chunk_size=1000, concurrency=2)
+        self.assert_fetched()
+        ranges = [headers.get('range') for _, _, _, headers in self.s3.requests]
+        self.assertEqual(ranges[0], None) # HEAD
+        self.assertIn('bytes=5000-5999', ranges)
+        self.assertLess(len(ranges), 1 + 10)
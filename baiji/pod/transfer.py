@@ -0,0 +1,420 @@
+'''
+Requests made directly with boto, for when the `s3` module costs more round
+trips than we need.
+'''
+import os
+import threading
+
+# Each thread keeps its own connection, so that requests made one after
+# another, such as by the threads downloading during prefill, reuse the same
+# keep-alive connections rather than each opening new ones. boto connections
+# aren't safe to share between threads.
+_connections = threading.local()
+
+# How many times `fetch` tries again after a dropped connection, a server
+# error, or a download which doesn't match its etag, as `s3.cp` does.
+RETRIES = 1
+
+
+def _connection():
+    '''
+    Return this thread's boto connection. After a fork, the child makes its
+    own, rather than sharing the parent's sockets.
+    '''
+    from baiji.connection import S3Connection
+    pid = getattr(_connections, 'pid', None)
+    if pid != os.getpid():
+        _connections.conn = S3Connection().conn
+        _connections.pid = os.getpid()
+    return _connections.conn
+
+
+def connect_bucket(bucket_name):
+    '''
+    Return a boto bucket, without the request `get_bucket` normally makes to
+    check that it exists. A missing bucket shows up as a 404 on the key.
+    '''
+    return _connection().get_bucket(bucket_name, validate=False)
+
+
+def _open_key(remote, headers=None):
+    '''
+    Start a GET of `remote`, and return the boto key to read it from, or None
+    if the server responds 304 Not Modified.
+    '''
+    from boto.exception import S3ResponseError
+    from baiji import s3
+
+    parsed = s3.path.parse(remote)
+    key = connect_bucket(parsed.netloc).new_key(parsed.path.lstrip('/'))
+    try:
+        key.open_read(headers=headers)
+    except S3ResponseError as e:
+        if e.status == 304:
+            return None
+        elif e.status == 404:
+            raise s3.KeyNotFound('{} not found on s3'.format(remote))
+        elif e.status == 412:
+            from baiji.exceptions import get_transient_error_class
+            raise get_transient_error_class()('{} changed during download'.format(remote))
+        else:
+            raise
+    return key
+
+
+def _ensure_integrity(remote, path, etag, md5=None):
+    '''
+    Raise a transient error if the file at `path`, whose md5 is `md5`, doesn't
+    match `etag`. If the md5 isn't known, it's computed.
+    '''
+    from baiji import s3
+    from baiji.exceptions import get_transient_error_class
+    from baiji.util.md5 import md5_for_file
+    if '-' in etag: # Multipart upload; the etag isn't an md5.
+        matches = s3.etag_matches(path, etag)
+    else:
+        if md5 is None:
+            md5 = md5_for_file(path, block_size=1024*1024)
+        matches = md5 == etag
+    if not matches:
+        raise get_transient_error_class()(
+            'Download of {} is corrupted; expected etag {}'.format(remote, etag))
+
+
+class PartialDownload(object):
+    '''
+    A download of `local` which hasn't finished. The contents so far are
+    kept next to it in `.<name>.part`, and what we know about the download
+    in `.<name>.part.json`: the remote etag and size, and for ranged
+    downloads, the chunk size and which ranges are complete. When a download
+    is interrupted, they're left in place, so it can be resumed.
+
+    Downloads of the same file must not run at the same time. The asset
+    cache ensures this with `AssetCache.download_lock`.
+    '''
+    SUFFIXES = ('.part', '.part.json')
+
+    def __init__(self, local):
+        from baiji.pod.util import json
+        directory, name = os.path.split(local)
+        self.local = local
+        self.path = os.path.join(directory, '.{}.part'.format(name))
+        self.info_path = self.path + '.json'
+        self.info = None
+        if os.path.exists(self.path):
+            try:
+                self.info = json.load(self.info_path)
+            except (IOError, ValueError): # Missing, or cut short while it was written.
+                pass
+
+    @property
+    def etag(self):
+        return self.info['etag'] if self.info is not None else None
+
+    @property
+    def size(self):
+        return self.info['size']
+
+    @property
+    def chunk_size(self):
+        return self.info['chunk_size']
+
+    @property
+    def offset(self):
+        '''
+        For a download in a single stream, the number of bytes received.
+        '''
+        return os.path.getsize(self.path)
+
+    def start(self, etag, size, chunk_size=None):
+        '''
+        Start a new download of `size` bytes with `etag`. For a ranged
+        download, pass `chunk_size`, and the file is allocated up front.
+        '''
+        from baiji.util.shutillib import mkdir_p
+        mkdir_p(os.path.dirname(self.path))
+        with open(self.path, 'wb') as f:
+            if chunk_size:
+                f.truncate(size)
+        self.info = {'etag': etag, 'size': size, 'chunk_size': chunk_size, 'done': []}
+        self._save()
+
+    def is_done(self, start):
+        return start in self.info['done']
+
+    def mark_done(self, start):
+        '''
+        For a ranged download, record that the range at `start` is complete.
+        '''
+        self.info['done'].append(start)
+        self._save()
+
+    def _save(self):
+        from baiji.pod.util import json
+        json.dump(self.info, self.info_path)
+
+    def finish(self):
+        '''
+        Move the completed download into place at `local`.
+        '''
+        from baiji.pod.util.shutillib import remove_file
+        if os.name == 'nt': # On Windows, rename won't replace an existing file.
+            remove_file(self.local)
+        os.rename(self.path, self.local)
+        remove_file(self.info_path)
+        self.info = None
+
+    def discard(self):
+        from baiji.pod.util.shutillib import remove_file
+        remove_file(self.path)
+        remove_file(self.info_path)
+        self.info = None
+
+
+def fetch(remote, local, if_none_match=None, progress=False, chunk_size=None, concurrency=1,
+          limiter=None):
+    '''
+    Download `remote` to `local` using a single GET, and return its etag.
+
+    When `if_none_match` is given, the request is conditional: if the remote
+    etag still matches it, nothing is downloaded and None is returned.
+
+    When `concurrency` is more than 1, files larger than `chunk_size` are
+    instead downloaded in ranges of `chunk_size` bytes, `concurrency` at a
+    time. See `_fetch_ranges`.
+
+    When `limiter` is given, a BandwidthLimiter, it's told about each chunk
+    received, and slows the download to keep within its limit.
+
+    The contents are checked against the etag, and then renamed into place,
+    so `local` is never left partially written. If the download is
+    interrupted, what's been received is kept as a PartialDownload, and the
+    next fetch picks up where it left off, as long as the remote file hasn't
+    changed. After a dropped connection, a server error, or a mismatch with
+    the etag, it tries again, up to `RETRIES` times.
+    '''
+    for attempt in range(RETRIES + 1):
+        try:
+            return _fetch(
+                remote, local, if_none_match=if_none_match, progress=progress,
+                chunk_size=chunk_size, concurrency=concurrency, limiter=limiter)
+        except Exception as e: # pylint: disable=broad-except
+            if attempt == RETRIES or not _is_retryable(e):
+                raise
+
+
+def _is_retryable(e):
+    import httplib
+    import socket
+    from boto.exception import S3ResponseError
+    from baiji.exceptions import get_transient_error_class
+    if isinstance(e, S3ResponseError):
+        return e.status >= 500
+    return isinstance(e, (socket.error, httplib.HTTPException, get_transient_error_class()))
+
+
+def _fetch(remote, local, if_none_match, progress, chunk_size, concurrency, limiter):
+    import hashlib
+
+    partial = PartialDownload(local)
+    if partial.etag is not None and partial.etag != if_none_match:
+        etag = _resume(remote, partial, progress, concurrency, limiter)
+        if etag is not None:
+            return etag
+
+    headers = {}
+    if if_none_match is not None:
+        headers['If-None-Match'] = '"{}"'.format(if_none_match)
+
+    key = _open_key(remote, headers=headers)
+    if key is None:
+        partial.discard()
+        return None
+
+    etag = key.etag.strip('"')
+    if concurrency > 1 and chunk_size and key.size > chunk_size:
+        # Abandon this response, without reading it, in favor of ranges.
+        key.close(fast=True)
+        partial.start(etag, key.size, chunk_size=chunk_size)
+        _fetch_ranges(remote, partial, concurrency, progress, limiter)
+        md5 = None
+    else:
+        partial.start(etag, key.size)
+        md5 = hashlib.md5()
+        _stream(key, partial, md5, progress, limiter)
+    _finish(remote, partial, md5)
+    return etag
+
+
+def _resume(remote, partial, progress, concurrency, limiter=None):
+    '''
+    Continue an interrupted download, and return its etag. If the remote
+    file has changed since it started, discard it and return None.
+    '''
+    import hashlib
+    from baiji import s3
+
+    parsed = s3.path.parse(remote)
+    key = connect_bucket(parsed.netloc).get_key(parsed.path.lstrip('/'))
+    if key is None or key.etag.strip('"') != partial.etag or key.size != partial.size:
+        partial.discard()
+        return None
+
+    if partial.chunk_size:
+        _fetch_ranges(remote, partial, concurrency, progress, limiter)
+        md5 = None
+    else:
+        # Pick up the hash where it left off.
+        md5 = hashlib.md5()
+        with open(partial.path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024*1024), b''):
+                md5.update(chunk)
+        if partial.offset < partial.size:
+            key = _open_key(remote, headers={
+                'Range': 'bytes={}-'.format(partial.offset),
+                'If-Match': '"{}"'.format(partial.etag),
+            })
+            _stream(key, partial, md5, progress, limiter)
+    etag = partial.etag
+    _finish(remote, partial, md5)
+    return etag
+
+
+def _stream(key, partial, md5, progress, limiter=None):
+    '''
+    Append the response from `key` to `partial`, updating `md5`.
+    '''
+    from baiji.util.with_progressbar import FileTransferProgressbar
+    done = partial.offset
+    try:
+        with open(partial.path, 'ab') as f, \
+                FileTransferProgressbar(supress=(not progress)) as cb:
+            for chunk in key:
+                f.write(chunk)
+                md5.update(chunk)
+                done += len(chunk)
+                cb(done, partial.size)
+                if limiter is not None:
+                    limiter.consume(len(chunk))
+    finally:
+        key.close()
+
+
+def _finish(remote, partial, md5=None):
+    '''
+    Check a completed download against its etag, and move it into place.
+    If it doesn't match, it's discarded.
+    '''
+    try:
+        _ensure_integrity(remote, partial.path, partial.etag, md5.hexdigest() if md5 else None)
+    except:
+        partial.discard()
+        raise
+    partial.finish()
+
+
+def _fetch_ranges(remote, partial, concurrency, progress, limiter=None):
+    '''
+    Download the ranges of `partial` which aren't complete. Ranges are
+    requested concurrently, and each one is written at its own offset in the
+    file, which was allocated up front.
+
+    Each request requires the remote file to still have the etag, so if it
+    changes partway through, we get an error instead of a mix of versions.
+    '''
+    from multiprocessing.pool import ThreadPool
+    from baiji.util.with_progressbar import FileTransferProgressbar
+
+    size, chunk_size = partial.size, partial.chunk_size
+
+    def fetch_range(start):
+        end = min(start + chunk_size, size)
+        key = _open_key(remote, headers={
+            'Range': 'bytes={}-{}'.format(start, end - 1),
+            'If-Match': '"{}"'.format(partial.etag),
+        })
+        done = 0
+        try:
+            with open(partial.path, 'r+b') as f:
+                f.seek(start)
+                for chunk in key:
+                    f.write(chunk)
+                    done += len(chunk)
+                    if limiter is not None:
+                        limiter.consume(len(chunk))
+        finally:
+            key.close()
+        if done != end - start:
+            from baiji.exceptions import get_transient_error_class
+            raise get_transient_error_class()(
+                'Download of {} was cut short at byte {}'.format(remote, start + done))
+        return start, done
+
+    starts = [x for x in xrange(0, size, chunk_size) if not partial.is_done(x)]
+    pool = ThreadPool(concurrency)
+    try:
+        with FileTransferProgressbar(supress=(not progress)) as cb:
+            done = size - sum(min(chunk_size, size - x) for x in starts)
+            for start, num_bytes in pool.imap_unordered(fetch_range, starts):
+                partial.mark_done(start)
+                done += num_bytes
+                cb(done, size)
+    finally:
+        pool.terminate()
+
+
+def list_keys(bucket_name, prefix, delimiter=''):
+    '''
+    Yield `(path, etag, size)` for each key in the bucket starting with
+    `prefix`. Paths start with `/`. S3 returns up to a thousand keys, with
+    their etags and sizes, per request; boto requests more pages as they're
+    needed.
+
+    With `delimiter='/'`, only the keys immediately under `prefix` are listed.
+    '''
+    from boto.s3.key import Key
+    for key in connect_bucket(bucket_name).list(prefix=prefix, delimiter=delimiter):
+        if isinstance(key, Key): # Not a common prefix
+            yield '/' + key.name, key.etag.strip('"'), key.size
+
+
+def list_etags(bucket_name, prefix, delimiter=''):
+    '''
+    Yield `(path, etag)` for each key in the bucket starting with `prefix`.
+    See `list_keys`.
+    '''
+    for path, etag, _ in list_keys(bucket_name, prefix, delimiter=delimiter):
+        yield path, etag
+
+
+def list_many(uris):
+    '''
+    Return a dict mapping each of `uris` which is on s3 to `(etag, size)`.
+
+    Rather than a request for each uri, they're grouped by bucket and
+    directory, and each directory is listed once. A directory with only one
+    of the uris in it is listed with the key as the prefix, which is no
+    slower than asking for the key.
+    '''
+    from collections import defaultdict
+    from baiji import s3
+
+    groups = defaultdict(list)
+    for uri in uris:
+        parsed = s3.path.parse(uri)
+        path = parsed.path if parsed.path.startswith('/') else '/' + parsed.path
+        groups[(parsed.netloc, path.rsplit('/', 1)[0])].append((uri, path))
+
+    result = {}
+    for (bucket_name, directory), group in sorted(groups.items()):
+        if len(group) == 1:
+            listing = list_keys(bucket_name, group[0][1][1:])
+        else:
+            # Keys at the top of the bucket are listed with no prefix at all.
+            prefix = directory[1:] + '/' if directory else ''
+            listing = list_keys(bucket_name, prefix, delimiter='/')
+        found = {path: (etag, size) for path, etag, size in listing}
+        for uri, path in group:
+            if path in found:
+                result[uri] = found[path]
+    return result
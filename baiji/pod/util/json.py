@@ -17,3 +17,19 @@ def dump(obj, path, *args, **kwargs):
     import simplejson as json
     with open(path, 'w') as f:
         json.dump(obj, f, *args, **kwargs)
+
+def dumps(obj, *args, **kwargs):
+    '''
+    from baiji.pod.util import json
+    s = json.dumps(foo)
+    '''
+    import simplejson as json
+    return json.dumps(obj, *args, **kwargs)
+
+def loads(s, *args, **kwargs):
+    '''
+    from baiji.pod.util import json
+    foo = json.loads(s)
+    '''
+    import simplejson as json
+    return json.loads(s, *args, **kwargs)
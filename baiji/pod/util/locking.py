@@ -0,0 +1,121 @@
+'''
+Locking used by the asset cache. Advisory file locks coordinate processes
+which share a cache directory, and `SingleFlight` coordinates threads within
+a process.
+
+Locks are taken with `flock`, which locks an open file description. That
+means they also exclude other threads in the same process, as long as each
+one opens the lock file itself, which `FileLock` does. On platforms without
+`fcntl`, locking is skipped.
+'''
+import os
+
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+
+# A cache holds any number of files, but only a handful are downloaded at
+# once, so rather than a lock file per key, keys share a fixed set of lock
+# files. Two keys only contend when their hashes collide.
+NUM_LOCK_STRIPES = 1024
+
+
+class FileLock(object):
+    '''
+    An exclusive lock on `path`, which is created if needed. Use it as a
+    context manager; it blocks until the lock is acquired.
+
+    With `blocking=False`, it doesn't wait. Check `acquired` to find out
+    whether the lock was taken.
+    '''
+    def __init__(self, path, blocking=True):
+        self.path = path
+        self.blocking = blocking
+        self.fd = None
+        self.acquired = False
+
+    def __enter__(self):
+        import errno
+        from baiji.util.shutillib import mkdir_p
+        if fcntl is None:
+            self.acquired = True
+            return self
+        mkdir_p(os.path.dirname(self.path))
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX if self.blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            os.close(self.fd)
+            self.fd = None
+            if self.blocking or e.errno not in [errno.EAGAIN, errno.EACCES]:
+                raise
+            return self
+        except:
+            os.close(self.fd)
+            self.fd = None
+            raise
+        self.acquired = True
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+        self.acquired = False
+
+
+def key_lock(cache_dir, key):
+    '''
+    Return a FileLock for `key`, a string such as an s3 uri.
+    '''
+    import zlib
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    stripe = (zlib.crc32(key) & 0xffffffff) % NUM_LOCK_STRIPES
+    return FileLock(os.path.join(cache_dir, '.locks', '{:04d}'.format(stripe)))
+
+
+class SingleFlight(object):
+    '''
+    Coalesce concurrent calls with the same key: the first caller does the
+    work, and callers who arrive while it's in flight wait for it and share
+    its result, or its exception.
+    '''
+    class _Call(object):
+        def __init__(self):
+            import threading
+            self.done = threading.Event()
+            self.result = None
+            self.exc_info = None
+
+    def __init__(self):
+        import threading
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+
+        if not leader:
+            call.done.wait()
+            if call.exc_info is not None:
+                raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+        except:
+            import sys
+            call.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
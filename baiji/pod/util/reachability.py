@@ -31,3 +31,72 @@ def assert_internet_reachable():
 
     if not internet_reachable():
         raise InternetUnreachableError('Internet Unreachable')
+
+
+def create_reachability_probe(settings):
+    return ReachabilityProbe(
+        enabled=settings.check_reachability,
+        ttl=settings.reachability_ttl,
+        backoff=settings.reachability_backoff,
+        max_backoff=settings.reachability_max_backoff)
+
+
+class ReachabilityProbe(object):
+    '''
+    Remembers the outcome of `assert_internet_reachable`, so we don't probe
+    before every request.
+
+    A successful probe is trusted for `ttl` seconds. After a failure, we
+    don't probe again for `backoff` seconds, doubling with each consecutive
+    failure up to `max_backoff`. Until then, `assert_reachable` fails
+    straight away.
+
+    With `enabled=False`, it never probes, and assumes s3 is reachable.
+    '''
+    def __init__(self, enabled=True, ttl=60, backoff=5, max_backoff=300):
+        import threading
+        self.enabled = enabled
+        self.ttl = ttl
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._lock = threading.Lock()
+        self._reachable = None
+        self._valid_until = 0
+        self._failures = 0
+
+    def assert_reachable(self):
+        import time
+        if not self.enabled:
+            return
+        # Probing while holding the lock means concurrent callers share one
+        # probe.
+        with self._lock:
+            if time.time() < self._valid_until:
+                if not self._reachable:
+                    raise InternetUnreachableError('Internet Unreachable')
+                return
+            try:
+                assert_internet_reachable()
+            except InternetUnreachableError:
+                self._record_failure()
+                raise
+            self._reachable = True
+            self._failures = 0
+            self._valid_until = time.time() + self.ttl
+
+    def record_failure(self):
+        '''
+        Note that a request failed because we couldn't reach s3, as though
+        a probe had failed.
+        '''
+        if not self.enabled:
+            return
+        with self._lock:
+            self._record_failure()
+
+    def _record_failure(self):
+        import time
+        self._reachable = False
+        self._failures += 1
+        window = min(self.backoff * 2 ** (self._failures - 1), self.max_backoff)
+        self._valid_until = time.time() + window
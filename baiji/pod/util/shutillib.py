@@ -1,3 +1,6 @@
+from contextlib import contextmanager
+
+
 def remove_tree(path, ignore_errors=True):
     import os
     import shutil
@@ -16,3 +19,55 @@ def remove_file(path, ignore_errors=True):
                 raise
         else: # Something else, like permission denied
             raise
+
+def _umask_by_setting():
+    import os
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+# Setting the umask to read it changes it for every thread, so where it can't
+# be read from /proc, it's read this way once, while the module is imported.
+_umask_at_import = _umask_by_setting()
+
+def current_umask():
+    '''
+    Return the process umask. It's read from `/proc/self/status` where that
+    shows it (Linux 4.7 and later); elsewhere, it's the umask when this
+    module was imported.
+    '''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('Umask:'):
+                    return int(line.split(':', 1)[1].strip(), 8)
+    except (IOError, ValueError):
+        pass
+    return _umask_at_import
+
+@contextmanager
+def atomic_replace(path):
+    '''
+    Yield a temporary path in the same directory as `path`. When the block
+    completes, the temporary file is renamed to `path`, so readers see either
+    the old file or the new one, never a partial one. If the block raises, the
+    temporary file is removed.
+
+    The file gets the mode a newly created file would, following the umask,
+    rather than the owner-only mode of a temporary file.
+    '''
+    import os
+    import tempfile
+    from baiji.util.shutillib import mkdir_p
+    dirname, basename = os.path.split(path)
+    mkdir_p(dirname)
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.' + basename + '.', suffix='.tmp')
+    os.close(fd)
+    try:
+        yield tmp_path
+        os.chmod(tmp_path, 0o666 & ~current_umask())
+        if os.name == 'nt': # On Windows, rename won't replace an existing file.
+            remove_file(path)
+        os.rename(tmp_path, path)
+    finally:
+        remove_file(tmp_path)
@@ -0,0 +1,75 @@
+import unittest
+import mock
+from baiji.pod.util.reachability import ReachabilityProbe, InternetUnreachableError
+
+
+class TestReachabilityProbe(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('time.time', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        patcher = mock.patch('baiji.pod.util.reachability.assert_internet_reachable')
+        self.mock_probe = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.probe = ReachabilityProbe(ttl=60, backoff=5, max_backoff=12)
+
+    def go_offline(self):
+        self.mock_probe.side_effect = InternetUnreachableError('Internet Unreachable')
+
+    def test_that_success_is_trusted_until_ttl(self):
+        self.probe.assert_reachable()
+        self.now += 59
+        self.probe.assert_reachable()
+        self.assertEqual(self.mock_probe.call_count, 1)
+        self.now += 2
+        self.probe.assert_reachable()
+        self.assertEqual(self.mock_probe.call_count, 2)
+
+    def test_that_failure_fails_fast_with_backoff(self):
+        self.go_offline()
+        windows = []
+        for _ in range(4):
+            with self.assertRaises(InternetUnreachableError):
+                self.probe.assert_reachable()
+            probes = self.mock_probe.call_count
+            start = self.now
+            while self.mock_probe.call_count == probes:
+                self.now += 1
+                with self.assertRaises(InternetUnreachableError):
+                    self.probe.assert_reachable()
+            windows.append(self.now - start)
+        self.assertEqual(windows, [5, 10, 12, 12])
+
+    def test_that_backoff_resets_after_success(self):
+        self.go_offline()
+        for _ in range(3):
+            with self.assertRaises(InternetUnreachableError):
+                self.probe.assert_reachable()
+            self.now += 20
+        self.mock_probe.side_effect = None
+        self.probe.assert_reachable()
+
+        self.now += 60
+        self.go_offline()
+        with self.assertRaises(InternetUnreachableError):
+            self.probe.assert_reachable()
+        self.now += 5
+        with self.assertRaises(InternetUnreachableError):
+            self.probe.assert_reachable()
+        self.assertEqual(self.mock_probe.call_count, 6)
+
+    def test_that_recorded_failure_starts_backoff(self):
+        self.probe.record_failure()
+        with self.assertRaises(InternetUnreachableError):
+            self.probe.assert_reachable()
+        self.assertFalse(self.mock_probe.called)
+
+    def test_that_disabled_probe_never_checks(self):
+        self.go_offline()
+        probe = ReachabilityProbe(enabled=False)
+        probe.record_failure()
+        probe.assert_reachable()
+        self.assertFalse(self.mock_probe.called)
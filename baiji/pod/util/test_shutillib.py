@@ -0,0 +1,54 @@
+import unittest
+import os
+from scratch_dir import ScratchDirMixin
+
+
+class TestAtomicReplace(ScratchDirMixin, unittest.TestCase):
+    def test_that_file_is_replaced(self):
+        from baiji.pod.util.shutillib import atomic_replace
+        path = os.path.join(self.scratch_dir, 'dir', 'file.txt')
+        with atomic_replace(path) as tmp_path:
+            with open(tmp_path, 'w') as f:
+                f.write('contents')
+        with open(path) as f:
+            self.assertEqual(f.read(), 'contents')
+        self.assertEqual(os.listdir(os.path.dirname(path)), ['file.txt'])
+
+    def test_that_file_follows_the_umask(self):
+        from baiji.pod.util.shutillib import atomic_replace
+        path = os.path.join(self.scratch_dir, 'file.txt')
+        for umask in [0o022, 0o002]:
+            old_umask = os.umask(umask)
+            try:
+                with atomic_replace(path) as tmp_path:
+                    with open(tmp_path, 'w') as f:
+                        f.write('contents')
+            finally:
+                os.umask(old_umask)
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o666 & ~umask)
+
+    def test_that_umask_is_read_without_setting_it(self):
+        import mock
+        from baiji.pod.util.shutillib import current_umask
+        umask = os.umask(0)
+        os.umask(umask)
+        with mock.patch('os.umask') as mock_umask:
+            self.assertEqual(current_umask(), umask)
+        self.assertFalse(mock_umask.called)
+
+    def test_that_umask_at_import_is_used_without_proc(self):
+        import mock
+        from baiji.pod.util import shutillib
+        with mock.patch('__builtin__.open', side_effect=IOError()), \
+                mock.patch.object(shutillib, '_umask_at_import', 0o077):
+            self.assertEqual(shutillib.current_umask(), 0o077)
+
+    def test_that_temporary_file_is_removed_on_error(self):
+        from baiji.pod.util.shutillib import atomic_replace
+        path = os.path.join(self.scratch_dir, 'file.txt')
+        with self.assertRaises(ValueError):
+            with atomic_replace(path) as tmp_path:
+                with open(tmp_path, 'w') as f:
+                    f.write('contents')
+                raise ValueError()
+        self.assertEqual(os.listdir(self.scratch_dir), [])
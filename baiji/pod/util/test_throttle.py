@@ -0,0 +1,37 @@
+import unittest
+import mock
+from baiji.pod.util.throttle import BandwidthLimiter
+
+
+class TestBandwidthLimiter(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        def sleep(seconds):
+            self.now += seconds
+        patcher = mock.patch('time.time', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('time.sleep', side_effect=sleep)
+        self.mock_sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_that_a_burst_of_one_seconds_worth_is_allowed(self):
+        limiter = BandwidthLimiter(100)
+        limiter.consume(60)
+        limiter.consume(40)
+        self.assertFalse(self.mock_sleep.called)
+
+    def test_that_consumers_are_slowed_to_the_rate(self):
+        limiter = BandwidthLimiter(100)
+        start = self.now
+        for _ in range(10):
+            limiter.consume(50)
+        # The first 100 bytes are free, and the other 400 take 4 seconds.
+        self.assertAlmostEqual(self.now - start, 4)
+
+    def test_that_idle_time_refills_only_up_to_the_rate(self):
+        limiter = BandwidthLimiter(100)
+        limiter.consume(100)
+        self.now += 60
+        limiter.consume(200)
+        self.assertAlmostEqual(self.mock_sleep.call_args[0][0], 1)
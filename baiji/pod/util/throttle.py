@@ -0,0 +1,45 @@
+'''
+A limit on the bandwidth shared by the threads downloading for an asset
+cache. See `Config.max_bandwidth`.
+'''
+import threading
+import time
+
+
+def create_bandwidth_limiter(settings):
+    '''
+    Return a BandwidthLimiter for `settings.max_bandwidth`, or None if
+    bandwidth isn't limited.
+    '''
+    if settings.max_bandwidth is None:
+        return None
+    return BandwidthLimiter(settings.max_bandwidth)
+
+
+class BandwidthLimiter(object):
+    '''
+    A token bucket which fills at `rate` bytes per second, up to one
+    second's worth. Each thread calls `consume` with the bytes it's just
+    received, and sleeps until the bucket can cover them, so between them
+    the threads average no more than `rate`.
+    '''
+    def __init__(self, rate):
+        if rate <= 0:
+            raise ValueError('Bandwidth must be positive, not {}'.format(rate))
+        self.rate = float(rate)
+        self._lock = threading.Lock()
+        self._available = self.rate
+        self._updated_at = time.time()
+
+    def consume(self, num_bytes):
+        with self._lock:
+            now = time.time()
+            self._available = min(
+                self.rate, self._available + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            # Take the bytes now, even if that runs a debt, so threads which
+            # come after wait behind this one.
+            self._available -= num_bytes
+            wait = -self._available / self.rate
+        if wait > 0:
+            time.sleep(wait)
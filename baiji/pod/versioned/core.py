@@ -34,9 +34,11 @@ class VersionedCache(object):
         If verbose is left at None, uses the underlying asset cache's global
         default.
         '''
-        if not self.is_versioned(path):
-            raise self.KeyNotFound('{} is not a versioned path'.format(path))
-        uri = self.uri(path, version)
+        uri = self._manifest_uris.get(path) if version is None else None
+        if uri is None:
+            if not self.is_versioned(path):
+                raise self.KeyNotFound('{} is not a versioned path'.format(path))
+            uri = self.uri(path, version)
         try:
             # TODO Put a test around this magic number.
             return self.cache(uri, verbose=verbose, stacklevel=3)
@@ -44,10 +46,57 @@ class VersionedCache(object):
             raise self.KeyNotFound('{} is not cached for version {}'.format(
                 path, version))
 
+    def get_many(self, paths, verbose=None):
+        '''
+        Get the manifest version of many files at once, using the asset
+        cache's `get_many`.
+
+        Returns a tuple `(local_paths, errors)`. `local_paths` maps each path
+        which was got to its local path, and `errors` maps each path which
+        couldn't be got to the exception raised.
+        '''
+        errors = {}
+        uris = {}
+        for path in set(paths):
+            try:
+                if not self.is_versioned(path):
+                    raise self.KeyNotFound('{} is not a versioned path'.format(path))
+                uris[path] = self.uri(path)
+            except s3.KeyNotFound as e:
+                errors[path] = e
+
+        cached, cache_errors = self.cache.get_many(set(uris.values()), verbose=verbose)
+
+        local_paths = {}
+        for path, uri in uris.items():
+            if uri in cached:
+                local_paths[path] = cached[uri]
+            elif isinstance(cache_errors[uri], s3.KeyNotFound):
+                errors[path] = self.KeyNotFound('{} is not cached for version {}'.format(
+                    path, self.manifest_version(path)))
+            else:
+                errors[path] = cache_errors[uri]
+        return local_paths, errors
+
     @cached_property
     def manifest(self):
-        from baiji.pod.util import json
-        return json.load(self.manifest_path)
+        '''
+        The parsed manifest, which is shared with other VersionedCache
+        objects using the same file. See `baiji.pod.versioned.manifest`.
+        '''
+        from baiji.pod.versioned.manifest import registry
+        return registry.load(self.manifest_path)
+
+    @cached_property
+    def _manifest_uris(self):
+        '''
+        The s3 uris of the manifest versions which have been resolved, keyed
+        by the path as it was given to `uri`. It's filled in as paths are
+        resolved, rather than all at once, so a compiled manifest isn't read
+        in full. Manifest versions which are local paths aren't kept, since
+        whether they exist can change.
+        '''
+        return {}
 
     @property
     def manifest_files(self):
@@ -62,23 +111,30 @@ class VersionedCache(object):
         return path in self.manifest
 
     def update_manifest(self, path, version):
-        from baiji.pod.util import json
+        from baiji.pod.versioned.manifest import registry
 
         path = self.normalize_path(path)
 
-        manifest = json.load(self.manifest_path)
+        # The parsed manifest is shared, so change a copy. A compiled manifest
+        # is copied with a single scan.
+        manifest = dict(registry.load(self.manifest_path).items())
         manifest[path] = version
-        json.dump(manifest, self.manifest_path, sort_keys=True, indent=4)
+        registry.store(self.manifest_path, manifest)
 
-        try:
-            del self.__dict__['manifest']
-        except KeyError:
-            pass
+        for name in ['manifest', '_manifest_uris']:
+            self.__dict__.pop(name, None)
 
     def uri(self, path, version=None, allow_local=True, suffixes=None):
         '''
         Default version is manifest version
         '''
+        is_manifest_version = version is None and not suffixes
+        if is_manifest_version:
+            uri = self._manifest_uris.get(path)
+            if uri is not None:
+                return uri
+
+        given_path = path
         path = self.normalize_path(path)
 
         if version is None:
@@ -87,7 +143,10 @@ class VersionedCache(object):
         if self.version_number_is_valid(version):
             base_path, ext = os.path.splitext(path)
             suffixes = '.' + '.'.join(suffixes) if suffixes is not None and len(suffixes) > 0 else ''
-            return 's3://' + self.bucket + base_path + '.' + version + suffixes + ext
+            uri = 's3://' + self.bucket + base_path + '.' + version + suffixes + ext
+            if is_manifest_version:
+                self._manifest_uris[given_path] = uri
+            return uri
         elif allow_local and s3.exists(version):
             # version here is a local or s3 path
             return version
@@ -100,25 +159,20 @@ class VersionedCache(object):
         return path
 
     def version_number_is_valid(self, version):
-        import re
-        return re.match(r'(0|[1-9][0-9]*)\.(0|[1-9][0-9]*)\.(0|[1-9][0-9]*)', version)
+        from baiji.pod.versioned.versions import VERSION_PATTERN
+        return VERSION_PATTERN.match(version)
 
     def extract_version(self, path):
-        import re
-        x = re.match(r'.*?\.((0|[1-9][0-9]*)\.(0|[1-9][0-9]*)\.(0|[1-9][0-9]*))(\.[^\.]*)?', path)
-        if x is not None:
-            return x.groups()[0]
-        raise ValueError('No version string found in {}'.format(path))
+        from baiji.pod.versioned.versions import extract_version
+        return extract_version(path)
 
     def parse(self, path):
         '''
         Parse a path and return a tuple: key, version
 
         '''
-        version = self.extract_version(path)
-        position = path.rfind(version)
-        key = path[:position].rstrip('.') + path[position + len(version):]
-        return key, version
+        from baiji.pod.versioned.versions import split_versioned_path
+        return split_versioned_path(path)
 
     def add(self, path, local_file, version=None, verbose=False):
         path = self.normalize_path(path)
@@ -133,8 +187,25 @@ class VersionedCache(object):
                 raise ValueError('invalid version {}, always use versions of the form N.N.N'.format(version))
 
         s3.cp(local_file, self.uri(path, version), progress=verbose)
+        self._record_upload(path, version)
         self.update_manifest(path, version)
 
+    @cached_property
+    def remote_index(self):
+        '''
+        The RemoteVersionIndex of the bucket, or None when it's turned off or
+        the cache isn't an AssetCache. See `baiji.pod.versioned.remote_index`.
+        '''
+        from baiji.pod.versioned.remote_index import create_remote_index
+        settings = getattr(self.cache, 'settings', None)
+        if settings is None:
+            return None
+        return create_remote_index(settings, self.bucket)
+
+    def _record_upload(self, path, version):
+        if self.remote_index is not None:
+            self.remote_index.record(path, [version])
+
     def ls_remote(self):
         '''
         Return a list of keys on the remote server.
@@ -142,45 +213,40 @@ class VersionedCache(object):
         TODO This could return the versions and create date too.
 
         '''
+        if self.remote_index is not None:
+            return sorted(self.remote_index.paths())
         paths = s3.ls('s3://' + self.bucket)
         parsed = [self.parse(path) for path in paths]
         # parsed is a list of key, version tuples.
         return sorted(set([key for key, _ in parsed]))
 
-    def versions_available(self, path):
-        import semantic_version
+    def versions_available(self, path, refresh=False):
+        '''
+        Return the versions of `path` on s3, in ascending order. They come
+        from the remote index, unless it's turned off. With `refresh`, the
+        path is listed regardless.
+        '''
+        from baiji.pod.versioned.versions import sort_versions
 
         path = self.normalize_path(path)
+        if self.remote_index is not None:
+            return self.remote_index.versions(path, refresh=refresh)
+
         base_path, ext = os.path.splitext(path)
 
         versions = filter(lambda path: os.path.splitext(path)[1] == ext, s3.ls('s3://' + self.bucket + base_path))
-        versions = sorted([semantic_version.Version(self.extract_version(v)) for v in versions])
-        versions = [str(v) for v in versions]
-        return versions
+        return sort_versions([self.extract_version(v) for v in versions])
 
-    def latest_available_version(self, path):
-        versions = self.versions_available(path)
+    def latest_available_version(self, path, refresh=False):
+        versions = self.versions_available(path, refresh=refresh)
         if len(versions) > 0:
             return str(versions[-1])
         else:
             return None
 
     def normalize_version_number(self, version):
-        import semantic_version
-
-        if isinstance(version, basestring):
-            version = semantic_version.Version(version, partial=True)
-
-        if version.major is None:
-            version.major = 0
-        if version.minor is None:
-            version.minor = 0
-        if version.patch is None:
-            version.patch = 0
-        version.prerelease = []
-        version.build = []
-
-        return str(version)
+        from baiji.pod.versioned.versions import normalize
+        return normalize(str(version))
 
     def manifest_matches_spec(self, path, spec):
         if not self.is_versioned(path):
@@ -194,8 +260,8 @@ class VersionedCache(object):
         return self.version_matches_spec(version, spec)
 
     def version_matches_spec(self, version, spec):
-        import semantic_version
-        return semantic_version.Spec(str(spec)).match(semantic_version.Version(str(version)))
+        from baiji.pod.versioned.versions import matches_spec
+        return matches_spec(version, spec)
 
     def apply_min_version(self, version, min_version):
         if self.version_matches_spec(version, '>='+min_version):
@@ -216,9 +282,9 @@ class VersionedCache(object):
             vc.next_version_number('/foo', '3.7') => 3.7.0
             vc.next_version_number('/foo', '3.4.13') => 3.4.13
         '''
-        import semantic_version
-        version = semantic_version.Version(self.latest_available_version(path))
-        version.patch += 1
+        from baiji.pod.versioned.versions import format_version, parse_version
+        major, minor, patch = parse_version(self.latest_available_version(path))
+        version = format_version((major, minor, patch + 1))
         if min_version is not None:
             version = self.apply_min_version(version, min_version)
         return str(version)
@@ -234,41 +300,40 @@ class VersionedCache(object):
         When using major, minor or patch to bump version, min_version can be used. The final version of this file
         will be updated to be max(min_version, version_from_major_minor_or_patch).
         """
-        import semantic_version
+        from baiji.pod.versioned.versions import format_version, parse_version
 
         path = self.normalize_path(path)
 
-        latest_version = self.latest_available_version(path)
+        # List the path rather than trusting the index, so we never
+        # overwrite a version which was uploaded since it was built.
+        latest_version = self.latest_available_version(path, refresh=True)
         if latest_version is None:
             raise self.KeyNotFound('{} is not a versioned path; did you mean vc.add?'.format(path))
 
         if version is None:
-            version = semantic_version.Version(latest_version)
+            latest_major, latest_minor, latest_patch = parse_version(latest_version)
             if major:
-                version.major += 1
-                version.minor = 0
-                version.patch = 0
+                version = (latest_major + 1, 0, 0)
             elif minor:
-                version.minor += 1
-                version.patch = 0
+                version = (latest_major, latest_minor + 1, 0)
             elif patch:
-                version.patch += 1
+                version = (latest_major, latest_minor, latest_patch + 1)
             else:
                 raise ValueError('Umm.... what did you want to update the version to?')
+            version = format_version(version)
             if min_version is not None:
                 version = self.apply_min_version(version, min_version)
-            version = str(version)
         else:
             version = self.normalize_version_number(version)
 
         if not self.version_number_is_valid(version):
             raise ValueError('Invalid version {}, always use versions of the form N.N.N'.format(version))
 
-        latest_version = self.latest_available_version(path)
-        if semantic_version.Version(version) <= semantic_version.Version(latest_version):
+        if parse_version(version) <= parse_version(latest_version):
             raise ValueError('Version numbers must be strictly increasing. You specified {} but there is already a {}'.format(version, latest_version))
 
         s3.cp(local_file, self.uri(path, version), progress=verbose)
+        self._record_upload(path, version)
         self.update_manifest(path, version)
 
     def update_major(self, path, local_file, verbose=False):
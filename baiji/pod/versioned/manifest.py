@@ -0,0 +1,207 @@
+'''
+Parsed manifests, shared by every VersionedCache in the process.
+
+Manifests can hold tens of thousands of entries, and a process may create
+many short-lived VersionedCache objects for the same one, so rather than
+each of them parsing the file, they get it from `registry`. It keeps the
+parsed manifest for each path, and parses the file again only when its
+mtime, size, or inode has changed.
+
+The manifests returned are shared, so treat them as read-only.
+
+A manifest can also be compiled, with `vc compile-manifest`, into a sqlite
+file next to it. When the compiled manifest is current, it's used instead
+of the JSON: opening it is nearly free, and each lookup is a search of its
+index, so nothing is parsed up front. When it's missing or out of date, the
+JSON is used.
+'''
+import os
+import threading
+
+COMPILED_SUFFIX = '.sqlite'
+
+
+def compiled_path(manifest_path):
+    '''
+    Where the compiled form of the manifest at `manifest_path` is kept.
+    '''
+    return manifest_path + COMPILED_SUFFIX
+
+
+def _sha1(path):
+    import hashlib
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024*1024), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def compile_manifest(manifest_path):
+    '''
+    Compile the JSON manifest at `manifest_path` to a sqlite file at
+    `compiled_path(manifest_path)`, where it's loaded from. Returns the
+    number of entries.
+
+    The compiled manifest records the size, mtime, and sha1 of the JSON it
+    was compiled from, so it can tell when it's out of date.
+    '''
+    import sqlite3
+    from baiji.pod.util import json
+    from baiji.pod.util.shutillib import atomic_replace
+
+    path = compiled_path(manifest_path)
+    stat = os.stat(manifest_path)
+    sha1 = _sha1(manifest_path)
+    manifest = json.load(manifest_path)
+
+    with atomic_replace(path) as tmp_path:
+        connection = sqlite3.connect(tmp_path)
+        try:
+            connection.execute(
+                'CREATE TABLE manifest (path TEXT PRIMARY KEY, version TEXT NOT NULL) '
+                'WITHOUT ROWID')
+            connection.execute(
+                'CREATE TABLE source (size INTEGER, mtime REAL, sha1 TEXT)')
+            connection.executemany(
+                'INSERT INTO manifest (path, version) VALUES (?, ?)', sorted(manifest.items()))
+            connection.execute(
+                'INSERT INTO source (size, mtime, sha1) VALUES (?, ?, ?)',
+                (stat.st_size, stat.st_mtime, sha1))
+            connection.commit()
+        finally:
+            connection.close()
+    return len(manifest)
+
+
+class CompiledManifest(object):
+    '''
+    A read-only mapping of path to version, backed by a compiled manifest.
+
+    sqlite connections aren't shared between threads or across a fork, so
+    we keep one per thread and process.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    @classmethod
+    def open_if_current(cls, path, manifest_path):
+        '''
+        Return the compiled manifest at `path` if it was compiled from the
+        JSON manifest at `manifest_path` as it is now. Otherwise, including
+        when it doesn't exist, return None.
+
+        When the JSON has the size and mtime it had when it was compiled, it
+        isn't read at all. When only its mtime has changed, as happens when
+        it's checked out again, its sha1 is compared.
+        '''
+        import sqlite3
+        if not os.path.exists(path):
+            return None
+        compiled = cls(path)
+        try:
+            size, mtime, sha1 = compiled.connection.execute(
+                'SELECT size, mtime, sha1 FROM source').fetchone()
+        except (sqlite3.DatabaseError, TypeError): # Not a compiled manifest
+            return None
+        stat = os.stat(manifest_path)
+        if stat.st_size != size:
+            return None
+        if stat.st_mtime == mtime or _sha1(manifest_path) == sha1:
+            return compiled
+        return None
+
+    @property
+    def connection(self):
+        import sqlite3
+        pid = os.getpid()
+        if getattr(self._local, 'pid', None) != pid:
+            self._local.connection = sqlite3.connect(self.path)
+            self._local.pid = pid
+        return self._local.connection
+
+    def get(self, path, default=None):
+        row = self.connection.execute(
+            'SELECT version FROM manifest WHERE path = ?', (path,)).fetchone()
+        return row[0] if row is not None else default
+
+    def __getitem__(self, path):
+        version = self.get(path)
+        if version is None:
+            raise KeyError(path)
+        return version
+
+    def __contains__(self, path):
+        return self.get(path) is not None
+
+    def keys(self):
+        return [row[0] for row in self.connection.execute(
+            'SELECT path FROM manifest ORDER BY path')]
+
+    def items(self):
+        return self.connection.execute(
+            'SELECT path, version FROM manifest ORDER BY path').fetchall()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM manifest').fetchone()[0]
+
+
+class ManifestRegistry(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Maps the absolute path of each manifest to a tuple of
+        # `(signature, manifest)`.
+        self._manifests = {}
+
+    @staticmethod
+    def _signature(path):
+        stat = os.stat(path)
+        return stat.st_mtime, stat.st_size, stat.st_ino
+
+    def load(self, path):
+        '''
+        Return the manifest at `path`, loading it only if it's changed since
+        it was last loaded. This is a CompiledManifest when there's a current
+        one, and otherwise the parsed JSON.
+        '''
+        from baiji.pod.util import json
+        key = os.path.abspath(path)
+        signature = self._signature(path)
+        with self._lock:
+            loaded = self._manifests.get(key)
+        if loaded is not None and loaded[0] == signature:
+            return loaded[1]
+        manifest = CompiledManifest.open_if_current(compiled_path(path), path)
+        if manifest is None:
+            manifest = json.load(path)
+        with self._lock:
+            self._manifests[key] = (signature, manifest)
+        return manifest
+
+    def store(self, path, manifest):
+        '''
+        Write `manifest` to `path`, and keep it as the parsed manifest, so it
+        isn't parsed again. A file rewritten within the resolution of its
+        mtime, at the same size, would otherwise look unchanged.
+        '''
+        from baiji.pod.util import json
+        json.dump(manifest, path, sort_keys=True, indent=4)
+        with self._lock:
+            self._manifests[os.path.abspath(path)] = (self._signature(path), manifest)
+
+    def forget(self, path=None):
+        '''
+        Drop the parsed manifest for `path`, or with no path, all of them.
+        '''
+        with self._lock:
+            if path is None:
+                self._manifests.clear()
+            else:
+                self._manifests.pop(os.path.abspath(path), None)
+
+
+registry = ManifestRegistry()
@@ -0,0 +1,171 @@
+'''
+An index of the versions of each file in a versioned cache bucket.
+
+Listing the versions of a file takes an s3 listing, and `vc ls-remote`
+lists the whole bucket. The index keeps the results of these listings in
+`<cache_dir>/.versions/<bucket>.json`, so other processes can use them too.
+The versions of a file are found by listing the file's own prefix, like
+`/foo/bar` for `/foo/bar.csv`, as with no index, and the result is trusted
+for `Config.VERSION_INDEX_TTL` seconds, after which the prefix is listed
+again. A listing of the whole bucket, made for `paths`, covers every file.
+Versions uploaded through the versioned cache are added to it as they're
+made.
+
+The file is read, changed, and written under a `FileLock`, so processes
+sharing it don't lose each other's changes.
+'''
+import os
+import threading
+import time
+
+
+def create_remote_index(settings, bucket):
+    '''
+    Return a RemoteVersionIndex for `bucket`, or None when the index is
+    turned off.
+    '''
+    if not settings.version_index_ttl:
+        return None
+    return RemoteVersionIndex(
+        bucket, os.path.join(settings.cache_dir, '.versions'), settings.version_index_ttl)
+
+
+def listing_prefix(path):
+    '''
+    Return the prefix which is listed to find the versions of `path`. For
+    `''`, it's the whole bucket.
+    '''
+    return os.path.splitext(path)[0]
+
+
+class RemoteVersionIndex(object):
+    def __init__(self, bucket, index_dir, ttl):
+        self.bucket = bucket
+        self.index_path = os.path.join(index_dir, bucket + '.json')
+        self.lock_path = self.index_path + '.lock'
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # A dict with the time each prefix was listed, `listed`, and a dict
+        # mapping each versioned path found to its sorted list of versions,
+        # `versions`.
+        self._index = self._empty()
+
+    @staticmethod
+    def _empty():
+        return {'listed': {}, 'versions': {}}
+
+    def _is_current(self, index, path):
+        '''
+        Whether `index` has a listing of `path`'s prefix, or of the whole
+        bucket, which hasn't expired.
+        '''
+        now = time.time()
+        listed = index['listed']
+        return any(
+            now - listed[prefix] < self.ttl
+            for prefix in [listing_prefix(path), ''] if prefix in listed)
+
+    def _load(self):
+        from baiji.pod.util import json
+        try:
+            index = json.load(self.index_path)
+        except (IOError, ValueError):
+            return self._empty()
+        if not isinstance(index, dict) or 'listed' not in index: # Unrecognized
+            return self._empty()
+        return index
+
+    def _save(self, index):
+        from baiji.pod.util import json
+        from baiji.pod.util.shutillib import atomic_replace
+        with atomic_replace(self.index_path) as tmp_path:
+            json.dump(index, tmp_path)
+
+    def _list(self, prefix):
+        '''
+        List the bucket under `prefix`, and return a dict mapping each
+        versioned path found to its sorted list of versions.
+        '''
+        from baiji import s3
+        from baiji.pod.versioned.versions import split_versioned_path, sort_versions
+        versions = {}
+        for key in s3.ls('s3://' + self.bucket + prefix):
+            try:
+                path, version = split_versioned_path(key)
+            except ValueError: # Not a versioned file
+                continue
+            versions.setdefault(path, []).append(version)
+        return dict((path, sort_versions(v)) for path, v in versions.items())
+
+    def _add_listing(self, index, prefix, versions):
+        '''
+        Replace what `index` has for the paths under `prefix` with
+        `versions`, and drop the listings which have expired.
+        '''
+        now = time.time()
+        for path in index['versions'].keys():
+            if path.startswith(prefix):
+                del index['versions'][path]
+        index['versions'].update(versions)
+        index['listed'] = dict(
+            (x, listed_at) for x, listed_at in index['listed'].items() if now - listed_at < self.ttl)
+        index['listed'][prefix] = now
+
+    def _current_index(self, path, refresh=False):
+        '''
+        Return an index which is current for `path`, loading it, or listing
+        its prefix, if the one we have isn't. With `refresh`, list the prefix
+        regardless. Call this holding `_lock`.
+        '''
+        from baiji.pod.util.locking import FileLock
+        if not refresh and self._is_current(self._index, path):
+            return self._index
+        with FileLock(self.lock_path):
+            index = self._load()
+            if refresh or not self._is_current(index, path):
+                prefix = listing_prefix(path)
+                self._add_listing(index, prefix, self._list(prefix))
+                self._save(index)
+            self._index = index
+        return index
+
+    def versions(self, path, refresh=False):
+        '''
+        Return the versions of `path` on s3, in ascending order. With
+        `refresh`, list them now, whether or not the index has expired.
+        '''
+        with self._lock:
+            return list(self._current_index(path, refresh=refresh)['versions'].get(path, []))
+
+    def paths(self):
+        '''
+        Return the paths in the bucket which have versions.
+        '''
+        with self._lock:
+            return self._current_index('')['versions'].keys()
+
+    def refresh(self):
+        '''
+        List the whole bucket again now, whether or not the index has
+        expired.
+        '''
+        with self._lock:
+            self._current_index('', refresh=True)
+
+    def record(self, path, versions):
+        '''
+        Record that `versions` of `path` are on s3, after an upload, if
+        there's a current listing to add them to. The versions already
+        recorded for `path` are kept.
+        '''
+        from baiji.pod.util.locking import FileLock
+        from baiji.pod.versioned.versions import sort_versions
+        with self._lock, FileLock(self.lock_path):
+            # Another process may have changed it since we loaded it.
+            index = self._load()
+            if not self._is_current(index, path):
+                return
+            known = index['versions'].get(path, [])
+            index['versions'][path] = sort_versions(set(known) | set(versions))
+            self._save(index)
+            self._index = index
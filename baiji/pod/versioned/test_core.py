@@ -65,6 +65,27 @@ class TestVC(ScratchDirMixin, unittest.TestCase):
             manifest_path=self.manifest_file,
             bucket=bucket)
 
+    def test_that_manifest_uris_are_memoized(self):
+        from baiji.pod.versioned.manifest import registry
+        self.addCleanup(registry.forget, self.manifest_file)
+        vc = self.mock_vc()
+
+        with mock.patch.object(vc, 'manifest_version', wraps=vc.manifest_version) as mock_version:
+            self.assertEqual(vc('foo/bar.csv'), '/local/foo/bar.1.2.5.csv')
+            self.assertEqual(vc('foo/bar.csv'), '/local/foo/bar.1.2.5.csv')
+            self.assertEqual(
+                vc.uri('foo/bar.csv'), 's3://baiji-pod-mock-versioned-assets/foo/bar.1.2.5.csv')
+            self.assertEqual(mock_version.call_count, 1)
+
+            # Other versions and suffixes aren't memoized as the manifest version.
+            self.assertEqual(
+                vc.uri('foo/bar.csv', suffixes=['gz']),
+                's3://baiji-pod-mock-versioned-assets/foo/bar.1.2.5.gz.csv')
+            self.assertEqual(vc('foo/bar.csv', version='1.2.3'), '/local/foo/bar.1.2.3.csv')
+
+        vc.update_manifest('/foo/bar.csv', '1.2.6')
+        self.assertEqual(vc('foo/bar.csv'), '/local/foo/bar.1.2.6.csv')
+
     @mock.patch('baiji.s3.exists')
     def test_semver_works(self, exists_mock):
         vc = self.mock_vc()
@@ -114,7 +135,8 @@ class TestVC(ScratchDirMixin, unittest.TestCase):
             mkdir_p(os.path.dirname(dst))
             with open(dst, 'w'):
                 pass
-        with mock.patch('baiji.s3.cp', side_effect=touch_dst):
+            return 'abc'
+        with mock.patch('baiji.pod.transfer.fetch', side_effect=touch_dst):
             vc('/foo/bar.csv')
 
         vc.cache.invalidate(vc.uri('/foo/bar.csv'))
@@ -269,3 +291,27 @@ class TestVC(ScratchDirMixin, unittest.TestCase):
         mock_add.assert_called_with(
             '/foo/bar_new.csv', self.local_json_file,
             version=version, verbose=False)
+
+    @mock.patch('baiji.s3.cp')
+    @mock.patch('baiji.s3.ls')
+    def test_remote_index(self, mock_ls, mock_cp):
+        vc = self.real_vc()
+        mock_ls.return_value = self.bucket_contents
+
+        self.assertEqual(vc.versions_available('/foo/bar.csv'), ['1.2.3', '1.2.5'])
+        self.assertEqual(vc.latest_available_version('/foo/bar.json'), '0.1.6')
+        mock_ls.assert_called_once_with('s3://baiji-test-versioned-assets/foo/bar')
+        self.assertEqual(vc.ls_remote(), ['/foo/bar.csv', '/foo/bar.json'])
+        mock_ls.assert_called_with('s3://baiji-test-versioned-assets')
+        self.assertEqual(mock_ls.call_count, 2)
+
+        # Updates list the path itself, and record the upload.
+        vc.update_patch('/foo/bar.csv', self.local_json_file)
+        mock_ls.assert_called_with('s3://baiji-test-versioned-assets/foo/bar')
+        self.assertEqual(mock_ls.call_count, 3)
+        mock_cp.assert_called_with(
+            self.local_json_file,
+            's3://baiji-test-versioned-assets/foo/bar.1.2.6.csv',
+            progress=False)
+        self.assertEqual(vc.latest_available_version('/foo/bar.csv'), '1.2.6')
+        self.assertEqual(mock_ls.call_count, 3)
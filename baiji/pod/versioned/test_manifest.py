@@ -0,0 +1,145 @@
+import unittest
+import os
+import mock
+from scratch_dir import ScratchDirMixin
+
+
+class TestManifestRegistry(ScratchDirMixin, unittest.TestCase):
+    def setUp(self):
+        from baiji.pod.util import json
+        from baiji.pod.versioned.manifest import ManifestRegistry
+        super(TestManifestRegistry, self).setUp()
+        self.registry = ManifestRegistry()
+        self.manifest_path = os.path.join(self.scratch_dir, 'manifest.json')
+        json.dump({'/foo.txt': '1.0.0'}, self.manifest_path)
+
+        from baiji.pod.util.json import load
+        patcher = mock.patch('baiji.pod.util.json.load', side_effect=load)
+        self.mock_load = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_that_manifest_is_parsed_once(self):
+        first = self.registry.load(self.manifest_path)
+        cwd = os.getcwd()
+        os.chdir(self.scratch_dir)
+        try:
+            second = self.registry.load('manifest.json')
+        finally:
+            os.chdir(cwd)
+        self.assertIs(first, second)
+        self.assertEqual(self.mock_load.call_count, 1)
+
+    def test_that_changed_manifest_is_parsed_again(self):
+        from baiji.pod.util import json
+        self.registry.load(self.manifest_path)
+        json.dump({'/foo.txt': '1.0.0', '/bar.txt': '2.0.0'}, self.manifest_path)
+        self.assertEqual(self.registry.load(self.manifest_path)['/bar.txt'], '2.0.0')
+        self.assertEqual(self.mock_load.call_count, 2)
+
+    def test_that_stored_manifest_is_not_parsed_again(self):
+        # Same size, and most likely the same mtime.
+        self.registry.store(self.manifest_path, {'/foo.txt': '1.0.1'})
+        self.assertEqual(self.registry.load(self.manifest_path), {'/foo.txt': '1.0.1'})
+        self.assertFalse(self.mock_load.called)
+
+    def test_forget(self):
+        self.registry.load(self.manifest_path)
+        self.registry.forget(self.manifest_path)
+        self.registry.load(self.manifest_path)
+        self.assertEqual(self.mock_load.call_count, 2)
+
+
+class TestSharedManifest(ScratchDirMixin, unittest.TestCase):
+    def setUp(self):
+        from baiji.pod.util import json
+        from baiji.pod.versioned.manifest import registry
+        super(TestSharedManifest, self).setUp()
+        self.manifest_path = os.path.join(self.scratch_dir, 'manifest.json')
+        json.dump({'/foo.txt': '1.0.0'}, self.manifest_path)
+        self.addCleanup(registry.forget, self.manifest_path)
+
+    def create_vc(self):
+        from baiji.pod import VersionedCache
+        return VersionedCache(cache=None, manifest_path=self.manifest_path, bucket='bucket')
+
+    def test_that_instances_share_the_manifest(self):
+        self.assertIs(self.create_vc().manifest, self.create_vc().manifest)
+
+    def test_update_manifest(self):
+        from baiji.pod.util import json
+        vc = self.create_vc()
+        other = self.create_vc()
+        before = other.manifest
+        vc.update_manifest('/foo.txt', '1.0.1')
+
+        self.assertEqual(vc.manifest_version('/foo.txt'), '1.0.1')
+        self.assertEqual(json.load(self.manifest_path), {'/foo.txt': '1.0.1'})
+        # The manifest other instances hold isn't changed underneath them,
+        # and new instances see the update.
+        self.assertEqual(before, {'/foo.txt': '1.0.0'})
+        self.assertEqual(self.create_vc().manifest_version('/foo.txt'), '1.0.1')
+
+
+class TestCompiledManifest(ScratchDirMixin, unittest.TestCase):
+    def setUp(self):
+        from baiji.pod.util import json
+        from baiji.pod.versioned.manifest import ManifestRegistry
+        super(TestCompiledManifest, self).setUp()
+        self.registry = ManifestRegistry()
+        self.manifest_path = os.path.join(self.scratch_dir, 'manifest.json')
+        self.contents = {'/foo.txt': '1.0.0', '/bar/baz.obj': '2.3.4'}
+        json.dump(self.contents, self.manifest_path)
+
+    def compile(self):
+        from baiji.pod.versioned.manifest import compile_manifest
+        self.assertEqual(compile_manifest(self.manifest_path), 2)
+
+    def test_that_compiled_manifest_is_used(self):
+        from baiji.pod.versioned.manifest import CompiledManifest
+        self.compile()
+        with mock.patch('baiji.pod.util.json.load') as mock_load:
+            manifest = self.registry.load(self.manifest_path)
+        self.assertFalse(mock_load.called)
+        self.assertIsInstance(manifest, CompiledManifest)
+        self.assertEqual(manifest['/bar/baz.obj'], '2.3.4')
+        self.assertIn('/foo.txt', manifest)
+        self.assertNotIn('/nope.txt', manifest)
+        with self.assertRaises(KeyError):
+            manifest['/nope.txt'] # pylint: disable=pointless-statement
+        self.assertEqual(len(manifest), 2)
+        self.assertEqual(manifest.keys(), ['/bar/baz.obj', '/foo.txt'])
+        self.assertEqual(dict(manifest), self.contents)
+
+    def test_that_stale_compiled_manifest_is_not_used(self):
+        from baiji.pod.util import json
+        self.compile()
+        json.dump({'/foo.txt': '1.0.1', '/bar/baz.obj': '2.3.4'}, self.manifest_path)
+        self.assertEqual(self.registry.load(self.manifest_path), {
+            '/foo.txt': '1.0.1', '/bar/baz.obj': '2.3.4'})
+
+    def test_that_touched_manifest_is_checked_by_hash(self):
+        from baiji.pod.versioned.manifest import CompiledManifest
+        self.compile()
+        stat = os.stat(self.manifest_path)
+        os.utime(self.manifest_path, (stat.st_atime, stat.st_mtime + 10))
+        self.assertIsInstance(self.registry.load(self.manifest_path), CompiledManifest)
+
+    def test_that_invalid_compiled_manifest_is_ignored(self):
+        from baiji.pod.versioned.manifest import compiled_path
+        with open(compiled_path(self.manifest_path), 'w') as f:
+            f.write('not a database')
+        self.assertEqual(self.registry.load(self.manifest_path), self.contents)
+
+    def test_update_manifest_with_compiled_manifest(self):
+        from baiji.pod import VersionedCache
+        from baiji.pod.util import json
+        from baiji.pod.versioned.manifest import registry
+        self.compile()
+        self.addCleanup(registry.forget, self.manifest_path)
+        vc = VersionedCache(cache=None, manifest_path=self.manifest_path, bucket='bucket')
+        with mock.patch('baiji.pod.versioned.manifest.CompiledManifest.get') as mock_get:
+            vc.update_manifest('/foo.txt', '1.0.1')
+        self.assertFalse(mock_get.called)
+        self.assertEqual(vc.manifest_version('/foo.txt'), '1.0.1')
+        self.assertEqual(json.load(self.manifest_path), {
+            '/foo.txt': '1.0.1', '/bar/baz.obj': '2.3.4'})
@@ -0,0 +1,100 @@
+import unittest
+import os
+import mock
+from scratch_dir import ScratchDirMixin
+
+
+class TestRemoteVersionIndex(ScratchDirMixin, unittest.TestCase):
+    def setUp(self):
+        super(TestRemoteVersionIndex, self).setUp()
+        keys = [
+            u'/foo/bar.1.2.3.csv',
+            u'/foo/bar.1.10.0.csv',
+            u'/foo/bar.1.2.5.csv',
+            u'/foo/bar.0.1.6.json',
+            u'/foo/baz.1.0.0.csv',
+            u'/README.md',
+        ]
+        def ls(uri):
+            prefix = uri[len('s3://bucket'):]
+            return [key for key in keys if key.startswith(prefix)]
+        patcher = mock.patch('baiji.s3.ls', side_effect=ls)
+        self.mock_ls = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.index_dir = os.path.join(self.scratch_dir, '.versions')
+
+    def create_index(self, ttl=300):
+        from baiji.pod.versioned.remote_index import RemoteVersionIndex
+        return RemoteVersionIndex('bucket', self.index_dir, ttl)
+
+    def test_that_prefix_is_listed_once(self):
+        index = self.create_index()
+        self.assertEqual(index.versions('/foo/bar.csv'), ['1.2.3', '1.2.5', '1.10.0'])
+        self.assertEqual(index.versions('/foo/bar.json'), ['0.1.6'])
+        self.mock_ls.assert_called_once_with('s3://bucket/foo/bar')
+        self.assertEqual(index.versions('/foo/nope.csv'), [])
+        self.mock_ls.assert_called_with('s3://bucket/foo/nope')
+        self.assertEqual(self.mock_ls.call_count, 2)
+
+    def test_that_bucket_listing_covers_every_path(self):
+        index = self.create_index()
+        self.assertEqual(sorted(index.paths()), ['/foo/bar.csv', '/foo/bar.json', '/foo/baz.csv'])
+        self.assertEqual(index.versions('/foo/baz.csv'), ['1.0.0'])
+        self.assertEqual(index.versions('/foo/nope.csv'), [])
+        self.mock_ls.assert_called_once_with('s3://bucket')
+
+    def test_that_index_is_shared_through_the_file(self):
+        self.create_index().versions('/foo/bar.csv')
+        self.assertEqual(self.create_index().versions('/foo/bar.json'), ['0.1.6'])
+        self.assertEqual(self.mock_ls.call_count, 1)
+
+    def test_that_expired_index_is_listed_again(self):
+        index = self.create_index(ttl=60)
+        index.versions('/foo/bar.csv')
+        with mock.patch('time.time', return_value=time_after(61)):
+            index.versions('/foo/bar.csv')
+            self.create_index(ttl=60).versions('/foo/bar.csv')
+        self.assertEqual(self.mock_ls.call_count, 2)
+
+    def test_refresh(self):
+        index = self.create_index()
+        index.versions('/foo/bar.csv')
+        index.versions('/foo/bar.csv', refresh=True)
+        self.assertEqual(self.mock_ls.call_count, 2)
+
+    def test_record(self):
+        index = self.create_index()
+        index.versions('/foo/bar.csv')
+        index.record('/foo/bar.csv', ['1.10.1'])
+        index.record('/foo/new.csv', ['1.0.0'])
+        other = self.create_index()
+        self.assertEqual(other.versions('/foo/bar.csv')[-1], '1.10.1')
+        self.assertEqual(self.mock_ls.call_count, 1)
+        # Nothing listed /foo/new, so it isn't recorded.
+        self.assertEqual(other.versions('/foo/new.csv'), [])
+        self.assertEqual(self.mock_ls.call_count, 2)
+
+    def test_that_record_without_an_index_does_nothing(self):
+        self.create_index().record('/foo/bar.csv', ['1.10.1'])
+        self.assertFalse(os.path.exists(os.path.join(self.index_dir, 'bucket.json')))
+        self.assertFalse(self.mock_ls.called)
+
+    def test_that_record_waits_for_the_file_lock(self):
+        import threading
+        from baiji.pod.util import json
+        from baiji.pod.util.locking import FileLock
+        index = self.create_index()
+        index.versions('/foo/bar.csv')
+        thread = threading.Thread(target=index.record, args=('/foo/bar.csv', ['1.10.1']))
+        with FileLock(index.lock_path):
+            thread.start()
+            thread.join(0.2)
+            self.assertTrue(thread.is_alive())
+            self.assertEqual(json.load(index.index_path)['versions']['/foo/bar.csv'][-1], '1.10.0')
+        thread.join()
+        self.assertEqual(self.create_index().versions('/foo/bar.csv')[-1], '1.10.1')
+
+
+def time_after(seconds):
+    import time
+    return time.time() + seconds
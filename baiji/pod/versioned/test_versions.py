@@ -0,0 +1,45 @@
+import unittest
+import mock
+
+
+class TestVersions(unittest.TestCase):
+    def test_parse_version(self):
+        from baiji.pod.versioned.versions import parse_version
+        self.assertEqual(parse_version('1.2.3'), (1, 2, 3))
+        self.assertEqual(parse_version('0.10.0'), (0, 10, 0))
+        for invalid in ['1.2', '01.2.3', '1.2.3-beta', 'foo']:
+            with self.assertRaises(ValueError):
+                parse_version(invalid)
+
+    def test_that_versions_sort_numerically(self):
+        from baiji.pod.versioned.versions import sort_versions
+        self.assertEqual(
+            sort_versions(['1.10.0', '1.2.0', '0.1.6', '1.2.10', '1.2.9']),
+            ['0.1.6', '1.2.0', '1.2.9', '1.2.10', '1.10.0'])
+
+    def test_normalize(self):
+        from baiji.pod.versioned.versions import normalize
+        self.assertEqual(normalize('1'), '1.0.0')
+        self.assertEqual(normalize('1.2'), '1.2.0')
+        self.assertEqual(normalize('1.2.3-beta+build'), '1.2.3')
+
+    def test_matches_spec(self):
+        from baiji.pod.versioned.versions import matches_spec
+        self.assertTrue(matches_spec('1.2.3', '>=1.2.0'))
+        self.assertFalse(matches_spec('1.2.3', '>=1.3.0'))
+
+    def test_that_parsing_is_memoized(self):
+        from baiji.pod.versioned import versions
+        versions.parse_version.clear()
+        with mock.patch.object(versions, 'VERSION_PATTERN', wraps=versions.VERSION_PATTERN) as pattern:
+            versions.parse_version('4.5.6')
+            versions.parse_version('4.5.6')
+        self.assertEqual(pattern.match.call_count, 1)
+
+    def test_that_memo_is_bounded(self):
+        from baiji.pod.versioned import versions
+        with mock.patch.object(versions, 'MEMO_SIZE', 2):
+            square = versions.memoize(lambda x: x * x)
+            for x in range(5):
+                self.assertEqual(square(x), x * x)
+            self.assertEqual(square(4), 16)
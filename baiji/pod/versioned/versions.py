@@ -0,0 +1,121 @@
+'''
+Parsing and comparing the N.N.N versions used by the versioned cache.
+
+A version is represented as a tuple of `(major, minor, patch)`, which sorts
+the same way the versions do. The regular expressions are compiled once,
+and parsed versions and specs are memoized, since the same few versions
+come up over and over when listing and sorting the keys in a bucket.
+'''
+import re
+
+# Like `re.match`, these match at the start of the string, so a version
+# followed by anything else, like a prerelease, is valid.
+VERSION_PATTERN = re.compile(r'(0|[1-9][0-9]*)\.(0|[1-9][0-9]*)\.(0|[1-9][0-9]*)')
+VERSIONED_PATH_PATTERN = re.compile(
+    r'.*?\.((0|[1-9][0-9]*)\.(0|[1-9][0-9]*)\.(0|[1-9][0-9]*))(\.[^\.]*)?')
+
+# The most results to keep for each memoized function. When it's full, the
+# memo is cleared and starts again.
+MEMO_SIZE = 10000
+
+
+def memoize(fn):
+    '''
+    Memoize a function of one hashable argument. Exceptions aren't
+    memoized.
+    '''
+    import functools
+    memo = {}
+
+    @functools.wraps(fn)
+    def memoized(arg):
+        try:
+            return memo[arg]
+        except KeyError:
+            pass
+        result = fn(arg)
+        if len(memo) >= MEMO_SIZE:
+            memo.clear()
+        memo[arg] = result
+        return result
+
+    memoized.clear = memo.clear
+    return memoized
+
+
+@memoize
+def parse_version(version):
+    '''
+    Parse a version of the form N.N.N into a tuple of ints. Raises a
+    ValueError if it isn't one.
+    '''
+    match = VERSION_PATTERN.match(version)
+    if match is None or match.end() != len(version):
+        raise ValueError('Invalid version {}, always use versions of the form N.N.N'.format(version))
+    return tuple(int(part) for part in match.groups())
+
+
+def format_version(version):
+    '''
+    Format a tuple from `parse_version` as a string.
+    '''
+    return '{}.{}.{}'.format(*version)
+
+
+def sort_versions(versions):
+    '''
+    Sort a list of version strings into ascending order.
+    '''
+    return sorted(versions, key=parse_version)
+
+
+def extract_version(path):
+    '''
+    Return the version string in a versioned path, like `1.2.3` in
+    `/foo/bar.1.2.3.csv`. Raises a ValueError if there isn't one.
+    '''
+    match = VERSIONED_PATH_PATTERN.match(path)
+    if match is None:
+        raise ValueError('No version string found in {}'.format(path))
+    return match.group(1)
+
+
+def split_versioned_path(path):
+    '''
+    Split a versioned path into the path it's a version of and the version,
+    like `/foo/bar.1.2.3.csv` into `('/foo/bar.csv', '1.2.3')`. Raises a
+    ValueError if there isn't a version in it.
+    '''
+    version = extract_version(path)
+    position = path.rfind(version)
+    return path[:position].rstrip('.') + path[position + len(version):], version
+
+
+@memoize
+def normalize(version):
+    '''
+    Fill in a partial version string like `1.2` to a full one like `1.2.0`,
+    dropping any prerelease or build.
+    '''
+    import semantic_version
+    version = semantic_version.Version(version, partial=True)
+    return format_version((version.major or 0, version.minor or 0, version.patch or 0))
+
+
+@memoize
+def _spec(spec):
+    import semantic_version
+    return semantic_version.Spec(spec)
+
+
+@memoize
+def _semantic_version(version):
+    import semantic_version
+    return semantic_version.Version(version)
+
+
+def matches_spec(version, spec):
+    '''
+    Check whether `version` matches a semantic_version spec like `>=1.2`.
+    '''
+    return _spec(str(spec)).match(_semantic_version(str(version)))